@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+benchmark.py times each stage of creating a dataset on synthetic corpora built from the
+vocabularies and dataset/training.json: drawing scenarios, formatting prompts, completing
+them (against utilities/stub_server.py, so nothing is sent to OpenAI), cleaning and parsing
+the notes, converting them, and scoring annotations.
+
+Results are written as JSON, and compared to a saved baseline with --baseline, which lists
+the stages that got slower by more than --tolerance (and exits with status 1 if any did).
+"""
+import json
+import logging
+import os
+import pathlib
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Callable, List, Literal, Optional, Tuple
+
+from tap import Tap
+
+import convert
+import generate
+import utilities.cache
+import utilities.scoring
+import utilities.stub_server
+import utilities.tags
+import utilities.vocabulary
+
+STAGES = ['scenarios', 'scenarios_numpy', 'prompts', 'completions', 'clean', 'parse',
+          'convert_csv', 'convert_xml', 'convert_labelstudio', 'convert_text', 'convert_spacy', 'score']
+
+class Arguments(Tap):
+    stages: List[Literal[tuple(STAGES)]] = [s for s in STAGES if s != 'convert_spacy']
+    """The stages to time (convert_spacy also needs --spacyPipeline)"""
+    scenarios: int = 10000
+    """The number of scenarios to draw"""
+    completions: int = 200
+    """The number of prompts to complete with the stub server"""
+    notes: int = 5000
+    """The number of notes to clean, parse and convert (taken from --dataset, repeated as needed)"""
+    tasks: int = 2000
+    """The number of annotated tasks to score (taken from --annotations, repeated as needed)"""
+    dataset: pathlib.Path = 'dataset/training.json'
+    """The results to take notes from"""
+    annotations: pathlib.Path = 'samples/iaa-tests-03-08/annotations/annotator_1/baseline.json'
+    """The Label Studio annotations to take tasks from"""
+    spacyPipeline: str = None
+    """The spaCy pipeline to time convert_spacy with"""
+    repeat: int = 3
+    """How many times to run each stage (the fastest run is kept)"""
+    seed: int = 42
+    """The seed for drawing scenarios"""
+    output: pathlib.Path = 'benchmark.json'
+    """The JSON file to write the results to"""
+    baseline: Optional[pathlib.Path] = None
+    """Results of an earlier run to compare to"""
+    compare: Optional[pathlib.Path] = None
+    """Compare these results to --baseline, instead of running the benchmark"""
+    tolerance: float = 0.1
+    """How much slower (as a fraction) a stage may get before it counts as a regression"""
+    verbose: bool = False
+    """Whether to output debugging information"""
+
+def peak_rss_mb() -> float:
+    """peak_rss_mb gives the largest resident set size of this process so far, in megabytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def repeated(items: list, n: int) -> list:
+    """repeated gives the first n items of items repeated over and over."""
+    return [items[i % len(items)] for i in range(n)]
+
+def time_stage(run: Callable[[], Tuple[int, int]], repeat: int) -> dict:
+    """time_stage runs a stage repeat times, keeping the fastest. The stage returns the
+    number of items and bytes it processed."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        items, size = run()
+        seconds = time.perf_counter() - started
+        if best is None or seconds < best:
+            best = seconds
+    return {'seconds': best, 'items': items, 'items_per_second': items / best,
+            'megabytes_per_second': size / best / 1e6 if size else None, 'peak_rss_mb': peak_rss_mb()}
+
+def benchmark(args: Arguments) -> dict:
+    store = utilities.vocabulary.load_store('all')
+    with open(args.dataset, 'r', encoding='utf8') as dataset_file:
+        notes = repeated(json.load(dataset_file)['results'], args.notes)
+    with open(args.annotations, 'r', encoding='utf8') as annotations_file:
+        tasks = repeated(json.load(annotations_file), args.tasks)
+    notes_size = sum(len(note.encode('utf8')) for note in notes)
+    scenarios = generate.create_scenarios(max(args.scenarios, args.completions), 'nb', store=store, with_replacement=True)
+    prompts = [generate.format_scenario(s) for s in scenarios[:args.completions]]
+
+    def draw(backend: str):
+        def run():
+            random.seed(args.seed)
+            generate.create_scenarios(args.scenarios, 'nb', store=store, with_replacement=True, backend=backend)
+            return args.scenarios, 0
+        return run
+
+    def format_prompts():
+        formatted = [generate.format_scenario(s) for s in scenarios[:args.scenarios]]
+        return len(formatted), sum(len(p) for p in formatted)
+
+    def complete():
+        # Every run starts from an empty cache, so every prompt is sent to the stub
+        with tempfile.TemporaryDirectory() as directory, \
+                utilities.stub_server.StubServer(utilities.stub_server.StubArguments().parse_args(['--port', '0'])) as server:
+            generate_args = generate.Arguments().parse_args(['--openAIKey', 'stub', '--apiBase', server.url])
+            cache = utilities.cache.CompletionCache(os.path.join(directory, 'completions.sqlite'))
+            completed = generate.create_engine(cache, generate_args).complete_all(prompts)
+        return len(completed), sum(len(note.encode('utf8')) for note in completed)
+
+    def clean():
+        return len([generate.clean_answer(note) for note in notes]), notes_size
+
+    def parse():
+        return len(utilities.tags.parse_notes(notes)), notes_size
+
+    def convert_to(format: str):
+        def run():
+            convert_args = convert.Arguments().parse_args(['--format', format, '--noTokenCache'] +
+                                                          (['--spacyPipeline', args.spacyPipeline] if args.spacyPipeline else []))
+            with tempfile.TemporaryDirectory() as directory:
+                output_path = pathlib.Path(directory) / (format if format == 'text' else f'notes.{format}')
+                if format == 'text':
+                    output_path.mkdir()
+                convert.convert(notes, {format: output_path}, convert_args)
+            return len(notes), notes_size
+        return run
+
+    def score():
+        spans = [([(s['start'], s['end'], s['labels'][0]) for s in task['label']],
+                  utilities.tags.list_annotations(task['original_text'])) for task in tasks]
+        utilities.scoring.score_spans([task['text'] for task in tasks], [s[0] for s in spans], [s[1] for s in spans])
+        return len(tasks), sum(len(task['text'].encode('utf8')) for task in tasks)
+
+    runs = {'scenarios': draw('random'), 'scenarios_numpy': draw('numpy'), 'prompts': format_prompts,
+            'completions': complete, 'clean': clean, 'parse': parse, 'score': score,
+            **{f'convert_{f}': convert_to(f) for f in convert.FORMATS}}
+    stages = {}
+    for stage in args.stages:
+        if stage == 'convert_spacy' and args.spacyPipeline is None:
+            logging.warning("Skipping convert_spacy, which needs --spacyPipeline")
+            continue
+        logging.info(f"Timing {stage}")
+        stages[stage] = time_stage(runs[stage], args.repeat)
+        logging.info(f"{stage}: {stages[stage]['items_per_second']:.1f} items/s")
+    return stages
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """compare prints how the throughput of each stage changed from the baseline,
+    and gives the stages that got slower by more than tolerance."""
+    regressions = []
+    for stage, timing in results['stages'].items():
+        if stage not in baseline['stages']:
+            print(f"{stage:22s} {timing['items_per_second']:12.1f}/s (not in baseline)")
+            continue
+        before = baseline['stages'][stage]['items_per_second']
+        change = timing['items_per_second'] / before - 1
+        regressed = change < -tolerance
+        if regressed:
+            regressions.append(stage)
+        print(f"{stage:22s} {timing['items_per_second']:12.1f}/s {before:12.1f}/s {100 * change:+7.1f}%"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+def main(args: Arguments):
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    if args.compare is not None:
+        with open(args.compare, 'r', encoding='utf8') as results_file:
+            results = json.load(results_file)
+    else:
+        results = {'parameters': {k: str(v) if isinstance(v, pathlib.Path) else v for k, v in args.as_dict().items()},
+                   'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                                   'cpus': os.cpu_count(), 'created': time.time()},
+                   'stages': benchmark(args)}
+        with open(args.output, 'w', encoding='utf8') as output:
+            json.dump(results, output, indent=2)
+        logging.info(f"Wrote results to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf8') as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            logging.error(f"{len(regressions)} stages got more than {100 * args.tolerance:.0f}% slower: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    args = Arguments()
+    args.parse_args()
+    main(args)
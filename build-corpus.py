@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+build-corpus.py builds a columnar corpus file (see utilities/corpus.py) from the results of
+generate.py, which convert.py, validate-coverage.py and the other scripts read without
+parsing the whole file, or writes a corpus back to the JSON layout of the results.
+"""
+import logging
+import pathlib
+import time
+from tap import Tap
+
+import utilities.corpus
+
+class Arguments(Tap):
+    input: pathlib.Path = 'dataset/training.json'
+    """The results (or --checkpoint record file) of generate.py, or a corpus file (ending in .corpus) to export"""
+    output: pathlib.Path = None
+    """The corpus file to write (by default the input with the suffix .corpus), or the JSON file to export a corpus to"""
+    verbose: bool = False
+    """Whether to output debugging information"""
+
+def main(args: Arguments):
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    started = time.perf_counter()
+    if utilities.corpus.is_corpus(args.input):
+        output = args.output or args.input.with_suffix('.json')
+        utilities.corpus.export_results(args.input, output)
+        logging.info(f"Exported {args.input} to {output} in {time.perf_counter() - started:.2f}s")
+    else:
+        output = args.output or args.input.with_suffix('.corpus')
+        count = utilities.corpus.import_results(args.input, output)
+        logging.info(f"Wrote {count} notes to {output} in {time.perf_counter() - started:.2f}s")
+
+if __name__ == '__main__':
+    args = Arguments()
+    args.parse_args()
+    main(args)
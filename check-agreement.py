@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+check-agreement.py measures how well the annotators of a sample (e.g. samples/iaa-tests-03-08)
+agree with each other and with the annotations generated by GPT-4.
+
+Annotations are read from <samples>/annotations/<annotator>/<variant>.json, and tasks are
+matched between annotators by their id. For each variant, every pair of annotators is scored
+(exact, overlap and token F1, with per-label breakdowns), and Fleiss' kappa and Krippendorff's
+alpha are computed over the labels of each token.
+"""
+
+import concurrent.futures
+import itertools
+import json
+import logging
+import pathlib
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from tap import Tap
+
+from utilities.scoring import Corpus, category_counts, fleiss_kappa, krippendorff_alpha, label_ids, score_spans, tokenize
+from utilities.tags import list_annotations
+
+# MODEL is the name the annotations generated by GPT-4 are given, when included with --includeModel
+MODEL = 'model'
+
+class Arguments(Tap):
+    samples: pathlib.Path = 'samples/iaa-tests-03-08' # The sample directory, with annotations/<annotator>/<variant>.json
+    includeModel: bool = False # Compare the annotators to the annotations generated by GPT-4 (as the annotator 'model')
+    phiOnly: bool = False # Ignore classes, force all labels into a single class
+    cleanAges: bool = False # Strip "years" and "years old" from the end of spans
+    processes: int = 1 # The number of processes to score pairs of annotators with
+    output: Optional[pathlib.Path] = None # A JSON file to write the agreement to
+    verbose: bool = False # Whether to output debugging information
+
+def discover(args: Arguments) -> Dict[str, dict]:
+    """discover reads every annotator's annotations of every variant, giving for each variant
+    the text and tokens of each task (by id), and the spans of each annotator (by task id).
+    Each unique text is only tokenized once."""
+    variants = {}
+    tokens = {}
+    for path in sorted(pathlib.Path(args.samples, 'annotations').glob('*/*.json')):
+        annotator, variant = path.parent.name, path.stem
+        with open(path, 'r', encoding='utf8') as annotation_file:
+            tasks = json.load(annotation_file)
+        found = variants.setdefault(variant, {'texts': {}, 'annotators': {}})
+        for task in tasks:
+            text = found['texts'].setdefault(task['id'], task['text'])
+            if text != task['text']:
+                logging.warning(f"Task {task['id']} of {variant} has a different text for {annotator}, skipping it")
+                continue
+            if text not in tokens:
+                tokens[text] = tokenize(text)
+            found['annotators'].setdefault(annotator, {})[task['id']] = [
+                (s['start'], s['end'], 'PHI' if args.phiOnly else s['labels'][0]) for s in task['label']]
+            if args.includeModel:
+                found['annotators'].setdefault(MODEL, {})[task['id']] = [
+                    (s[0], s[1], 'PHI' if args.phiOnly else s[2]) for s in list_annotations(task['original_text'])]
+    for variant in variants.values():
+        variant['tokens'] = {i: tokens[text] for i, text in variant['texts'].items()}
+        logging.debug(f"Found annotators {sorted(variant['annotators'])} for {len(variant['texts'])} tasks")
+    return variants
+
+# _variants holds the annotations in each worker process, so that only the pairs to score are sent to it
+_variants = None
+
+def _load_variants(variants: Dict[str, dict]):
+    global _variants
+    _variants = variants
+
+def score_pair(variant_name: str, reference: str, predicted: str, clean_ages: bool) -> Tuple[str, str, str, dict]:
+    """score_pair scores the annotations of one annotator against another's, on the tasks both annotated."""
+    variant = _variants[variant_name]
+    shared = sorted(set(variant['annotators'][reference]) & set(variant['annotators'][predicted]))
+    scores = score_spans([variant['texts'][i] for i in shared],
+                         [variant['annotators'][reference][i] for i in shared],
+                         [variant['annotators'][predicted][i] for i in shared],
+                         tokens=[variant['tokens'][i] for i in shared], clean_ages=clean_ages)
+    return variant_name, reference, predicted, {'tasks': len(shared), **scores}
+
+def token_agreement(variant: dict, clean_ages: bool) -> dict:
+    """token_agreement computes Fleiss' kappa over the tasks every annotator annotated, and
+    Krippendorff's alpha over the tasks at least two annotators annotated, treating the
+    label of each token (or none) as a category."""
+    annotators = sorted(variant['annotators'])
+    rated = [i for i in sorted(variant['texts']) if sum(i in variant['annotators'][a] for a in annotators) >= 2]
+    corpus = Corpus([variant['texts'][i] for i in rated], [variant['tokens'][i] for i in rated])
+    ids = label_ids(*[variant['annotators'][a].values() for a in annotators])
+    labels = np.full((len(annotators), corpus.token_count), -1, dtype=np.int64)
+    token_tasks = np.repeat(np.arange(len(rated)), [len(variant['tokens'][i][0]) for i in rated])
+    for row, annotator in enumerate(annotators):
+        annotations = variant['annotators'][annotator]
+        labels[row] = corpus.token_labels([annotations.get(i, []) for i in rated], ids, clean_ages)
+        # Tokens of tasks the annotator didn't annotate have no rating
+        missing = np.array([i not in annotations for i in rated], dtype=bool)
+        labels[row, missing[token_tasks]] = -2
+
+    counts = category_counts(labels, len(ids))
+    everyone = (labels != -2).all(axis=0)
+    kappa, per_label = fleiss_kappa(counts[everyone])
+    return {'tokens': int(corpus.token_count), 'fleiss_tokens': int(everyone.sum()),
+            'fleiss_kappa': kappa, 'krippendorff_alpha': krippendorff_alpha(counts),
+            'fleiss_kappa_per_type': {label: float(per_label[i]) for label, i in ids.items()}}
+
+def main(args: Arguments):
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    started = time.perf_counter()
+    variants = discover(args)
+
+    pairs = [(name, a, b, args.cleanAges) for name, variant in variants.items()
+             for a, b in itertools.combinations(sorted(variant['annotators']), 2)]
+    if args.processes > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.processes, initializer=_load_variants,
+                                                    initargs=(variants,)) as executor:
+            scored = list(executor.map(score_pair, *zip(*pairs))) if pairs else []
+    else:
+        _load_variants(variants)
+        scored = [score_pair(*pair) for pair in pairs]
+
+    agreement = {}
+    for name, variant in variants.items():
+        annotators = sorted(variant['annotators'])
+        agreement[name] = {'annotators': annotators, 'tasks': len(variant['texts']), 'pairs': [],
+                           **token_agreement(variant, args.cleanAges)}
+        for kind in ['exact', 'overlap', 'token']:
+            # The F1 of a pair doesn't depend on which annotator is the reference, so the matrix is symmetric
+            agreement[name][f'{kind}_f'] = np.eye(len(annotators)).tolist()
+    for name, reference, predicted, scores in scored:
+        variant = agreement[name]
+        variant['pairs'].append({'reference': reference, 'predicted': predicted, **scores})
+        a, b = variant['annotators'].index(reference), variant['annotators'].index(predicted)
+        for kind in ['exact', 'overlap', 'token']:
+            variant[f'{kind}_f'][a][b] = variant[f'{kind}_f'][b][a] = scores[kind]['f']
+
+    for name, variant in agreement.items():
+        print(f"{name}: {variant['tasks']} tasks, Fleiss' kappa {variant['fleiss_kappa']:.3f} "
+              f"({variant['fleiss_tokens']} tokens), Krippendorff's alpha {variant['krippendorff_alpha']:.3f}")
+        for pair in variant['pairs']:
+            print(f"  {pair['reference']} / {pair['predicted']} ({pair['tasks']} tasks): exact F1 {pair['exact']['f']:.3f}, "
+                  f"overlap F1 {pair['overlap']['f']:.3f}, token F1 {pair['token']['f']:.3f}")
+    logging.info(f"Compared {len(scored)} pairs of annotators in {len(variants)} variants in {time.perf_counter() - started:.2f}s")
+
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf8') as output:
+            json.dump(agreement, output, indent=2)
+
+if __name__ == '__main__':
+    args = Arguments().parse_args()
+    main(args)
@@ -9,16 +9,15 @@ import time
 import os
 import logging
 import json
-from typing import List
+from typing import List, Literal, Optional, Tuple
 import re
 
 from tap import Tap
-import spacy
-import spacy.training
-import spacy.scorer
-from spacy import displacy
 
-from utilities import list_annotations
+from utilities.corpus import CorpusFile
+from utilities.scoring import Span, score_spans
+from utilities.tags import list_annotations
+from utilities.tokcache import TokenizationCache
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -28,8 +27,13 @@ class ExperimentArguments(Tap):
     phiOnly: bool = False # Ignore classes, force all labels into a single class
     cleanAges: bool = False # Strip "år gammel" from Age spans
     visualize: bool = False # Generate span diagrams
+    engine: Literal['native', 'spacy'] = 'native' # Score spans from character offsets (native) or with spacy.scorer.Scorer
+    crossCheck: bool = False # Also score with spaCy, and report where it disagrees with the native exact scores
+    noTokenCache: bool = False # Tokenize every task again, instead of reusing the tokenizations cached in .cache/tokens.sqlite
+    corpus: str = None # A corpus (see build-corpus.py) with the notes of the tasks, to read the spans predicted by GPT-4 from instead of parsing them
 
 def visualize_example(path, example):
+    from spacy import displacy
     comparison = {
         "text": example.reference.text,
         "spans": [{"start_token": e.start, "end_token": e.end, "label": "TRUE_" + e.label_} for e in example.reference.ents] +
@@ -39,15 +43,39 @@ def visualize_example(path, example):
     with open(path, 'w', encoding='utf-8') as example_html:
         example_html.write(displacy.render(comparison, 'span', manual=True))
 
-def create_examples(args, nlp, example_path) -> List[spacy.training.Example]:
-    examples = []
+def load_tasks(example_path) -> List[dict]:
     with open(example_path, encoding='utf-8') as reference_file:
-        reference_json = json.load(reference_file)
-    
-    for task in reference_json:
-        task_text = task['text']
+        return json.load(reference_file)
+
+def predicted_annotations(task, corpus: Optional[CorpusFile] = None) -> List[Span]:
+    """predicted_annotations gives the spans predicted by GPT-4 for a task, read from the note with
+    the same text in the corpus if given (and it has one), and parsed from the task otherwise."""
+    if corpus is not None:
+        index = corpus.find(task['text'])
+        if index is not None:
+            return corpus.spans(index)
+        logging.warning(f"Task {task.get('id')} is not in {corpus.path}, parsing its annotations")
+    return list_annotations(task['original_text'])
+
+def task_spans(args, task, corpus: Optional[CorpusFile] = None) -> Tuple[List[Span], List[Span]]:
+    """task_spans gives the reference spans labelled in Label Studio and the spans predicted by GPT-4 for a task."""
+    reference = [(s['start'], s['end'], 'PHI' if args.phiOnly else s['labels'][0]) for s in task['label']]
+    predicted = [(s[0], s[1], 'PHI' if args.phiOnly else s[2]) for s in predicted_annotations(task, corpus)]
+    return reference, predicted
 
-        reference_doc = nlp.make_doc(task_text)
+def score_tasks(args, tasks, tokens=None, corpus: Optional[CorpusFile] = None) -> dict:
+    spans = [task_spans(args, task, corpus) for task in tasks]
+    return score_spans([task['text'] for task in tasks], [s[0] for s in spans], [s[1] for s in spans],
+                       tokens=tokens, clean_ages=args.cleanAges)
+
+def create_examples(args, nlp, tasks, token_cache: TokenizationCache = None, corpus: Optional[CorpusFile] = None) -> list:
+    import spacy
+    import spacy.training
+    examples = []
+    texts = [task['text'] for task in tasks]
+    docs = token_cache.make_docs(nlp, texts) if token_cache is not None else (nlp.make_doc(text) for text in texts)
+    for task, doc in zip(tasks, docs):
+        reference_doc = doc
         reference_ents = [reference_doc.char_span(s['start'], s['end'], label='PHI' if args.phiOnly else s['labels'][0], alignment_mode='expand') for s in task['label']]
         if args.cleanAges:
             for ent in reference_ents:
@@ -58,10 +86,9 @@ def create_examples(args, nlp, example_path) -> List[spacy.training.Example]:
         else:
             pass
         reference_doc.set_ents(reference_ents)
-        
-        predicted_doc = nlp.make_doc(task_text) # Make a new document but with the same tokenization
-        predicted = task['original_text']
-        predicted_entities = list_annotations(predicted)
+
+        predicted_doc = doc.copy() # Make a new document but with the same tokenization
+        predicted_entities = predicted_annotations(task, corpus)
         predicted_spans = [predicted_doc.char_span(s[0], s[1], label='PHI' if args.phiOnly else s[2], alignment_mode='expand') for s in predicted_entities]
         if args.cleanAges:
             for ent in predicted_spans:
@@ -71,7 +98,7 @@ def create_examples(args, nlp, example_path) -> List[spacy.training.Example]:
                     ent.end -= 2
         else:
             pass
-        predicted_doc.set_ents(predicted_spans)
+        predicted_doc.set_ents(spacy.util.filter_spans(predicted_spans))
 
         example = spacy.training.Example(predicted_doc, reference_doc)
         if args.visualize:
@@ -80,15 +107,53 @@ def create_examples(args, nlp, example_path) -> List[spacy.training.Example]:
         examples.append(example)
     return examples
 
+def cross_check(args, tasks, examples, corpus: Optional[CorpusFile] = None) -> bool:
+    """cross_check scores the tasks natively with the tokens of the spaCy pipeline, and
+    compares the exact scores to those of spaCy. Returns whether they agree."""
+    import spacy.scorer
+    spacy_scores = spacy.scorer.get_ner_prf(examples)
+    tokens = [([t.idx for t in e.reference], [t.idx + len(t) for t in e.reference]) for e in examples]
+    exact = score_tasks(args, tasks, tokens=tokens, corpus=corpus)['exact']
+
+    disagreements = [f"{key}: native {exact[key[-1]]}, spaCy {spacy_scores[key]}" for key in ['ents_p', 'ents_r', 'ents_f']
+                     if abs(exact[key[-1]] - (spacy_scores[key] or 0.0)) > 1e-9]
+    for label, scores in (spacy_scores['ents_per_type'] or {}).items():
+        native = exact['per_type'].get(label, {'p': 0.0, 'r': 0.0, 'f': 0.0})
+        disagreements += [f"{label} {key}: native {native[key]}, spaCy {scores[key]}" for key in 'prf' if abs(native[key] - scores[key]) > 1e-9]
+    for disagreement in disagreements:
+        logging.warning(f"Cross-check: {disagreement}")
+    if not disagreements:
+        logging.info("Cross-check: the native exact scores agree with spaCy")
+    return not disagreements
+
 def main(args: ExperimentArguments):
-    logging.debug(f'Loading pipeline {args.spacyPipeline}')
-    nlp = spacy.load(args.spacyPipeline, enable=['ner'])
+    tasks = load_tasks(args.annotations)
+    corpus = CorpusFile(args.corpus) if args.corpus is not None else None
+
+    examples = None
+    if args.engine == 'spacy' or args.crossCheck or args.visualize:
+        import spacy
+        logging.debug(f'Loading pipeline {args.spacyPipeline}')
+        nlp = spacy.load(args.spacyPipeline, enable=['ner'])
+        token_cache = None if args.noTokenCache else TokenizationCache()
+        examples = create_examples(args, nlp, tasks, token_cache, corpus)
+        if token_cache is not None:
+            logging.info(token_cache.summary())
+
+    if args.engine == 'spacy':
+        import spacy.scorer
+        scorer = spacy.scorer.Scorer(nlp)
+        evaluation = scorer.score(examples)
+        print(evaluation)
+    else:
+        started = time.perf_counter()
+        scores = score_tasks(args, tasks, corpus=corpus)
+        logging.debug(f'Scored {len(tasks)} tasks in {time.perf_counter() - started:.3f}s')
+        print(json.dumps(scores, indent=2))
 
-    answers = create_examples(args, nlp, example_path=args.annotations)
-    scorer = spacy.scorer.Scorer(nlp)
-    evaluation = scorer.score(answers)
-    print(evaluation)
+    if args.crossCheck:
+        cross_check(args, tasks, examples, corpus)
 
 if __name__ == '__main__':
     args = ExperimentArguments().parse_args()
-    main(args)
\ No newline at end of file
+    main(args)
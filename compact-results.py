@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+compact-results.py rewrites the JSONL checkpoint of a generation run
+(see --checkpoint in generate.py) as a single results JSON file.
+"""
+import pathlib
+import logging
+from tap import Tap
+
+import utilities.records
+
+class Arguments(Tap):
+    input: pathlib.Path
+    """The JSONL checkpoint to compact."""
+    output: pathlib.Path = 'results.json'
+    """The JSON file to write the results to."""
+    verbose: bool = False
+    """Whether to output debugging information"""
+
+def main(args: Arguments):
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    utilities.records.compact(args.input, args.output)
+    logging.info(f"Wrote results to {args.output}")
+
+if __name__ == '__main__':
+    args = Arguments()
+    args.parse_args()
+    main(args)
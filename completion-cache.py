@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+completion-cache.py inspects and maintains the completion cache used by generate.py,
+and imports completions cached by joblib in earlier versions of generate.py.
+"""
+import json
+import logging
+import pathlib
+from tap import Tap
+
+import utilities.cache
+
+class Arguments(Tap):
+    cache: pathlib.Path = '.cache/completions.sqlite'
+    """The completion cache to maintain."""
+    importJoblib: pathlib.Path = None
+    """A joblib cache directory (e.g. .cache) to import completions from."""
+    systemPrompt: str = None
+    """The system prompt the imported completions were made with (defaults to the one in generate.py)."""
+    maxEntries: int = None
+    """Evict the least recently used completions beyond this number of entries."""
+    maxBytes: int = None
+    """Evict the least recently used completions beyond this total size of answers."""
+    maxAgeDays: float = None
+    """Evict completions created more than this many days ago."""
+    verbose: bool = False
+    """Whether to output debugging information"""
+
+def main(args: Arguments):
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    cache = utilities.cache.CompletionCache(args.cache)
+
+    if args.importJoblib is not None:
+        system_prompt = args.systemPrompt
+        if system_prompt is None:
+            from generate import SYSTEM_PROMPT
+            system_prompt = SYSTEM_PROMPT
+        imported = cache.import_joblib(args.importJoblib, system_prompt)
+        logging.info(f"Imported {imported} completions from {args.importJoblib}")
+
+    if args.maxEntries is not None or args.maxBytes is not None or args.maxAgeDays is not None:
+        removed = cache.evict(args.maxEntries, args.maxBytes, args.maxAgeDays)
+        logging.info(f"Evicted {removed} completions")
+
+    print(json.dumps(cache.stats()))
+
+if __name__ == '__main__':
+    args = Arguments()
+    args.parse_args()
+    main(args)
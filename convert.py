@@ -1,11 +1,22 @@
 #!/usr/bin/env python3
+import collections
+import concurrent.futures
+import dataclasses
+import functools
+import itertools
+import queue
 import re
 import pathlib
 import json
-from typing import Literal
+import threading
+import time
+from typing import Dict, Iterable, List, Literal, Optional
 from tap import Tap
 
+import utilities.corpus
+import utilities.stream
 import utilities.tags
+import utilities.tokcache
 
 def fix_orthography(answer: str) -> str:
     """fix_orthography adds spaces between punctuation and
@@ -17,82 +28,336 @@ def fix_orthography(answer: str) -> str:
 
 class Arguments(Tap):
     input: pathlib.Path = 'results.json'
-    """The JSON file with annotated notes to convert to a specific format."""
+    """The JSON file (or JSONL checkpoint from generate.py) with annotated notes to convert to a specific format."""
     output: pathlib.Path = 'results.csv'
     """The filename or directory to write converted documents to."""
-    format: Literal['csv', 'xml', 'labelstudio', 'spacy', 'text'] = 'csv'
-    """The format to convert notes to."""
+    format: List[Literal['csv', 'xml', 'labelstudio', 'spacy', 'text', 'all']] = ['csv']
+    """The formats to convert notes to ('all' for every format). With more than one, output is a directory to write each format to."""
     section: Literal['cleaned', 'results'] = 'cleaned'
     """Whether to use the cleaned texts under 'cleaned_results' or the original annotated examples under 'results' """
+    spacyPipeline: str = 'nb_core_news_sm'
+    """The spaCy pipeline to tokenize notes with when converting to spacy."""
+    workers: int = 1
+    """The number of processes to convert notes to spacy with."""
+    batchSize: int = 256
+    """The number of notes each process converts to spacy at a time."""
+    shards: bool = False
+    """Write one spacy file per batch (e.g. training-000.spacy) and a manifest instead of a single file."""
+    noTokenCache: bool = False
+    """Tokenize every note again, instead of reusing the tokenizations cached in .cache/tokens.sqlite."""
+    start: int = None
+    """The index of the first note to convert."""
+    stop: int = None
+    """The index after the last note to convert."""
 
-def main(args: Arguments):
-    with open(args.input, 'r', encoding='utf8') as input_file:
-        source = json.load(input_file)
+FORMATS = ['csv', 'xml', 'labelstudio', 'spacy', 'text']
+
+# FORMAT_OUTPUTS name the output of each format in the output directory, when converting to several formats
+FORMAT_OUTPUTS = {'csv': '{stem}.csv', 'xml': '{stem}.xml', 'labelstudio': '{stem}.labelstudio.json',
+                  'spacy': '{stem}.spacy', 'text': '{stem}-text'}
+
+# PARSED_FORMATS are written from the parsed note, the others from the annotated text
+PARSED_FORMATS = ['csv', 'labelstudio', 'text']
+
+# NOTE_CHUNK is the number of notes passed to the writers at a time, and QUEUED_CHUNKS
+# the number of chunks a writer may fall behind the reader before the reader waits for it
+NOTE_CHUNK = 64
+QUEUED_CHUNKS = 16
+
+@dataclasses.dataclass
+class Note:
+    """Note is an annotated note as it is passed to the writers."""
+    annotated: str
+    """The note with its XML-style tags."""
+    parsed: Optional[utilities.tags.ParsedNote]
+    """The parsed tags, if any of the writers need them."""
 
+@dataclasses.dataclass
+class WriterTiming:
+    """WriterTiming records how long a writer took to write its format."""
+    format: str
+    output_path: pathlib.Path
+    notes: int = 0
+    seconds: float = 0.0
+    """The time from the first note being read until the writer was done."""
+    waiting: float = 0.0
+    """The part of seconds spent waiting for the reader to pass on notes."""
+    finished: bool = False
+    error: Optional[BaseException] = None
+
+def main(args: Arguments):
+    formats = FORMATS if 'all' in args.format else list(dict.fromkeys(args.format))
+    outputs = output_paths(formats, args)
     section_name = "cleaned_results" if args.section == 'cleaned' else "results"
-    
-    if args.format == 'csv':
-        create_csv(source, section_name, args.output, args)
-    elif args.format == 'xml':
-        create_xml(source, section_name, args.output, args)
-    elif args.format == 'labelstudio':
-        create_labelstudio(source, section_name, args.output, args)
-    elif args.format == 'spacy':
-        create_spacy(source, section_name, args.output, args)
-    elif args.format == 'text':
-        create_text(source, section_name, args.output, args)
+    parsed_notes = None
+    if utilities.corpus.is_corpus(args.input):
+        # A corpus reads the notes of a slice directly, with their tags already parsed
+        corpus = utilities.corpus.CorpusFile(args.input)
+        indices = range(len(corpus))[args.start:args.stop]
+        section = corpus.section(section_name)
+        results = (section[i] for i in indices)
+        if section_name == 'cleaned_results':
+            parsed_notes = (corpus.parsed(i) for i in indices)
     else:
-        raise ValueError(f"Unrecognized format '{args.format}'")
+        # The notes are read one at a time as the writers consume them
+        results = itertools.islice(utilities.stream.iterate_section(args.input, section_name), args.start, args.stop)
+
+    prepare_outputs(outputs, args)
+    started = time.perf_counter()
+    timings = convert(results, outputs, args, parsed_notes)
+    for timing in timings:
+        print(f"{timing.format}: wrote {timing.notes} notes to {timing.output_path} in {timing.seconds:.2f}s "
+              f"({timing.waiting:.2f}s waiting for notes)")
+    print(f"Converted to {len(timings)} formats in {time.perf_counter() - started:.2f}s")
+
+def output_paths(formats: List[str], args: Arguments) -> Dict[str, pathlib.Path]:
+    """output_paths gives the path to write each format to. A single format is written to
+    --output, several are written to the directory --output, named after the input
+    (e.g. training.csv and training.spacy)."""
+    if len(formats) == 1:
+        return {formats[0]: args.output}
+    directory = pathlib.Path(args.output)
+    directory.mkdir(parents=True, exist_ok=True)
+    stem = pathlib.Path(args.input).stem
+    outputs = {f: directory / FORMAT_OUTPUTS[f].format(stem=stem) for f in formats}
+    if 'text' in outputs:
+        outputs['text'].mkdir(exist_ok=True)
+    return outputs
 
-def create_csv(source, section_name, output_path: pathlib.Path, args: Arguments):
+def prepare_outputs(outputs: Dict[str, pathlib.Path], args: Arguments):
+    """prepare_outputs checks that every format in outputs can be written before any note is converted:
+    it loads the spaCy pipeline (which the spacy writer then uses) and creates each output."""
+    for format, path in outputs.items():
+        if format == 'text':
+            pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+        elif format == 'spacy':
+            load_pipeline(args.spacyPipeline)
+            if not args.shards:
+                open(path, 'wb').close()
+        else:
+            open(path, 'w', encoding='utf8').close()
+
+def convert(results: Iterable[str], outputs: Dict[str, pathlib.Path], args: Arguments,
+            parsed_notes: Optional[Iterable[utilities.tags.ParsedNote]] = None) -> List[WriterTiming]:
+    """convert reads and parses each note once (unless parsed_notes gives them parsed), passing it
+    to a writer thread for every format in outputs (see write_chunks)."""
+    parse = any(f in PARSED_FORMATS for f in outputs)
+
+    def chunks() -> Iterable[List[Note]]:
+        parsed_chunks = batched(parsed_notes, NOTE_CHUNK) if parse and parsed_notes is not None else None
+        for chunk in batched(results, NOTE_CHUNK):
+            if parsed_chunks is not None:
+                yield [Note(r, parsed) for r, parsed in zip(chunk, next(parsed_chunks))]
+            else:
+                yield [Note(r, utilities.tags.parse_note(r) if parse else None) for r in chunk]
+
+    return write_chunks(chunks(), outputs, args)
+
+def write_chunks(chunks: Iterable[List[Note]], outputs: Dict[str, pathlib.Path], args: Arguments) -> List[WriterTiming]:
+    """write_chunks passes each chunk of notes to a writer thread for every format in outputs (the notes
+    must be parsed if any of the formats is in PARSED_FORMATS). Each writer has a bounded queue, so a slow
+    writer holds back the reader instead of notes piling up in memory."""
+    timings = [WriterTiming(format=f, output_path=path) for f, path in outputs.items()]
+    queues = [queue.Queue(maxsize=QUEUED_CHUNKS) for _ in timings]
+    writers = [threading.Thread(target=_run_writer, args=(note_queue, timing, args), name=f'convert-{timing.format}')
+               for note_queue, timing in zip(queues, timings)]
+    for writer in writers:
+        writer.start()
+    try:
+        for notes in chunks:
+            for note_queue in queues:
+                note_queue.put(notes)
+    finally:
+        for note_queue in queues:
+            note_queue.put(None)
+        for writer in writers:
+            writer.join()
+
+    for timing in timings:
+        if timing.error is not None:
+            raise RuntimeError(f"Failed to write {timing.format} to {timing.output_path}") from timing.error
+    return timings
+
+def _queued_notes(note_queue: queue.Queue, timing: WriterTiming) -> Iterable[Note]:
+    """_queued_notes yields the notes passed to a writer until the reader is done."""
+    while True:
+        started = time.perf_counter()
+        notes = note_queue.get()
+        timing.waiting += time.perf_counter() - started
+        if notes is None:
+            timing.finished = True
+            return
+        timing.notes += len(notes)
+        yield from notes
+
+def _run_writer(note_queue: queue.Queue, timing: WriterTiming, args: Arguments):
+    started = time.perf_counter()
+    try:
+        WRITERS[timing.format](_queued_notes(note_queue, timing), timing.output_path, args)
+    except BaseException as error:
+        timing.error = error
+    finally:
+        # Keep taking notes from a writer that stopped early, so the reader isn't blocked by it
+        while not timing.finished:
+            timing.finished = note_queue.get() is None
+        timing.seconds = time.perf_counter() - started
+
+def create_csv(notes: Iterable[Note], output_path: pathlib.Path, args: Arguments):
     with open(output_path, 'w', encoding='utf8') as output:
         output.write('source_text,target_text\n')
-        results = source[section_name]
-        for r in results:
-            source_text = utilities.tags.remove_tags(r).replace('\n', ' ')
-            target_text = utilities.tags.redact_tags(r).replace('\n', ' ')
+        for note in notes:
+            source_text = note.parsed.text.replace('\n', ' ')
+            target_text = note.parsed.redacted.replace('\n', ' ')
             output.write(f'"{source_text}","{target_text}"\n')
 
-def create_xml(source, section_name, output_path: pathlib.Path, args: Arguments):
+def create_xml(notes: Iterable[Note], output_path: pathlib.Path, args: Arguments):
     with open(output_path, 'w', encoding='utf8') as output:
         output.write('<?xml version="1.0" encoding="UTF-8"?>')
-        results = source[section_name]
-        for i, r in enumerate(results):
+        for i, note in enumerate(notes):
             output.write(f"<record id='{i}'>")
-            output.write(r)
+            output.write(note.annotated)
             output.write(f"</record>")
 
-def create_labelstudio(source, section_name, output_path: pathlib.Path, args: Arguments):
-    results = source[section_name]
-    tasks = [{'id': i, 'data': {'text': utilities.tags.remove_tags(r), 'original_text': r}, } for i, r in enumerate(results)]
+def create_labelstudio(notes: Iterable[Note], output_path: pathlib.Path, args: Arguments):
     with open(output_path, 'w', encoding='utf8') as output:
-        json.dump(tasks, output)
+        # Write the list of tasks one task at a time
+        output.write('[')
+        for i, note in enumerate(notes):
+            if i > 0:
+                output.write(', ')
+            json.dump({'id': i, 'data': {'text': note.parsed.text, 'original_text': note.annotated}, }, output)
+        output.write(']')
 
-def create_spacy(source, section_name, output_path: pathlib.Path, args: Arguments):
-    results = source[section_name]
-    EXPECTED_TAGS = ['First_Name', 'Last_Name', 'Location', 'Health_Care_Unit', 'Age', 'Phone_Number', 'Social_Security_Number', 'Date', 'PHI']
+# SPACY_TAGS are the tags we keep as entities in spaCy documents
+SPACY_TAGS = ['First_Name', 'Last_Name', 'Location', 'Health_Care_Unit', 'Age', 'Phone_Number', 'Social_Security_Number', 'Date', 'PHI']
 
+def create_spacy(notes: Iterable[Note], output_path: pathlib.Path, args: Arguments):
     import spacy
+    # spaCy documents are made from the notes after fix_orthography, which are parsed separately
+    results = (note.annotated for note in notes)
+    if args.workers > 1 or args.shards:
+        return create_spacy_parallel(results, output_path, args)
+
     doc_bin = spacy.tokens.DocBin()
-    nlp = spacy.load('nb_core_news_sm')
-    for r in results:
-        cleaned = fix_orthography(r)
-        doc_text = utilities.tags.remove_tags(cleaned)
-        annotations = utilities.tags.list_annotations(cleaned, EXPECTED_TAGS)
-        doc = nlp.make_doc(doc_text)
-        ents = [
-            doc.char_span(a[0], a[1], a[2], alignment_mode='expand') for a in annotations
-        ]
-        doc.set_ents(ents)
+    nlp = load_pipeline(args.spacyPipeline)
+    token_cache = None if args.noTokenCache else utilities.tokcache.TokenizationCache()
+    for doc in annotated_docs(nlp, results, args.batchSize, token_cache):
         doc_bin.add(doc)
     doc_bin.to_disk(output_path)
+    if token_cache is not None:
+        print(token_cache.summary())
 
-def create_text(source, section_name, output_path: pathlib.Path, args: Arguments):
-    results = source[section_name]
-    for i, r in enumerate(results):
+def annotated_docs(nlp, notes: Iterable[str], batch_size: int = 256,
+                   token_cache: Optional[utilities.tokcache.TokenizationCache] = None):
+    """annotated_docs tokenizes annotated notes with the tokenizer of a spaCy pipeline
+    (reusing the tokenizations in token_cache, if given), yielding documents with the tags
+    in SPACY_TAGS set as entities."""
+    import spacy
+    for batch in batched(notes, batch_size):
+        parsed_notes = [utilities.tags.parse_note(fix_orthography(r)) for r in batch]
+        texts = (parsed.text for parsed in parsed_notes)
+        if token_cache is not None:
+            docs = token_cache.make_docs(nlp, texts, batch_size=batch_size)
+        else:
+            docs = nlp.tokenizer.pipe(texts, batch_size=batch_size)
+        for parsed, doc in zip(parsed_notes, docs):
+            ents = [
+                doc.char_span(a[0], a[1], a[2], alignment_mode='expand') for a in parsed.spans if a[2] in SPACY_TAGS
+            ]
+            # Nested tags give overlapping spans, of which we keep the longest.
+            # Tags around nothing but whitespace give no span at all.
+            doc.set_ents(spacy.util.filter_spans([e for e in ents if e is not None]))
+            yield doc
+
+def batched(items: Iterable, size: int) -> Iterable[list]:
+    """batched splits items into lists of (at most) size items."""
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+@functools.lru_cache(maxsize=None)
+def load_pipeline(name: str):
+    """load_pipeline loads a spaCy pipeline once."""
+    import spacy
+    return spacy.load(name)
+
+# _worker_nlp and _worker_token_cache are the pipeline and tokenization cache
+# opened in each worker process by _load_pipeline
+_worker_nlp = None
+_worker_token_cache = None
+
+def _load_pipeline(name: str, use_token_cache: bool):
+    global _worker_nlp, _worker_token_cache
+    import spacy
+    _worker_nlp = spacy.load(name)
+    _worker_token_cache = utilities.tokcache.TokenizationCache() if use_token_cache else None
+
+def _convert_batch(notes: List[str], batch_size: int, shard_path: Optional[str]):
+    """_convert_batch runs in a worker process, converting a batch of notes to a DocBin,
+    which is written to shard_path if given and returned as bytes otherwise.
+    Also returns the tokenization cache hits and misses of the batch."""
+    import spacy
+    hits, misses = (_worker_token_cache.hits, _worker_token_cache.misses) if _worker_token_cache else (0, 0)
+    doc_bin = spacy.tokens.DocBin(docs=annotated_docs(_worker_nlp, notes, batch_size, _worker_token_cache))
+    if _worker_token_cache is not None:
+        hits, misses = _worker_token_cache.hits - hits, _worker_token_cache.misses - misses
+    if shard_path is not None:
+        doc_bin.to_disk(shard_path)
+        return len(doc_bin), hits, misses
+    return doc_bin.to_bytes(), hits, misses
+
+def create_spacy_parallel(results: Iterable[str], output_path: pathlib.Path, args: Arguments):
+    """create_spacy_parallel converts batches of notes in a pool of worker processes.
+    With --shards, each batch is written to its own file (e.g. training-000.spacy), listed
+    in a manifest (training.manifest.json), so no process holds more than a batch of documents.
+    Otherwise the batches are merged into a single DocBin at output_path."""
+    import spacy
+    output_path = pathlib.Path(output_path)
+    merged = spacy.tokens.DocBin()
+    shards = []
+    # The tokenization cache hits and misses of all workers
+    token_cache_counts = collections.Counter()
+
+    def collect(future, shard_path):
+        result, hits, misses = future.result()
+        token_cache_counts.update(hits=hits, misses=misses)
+        if shard_path is None:
+            merged.merge(spacy.tokens.DocBin().from_bytes(result))
+        else:
+            shards.append({'path': shard_path.name, 'docs': result})
+
+    # Open the cache once before starting the workers, so they don't race to create it
+    token_cache = None if args.noTokenCache else utilities.tokcache.TokenizationCache()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=_load_pipeline,
+                                                initargs=(args.spacyPipeline, token_cache is not None)) as executor:
+        # Keep a couple of batches per worker in flight, so we never read far ahead of the workers
+        pending = collections.deque()
+        for i, batch in enumerate(batched(results, args.batchSize)):
+            shard_path = output_path.with_name(f'{output_path.stem}-{i:03d}{output_path.suffix}') if args.shards else None
+            pending.append((executor.submit(_convert_batch, batch, args.batchSize, None if shard_path is None else str(shard_path)), shard_path))
+            if len(pending) >= 2 * args.workers:
+                collect(*pending.popleft())
+        while pending:
+            collect(*pending.popleft())
+
+    if args.shards:
+        manifest_path = output_path.with_name(f'{output_path.stem}.manifest.json')
+        with open(manifest_path, 'w', encoding='utf8') as manifest:
+            json.dump({'pipeline': args.spacyPipeline, 'section': args.section,
+                       'docs': sum(s['docs'] for s in shards), 'shards': shards}, manifest, indent=2)
+    else:
+        merged.to_disk(output_path)
+    if token_cache is not None:
+        token_cache.hits, token_cache.misses = token_cache_counts['hits'], token_cache_counts['misses']
+        print(token_cache.summary())
+
+def create_text(notes: Iterable[Note], output_path: pathlib.Path, args: Arguments):
+    for i, note in enumerate(notes):
         target_path = output_path / f"{i}.txt"
         with open(target_path, 'w', encoding='utf8') as target:
-            target.write(utilities.tags.remove_tags(r).replace('\n', ' '))
+            target.write(note.parsed.text.replace('\n', ' '))
+
+WRITERS = {'csv': create_csv, 'xml': create_xml, 'labelstudio': create_labelstudio, 'spacy': create_spacy, 'text': create_text}
 
 
 if __name__ == '__main__':
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+deduplicate.py finds clusters of near-duplicate notes in the results of generate.py, which
+the model writes a lot of at high temperatures for similar scenarios.
+
+Notes are compared by the runs of words (shingles) in their cleaned text with the tags
+removed, with MinHash signatures and LSH banding (see utilities/minhash.py), so that a corpus
+of hundreds of thousands of notes is deduplicated in minutes instead of comparing every pair.
+The first note of each cluster is kept, and the others can be dropped from the results, or
+flagged in a duplicate_of list, before converting them with convert.py.
+"""
+import json
+import logging
+import pathlib
+import time
+from typing import Dict, List, Literal, Tuple
+
+import numpy as np
+from tap import Tap
+
+import utilities.minhash
+import utilities.records
+import utilities.stream
+import utilities.tags
+
+class Arguments(Tap):
+    results: pathlib.Path = 'results.json'
+    """The results (or --checkpoint record file) of generate.py to deduplicate"""
+    threshold: float = 0.8
+    """The (estimated) Jaccard similarity of the shingles of two notes from which they are near-duplicates"""
+    shingleSize: int = 3
+    """The number of words in each shingle"""
+    numPerm: int = 128
+    """The number of hash functions in each MinHash signature"""
+    bands: int = None
+    """The number of LSH bands, of --numPerm / --bands values each (by default chosen for --threshold)"""
+    redactTags: bool = False
+    """Compare the notes with each tagged value replaced by its label, so notes that only differ in the patient details are near-duplicates"""
+    action: Literal['report', 'flag', 'drop'] = 'report'
+    """Whether to only report the clusters, or to also write the results to --output with a duplicate_of list, or without the duplicates"""
+    output: pathlib.Path = None
+    """The JSON file to write the flagged or deduplicated results to"""
+    report: pathlib.Path = None
+    """A JSON file to write the clusters to"""
+    seed: int = 1
+    """The seed for the hash functions"""
+    verbose: bool = False
+    """Whether to output debugging information"""
+
+def note_texts(args: Arguments):
+    """note_texts yields the text each note is compared by."""
+    for note in utilities.stream.iterate_section(args.results, 'cleaned_results'):
+        parsed = utilities.tags.parse_note(note or '')
+        yield parsed.redacted if args.redactTags else parsed.text
+
+def find_duplicates(args: Arguments) -> Tuple[np.ndarray, np.ndarray]:
+    """find_duplicates gives the index of the note each note is a near-duplicate of (the first of its cluster),
+    which is its own index for the notes that are kept, and the signatures of the notes."""
+    started = time.perf_counter()
+    hasher = utilities.minhash.MinHasher(args.numPerm, args.shingleSize, args.seed)
+    signatures = np.concatenate(list(hasher.signatures(note_texts(args))) or [np.empty((0, args.numPerm), np.uint32)])
+    logging.info(f"Computed the signatures of {len(signatures)} notes in {time.perf_counter() - started:.1f}s")
+
+    if args.bands is None:
+        bands, rows = utilities.minhash.optimal_bands(args.threshold, args.numPerm)
+    else:
+        bands, rows = args.bands, args.numPerm // args.bands
+    started = time.perf_counter()
+    first, second = utilities.minhash.candidate_pairs(signatures, bands, rows)
+    similar = utilities.minhash.similarities(signatures, first, second) >= args.threshold
+    labels = utilities.minhash.connected_components(len(signatures), first[similar], second[similar])
+    logging.info(f"Found {len(first)} candidate pairs with {bands} bands of {rows} rows, {similar.sum()} of them similar, "
+                 f"in {time.perf_counter() - started:.1f}s")
+    return labels, signatures
+
+def clusters(duplicate_of: np.ndarray, signatures: np.ndarray) -> List[dict]:
+    """clusters lists the note kept and its near-duplicates for each cluster, largest first,
+    with the estimated similarity of each duplicate to the note kept."""
+    duplicates = np.flatnonzero(duplicate_of != np.arange(len(duplicate_of)))
+    kept = duplicate_of[duplicates]
+    similarity = utilities.minhash.similarities(signatures, duplicates, kept)
+    members: Dict[int, List[int]] = {}
+    for duplicate, original in zip(duplicates.tolist(), kept.tolist()):
+        members.setdefault(original, []).append(duplicate)
+    similarity_of = dict(zip(duplicates.tolist(), similarity.tolist()))
+    return sorted(({'kept': original, 'duplicates': found, 'similarity': [round(similarity_of[i], 3) for i in found]}
+                   for original, found in members.items()), key=lambda cluster: (-len(cluster['duplicates']), cluster['kept']))
+
+def write_results(args: Arguments, duplicate_of: np.ndarray):
+    """write_results copies the results to args.output, one section at a time, without the near-duplicates
+    (--action drop) or with the index of the note each note duplicates, or null, in a duplicate_of list (--action flag)."""
+    kept = duplicate_of == np.arange(len(duplicate_of))
+    sections = list(utilities.records.SECTIONS)
+    with open(args.output, 'w', encoding='utf8') as output:
+        output.write('{"parameters": ')
+        json.dump(utilities.stream.read_parameters(args.results), output)
+        for section in sections:
+            output.write(f', "{section}": [')
+            written = 0
+            elements = utilities.stream.iterate_optional_section(args.results, section)
+            for index, element in zip(range(len(duplicate_of)), elements):
+                if args.action == 'drop' and not kept[index]:
+                    continue
+                if written > 0:
+                    output.write(', ')
+                json.dump(element, output)
+                written += 1
+            output.write(']')
+        if args.action == 'flag':
+            output.write(', "duplicate_of": ')
+            json.dump([None if is_kept else original for is_kept, original in zip(kept.tolist(), duplicate_of.tolist())], output)
+        output.write('}')
+
+def main(args: Arguments):
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    if args.action != 'report' and args.output is None:
+        raise ValueError(f"--action {args.action} needs an --output to write the results to")
+    if args.bands is not None and not 0 < args.bands <= args.numPerm:
+        raise ValueError("--bands must be between 1 and --numPerm")
+
+    duplicate_of, signatures = find_duplicates(args)
+    found = clusters(duplicate_of, signatures)
+    duplicates = sum(len(cluster['duplicates']) for cluster in found)
+    logging.info(f"{duplicates} of {len(duplicate_of)} notes are near-duplicates, in {len(found)} clusters")
+    for cluster in found[:10]:
+        print(f"Note {cluster['kept']:7d}: {len(cluster['duplicates'])} near-duplicates, e.g. {cluster['duplicates'][:5]}")
+
+    if args.report is not None:
+        report = {'notes': len(duplicate_of), 'threshold': args.threshold, 'shingle_size': args.shingleSize,
+                  'num_perm': args.numPerm, 'redact_tags': args.redactTags, 'duplicates': duplicates, 'clusters': found}
+        with open(args.report, 'w', encoding='utf8') as report_file:
+            json.dump(report, report_file, indent=2)
+    if args.action != 'report':
+        write_results(args, duplicate_of)
+        logging.info(f"Wrote results to {args.output}")
+
+if __name__ == '__main__':
+    args = Arguments()
+    args.parse_args()
+    main(args)
@@ -2,64 +2,164 @@
 """
 filter-icd10.py tries to finds a subset of ICD-10 codes that are applicable as
 principal/primary diagnosis codes.
+
+The codes to exclude are described by the rules in --rules, for each variant of the code
+list (e.g. 'en' for the codes and names of ICD-10-CM, 'nb' for the Norwegian names in
+nb_diagnoses_full_icd10.csv). A rule excludes the codes starting with any of its
+code_prefixes, or whose name contains any of its keywords or matches any of its (regex)
+patterns, ignoring case. The rules of a variant are compiled into a single regular
+expression, so each line that is kept is matched once. The lines it excludes are counted
+under the first rule that excludes them, in the order of the rules.
 """
+import functools
+import json
+import logging
+import multiprocessing
 import pathlib
-from typing import Literal
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
 from tap import Tap
-import logging
+
+# EXAMPLES is the number of excluded names to list for each rule in the report
+EXAMPLES = 5
 
 class Arguments(Tap):
     input: pathlib.Path = 'vocabularies/icd10cm-codes-April-1-2023.txt'
     """The path to the full list of ICD-10 diagnosis codes."""
     output: pathlib.Path = 'vocabularies/en_diagnoses.csv'
     """The filename or directory to write the subset of diagnosis codes to."""
+    rules: pathlib.Path = 'vocabularies/icd10-rules.json'
+    """The JSON file with the rules for each variant of the code list"""
+    locale: str = 'en'
+    """The variant of the rules to use (e.g. 'en' for ICD-10-CM, 'nb' for nb_diagnoses_full_icd10.csv)"""
+    report: pathlib.Path = None
+    """A JSON file to write the number of codes each rule excluded to, with examples"""
+    processes: int = None
+    """The number of processes to filter with (by default one per CPU)"""
+    chunkSize: int = 20000
+    """The number of lines each process filters at a time"""
     verbose: bool = False
     """Whether to output debugging information"""
 
-def include(code: str, name: str) -> bool:
-    logging.debug(f"Checking {code=}, {name=}")
-    
-    # We exclude mental and behavioral disorder codes,
-    # and codes which are primarily secondary:
-    if code[0] in ['F', 'Z', 'Y', 'U']:
-        return False
-    
-    name_lowered = name.lower()
-    if 'personal history of' in name_lowered:
-        return False
-    
-    if 'status' in name_lowered:
-        return False
-    
-    if 'unspecified' in name_lowered:
-        return False
-    
-    if 'other' in name_lowered:
-        return False
-    
-    return True
+def compile_rules(rules: List[dict]) -> Tuple[re.Pattern, List[re.Pattern]]:
+    """compile_rules builds one regular expression that matches the line '<code>\t<name>' if any of the rules
+    excludes it, and one for each rule, which tell the lines that match the first apart by the rule that
+    excludes them (the first in order, as a named group of the combined expression may belong to a later
+    rule, e.g. one whose keyword comes first in the name). Lines without a code have an empty one."""
+    code_patterns = []
+    name_patterns = []
+    rule_patterns = []
+    for i, rule in enumerate(rules):
+        unknown = set(rule) - {'name', 'description', 'code_prefixes', 'keywords', 'patterns'}
+        if unknown:
+            raise ValueError(f"Rule '{rule.get('name', i)}' has unknown fields: {', '.join(sorted(unknown))}")
+        alternatives = []
+        if rule.get('code_prefixes'):
+            code_pattern = '|'.join(re.escape(p) for p in rule['code_prefixes'])
+            code_patterns.append(code_pattern)
+            alternatives.append(f"^(?:{code_pattern})")
+        name_alternatives = [re.escape(k) for k in rule.get('keywords', [])] + [f'(?:{p})' for p in rule.get('patterns', [])]
+        if name_alternatives:
+            name_pattern = '|'.join(name_alternatives)
+            name_patterns.append(name_pattern)
+            alternatives.append(f"\t.*?(?:{name_pattern})")
+        rule_patterns.append(re.compile('|'.join(alternatives) or r'(?!)', re.IGNORECASE))
+    alternatives = []
+    if code_patterns:
+        alternatives.append(f"^(?:{'|'.join(code_patterns)})")
+    if name_patterns:
+        alternatives.append(f"\t.*?(?:{'|'.join(name_patterns)})")
+    return re.compile('|'.join(alternatives) or r'(?!)', re.IGNORECASE), rule_patterns
+
+def parse_line(line: str, line_format: str) -> Optional[Tuple[str, str]]:
+    """parse_line reads the code and name of a line of the code list (the code is empty for lists of names)."""
+    line = line.strip()
+    if not line:
+        return None
+    if line_format == 'name':
+        return '', line
+    code, _, name = line.partition(' ')
+    return code, name.strip()
+
+def clean(name: str, truncate_at: Optional[str]) -> str:
+    return name.split(truncate_at, maxsplit=1)[0].strip() if truncate_at else name
 
-def clean(name: str) -> str:
-    return name.split(',', maxsplit=1)[0]
+def filter_chunk(lines: List[str], variant: dict) -> Tuple[List[str], Dict[int, int], Dict[int, List[str]]]:
+    """filter_chunk gives the cleaned entries the rules keep, and the number of lines each rule excluded, with examples."""
+    matcher, rule_matchers = _matcher(json.dumps(variant['rules']))
+    kept = []
+    hits: Dict[int, int] = {}
+    examples: Dict[int, List[str]] = {}
+    for line in lines:
+        parsed = parse_line(line, variant['format'])
+        if parsed is None:
+            continue
+        code, name = parsed
+        line = f'{code}\t{name}'
+        if matcher.search(line) is None:
+            cleaned = clean(name, variant.get('truncate_at'))
+            kept.append(f'{code} {cleaned}' if code else cleaned)
+            continue
+        # Most lines are kept, so the rule that excludes a line is only looked for once it is excluded
+        rule = next(i for i, rule_matcher in enumerate(rule_matchers) if rule_matcher.search(line))
+        hits[rule] = hits.get(rule, 0) + 1
+        if len(examples.setdefault(rule, [])) < EXAMPLES:
+            examples[rule].append(f'{code} {name}' if code else name)
+    return kept, hits, examples
+
+@functools.lru_cache(maxsize=None)
+def _matcher(rules: str) -> Tuple[re.Pattern, List[re.Pattern]]:
+    """_matcher compiles the rules (as JSON) once in each process."""
+    return compile_rules(json.loads(rules))
+
+def chunks(path: pathlib.Path, size: int) -> Iterator[List[str]]:
+    with open(path, 'r', encoding='utf-8') as code_file:
+        while True:
+            chunk = [line for _, line in zip(range(size), code_file)]
+            if not chunk:
+                return
+            yield chunk
 
 def main(args: Arguments):
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
+    with open(args.rules, 'r', encoding='utf-8') as rules_file:
+        variants = json.load(rules_file)
+    if args.locale not in variants:
+        raise ValueError(f"{args.rules} has no rules for '{args.locale}', only for {', '.join(variants)}")
+    variant = variants[args.locale]
+    rules = variant['rules']
+    # Compiling the rules here reports mistakes in them before any process starts
+    compile_rules(rules)
+
     diagnoses = set()
-    with open(args.input, 'r') as code_file:
-        for line in code_file:
-            split_line = line.split(' ', maxsplit=1)
-            code, name = split_line[0], split_line[1].strip()
-            if include(code, name):
-                logging.debug(f"Cleaning {name=}")
-                cleaned_name = clean(name)
-                logging.debug(f"Adding {cleaned_name=}")
-                diagnoses.add(code + " " + cleaned_name + '\n')
-            else:
-                logging.debug(f"Excluded {name=}")
+    hits = [0] * len(rules)
+    examples: List[List[str]] = [[] for _ in rules]
+    total = 0
+    work = functools.partial(filter_chunk, variant=variant)
+    with multiprocessing.Pool(args.processes) as pool:
+        # imap keeps the chunks in order, so the examples are the first lines each rule excluded
+        for kept, chunk_hits, chunk_examples in pool.imap(work, chunks(args.input, args.chunkSize)):
+            diagnoses.update(kept)
+            total += len(kept) + sum(chunk_hits.values())
+            for rule, count in chunk_hits.items():
+                hits[rule] += count
+                examples[rule] += chunk_examples[rule][:EXAMPLES - len(examples[rule])]
+
+    logging.info(f"Kept {len(diagnoses)} of {total} codes")
+    for rule, count, rule_examples in zip(rules, hits, examples):
+        logging.info(f"Rule '{rule['name']}' excluded {count} codes, e.g. {rule_examples[:3]}")
+
+    output_path = args.output / f'{args.locale}_diagnoses.csv' if args.output.is_dir() else args.output
+    with open(output_path, 'w', encoding='utf-8') as output_file:
+        output_file.writelines(diagnosis + '\n' for diagnosis in sorted(diagnoses))
 
-    with open(args.output, 'w', encoding='utf-8') as output_file:
-        output_file.writelines(list(diagnoses))
+    if args.report is not None:
+        report = {'input': str(args.input), 'locale': args.locale, 'lines': total, 'kept': len(diagnoses),
+                  'rules': [{'name': rule['name'], 'excluded': count, 'examples': rule_examples}
+                            for rule, count, rule_examples in zip(rules, hits, examples)]}
+        with open(args.report, 'w', encoding='utf-8') as report_file:
+            json.dump(report, report_file, indent=2, ensure_ascii=False)
 
 if __name__ == '__main__':
     args = Arguments()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+generate-client.py generates notes like generate.py, with the same arguments, but has the
+service started by serve.py do the work, so the vocabularies, cache and connections to the
+model endpoint are already warm. The results and metrics are written next to --output as
+generate.py writes them (the metrics as JSON only).
+"""
+import http.client
+import json
+import logging
+import os
+import socket
+import time
+import urllib.parse
+
+import generate
+
+class Arguments(generate.Arguments):
+    service: str = 'http://localhost:8100'
+    """The URL of the generation service (see serve.py)"""
+    socket: str = None
+    """The Unix socket of the generation service, instead of --service"""
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """UnixHTTPConnection sends HTTP requests over a Unix socket."""
+    def __init__(self, path: str, timeout: float = None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def request(args: Arguments, endpoint: str, body: dict) -> dict:
+    """request posts a request to an endpoint of the service, giving its answer.
+    Raises a ValueError if the service rejects it."""
+    if args.socket is not None:
+        connection, prefix = UnixHTTPConnection(args.socket), ''
+    else:
+        url = urllib.parse.urlsplit(args.service)
+        connection, prefix = http.client.HTTPConnection(url.hostname, url.port or 80), url.path.rstrip('/')
+    try:
+        connection.request('POST', f'{prefix}/{endpoint}', json.dumps(body).encode('utf8'),
+                           {'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        answer = json.loads(response.read())
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise ValueError(f"The service could not {endpoint} ({response.status}): {answer.get('error')}")
+    return answer
+
+
+def main(args: Arguments):
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    generate.validate_arguments(args)
+
+    # The service uses its own endpoint and key
+    parameters = {name: value for name, value in generate.public_parameters(args).items()
+                  if name not in ('service', 'socket', 'openAIKey', 'apiBase')}
+    started = time.perf_counter()
+    results = request(args, 'generate', {'parameters': parameters})
+    logging.info(f"The service generated {len(results['results'])} notes in {time.perf_counter() - started:.1f}s")
+
+    metrics = results.pop('metrics')
+    with open(args.output, 'w', encoding='utf8') as result_file:
+        json.dump(results, result_file)
+    if not args.noMetrics:
+        with open(f'{os.path.splitext(args.output)[0]}.metrics.json', 'w', encoding='utf8') as metrics_file:
+            json.dump(metrics, metrics_file, indent=2)
+
+
+if __name__ == '__main__':
+    args = Arguments()
+    args.parse_args()
+    main(args)
@@ -4,25 +4,36 @@ generate.py
 
 Call OpenAI's chat completion to generate synthetic discharge summaries in English and Norwegian with annotated PHI
 """
-import csv
+import asyncio
 import json
 import os
 import logging
+import math
 import pathlib
+import queue
 import random
+import re
 import datetime
+import threading
+import time
 
 import dataclasses
-from typing import List, Literal, Tuple
-import joblib
+from typing import Callable, Dict, Iterator, List, Literal, Optional, Sequence, Tuple
 
 from tap import Tap
-from joblib import Memory
-import openai
 
+import utilities.batch
+import utilities.cache
+import utilities.completion
+import utilities.metrics
+import utilities.records
+import utilities.seeding
+from utilities.scenarios import Scenario, BIRTH_DATES, ADMISSION_DATES, DATE_FORMAT
 import utilities.tags
+import utilities.vocabulary
 
 CACHE_DIRECTORY = '.cache'
+CACHE_PATH = os.path.join(CACHE_DIRECTORY, 'completions.sqlite')
 OPENAI_PLACEHOLDER = 'OPENAI-KEY-HERE'
 SYSTEM_PROMPT = """
 Answer in the form of an annotated discharge note from a specialist. Include details about each finding.
@@ -44,7 +55,7 @@ class Arguments(Tap):
     remove_titles: bool = False
     """Apply heuristic to remove trivial cases (title followed by PHI)"""
     seed: int = 42
-    """The seed for the random generator (note: must set --n the same to get same prompts)"""
+    """The seed for the random generator (note: must set --n the same to get same prompts, unless using --seeding per-record)"""
     verbose: bool = False
     """Whether to output debugging information"""
     output: str = 'results.json'
@@ -57,39 +68,86 @@ class Arguments(Tap):
     """The upper bound on tokens to output for each document"""
     withReplacement: bool = False
     """Whether we sample with replacement for the larger sets (names, cities)"""
+    concurrency: int = 8
+    """The maximum number of completion requests in flight at the same time"""
+    requestsPerMinute: float = None
+    """The budget of completion requests per minute (unlimited if not set)"""
+    tokensPerMinute: float = None
+    """The budget of prompt and completion tokens per minute (unlimited if not set)"""
+    maxRetries: int = 6
+    """How many times to retry a request that was rate limited or failed transiently"""
+    apiBase: str = None
+    """The base URL of an OpenAI-compatible API to use instead of OpenAI (e.g. utilities/stub_server.py)"""
+    checkpoint: str = None
+    """A JSONL file to append each note to as it is completed (compacted to --output at the end)"""
+    resume: bool = False
+    """Continue the run in --checkpoint, skipping the notes it already contains"""
+    vocabularyIndex: bool = False
+    """Keep a memory-mapped index next to each vocabulary file to load it faster next time"""
+    backend: Literal['random', 'numpy'] = 'random'
+    """How to draw scenarios: one value at a time, or in batches with NumPy (faster for large --n, but draws different scenarios for the same seed)"""
+    seeding: Literal['sequential', 'per-record'] = 'sequential'
+    """Draw all records from one random sequence, or each record from its own (the same for a given seed and index, whatever --n is)"""
+    shardIndex: int = 0
+    """Which of --shardCount equal slices of the --n records to create (requires --seeding per-record)"""
+    shardCount: int = 1
+    """How many slices to divide the --n records into (see merge-shards.py)"""
+    start: int = 0
+    """The index of the first record to create, if not using --shardCount (requires --seeding per-record)"""
+    end: int = None
+    """The index after the last record to create, if not using --shardCount (defaults to --n)"""
+    noMetrics: bool = False
+    """Don't write the metrics of the run next to --output (as <output>.metrics.json and <output>.prom)"""
+    profile: Literal['cprofile', 'tracemalloc'] = None
+    """Profile the run, writing the statistics next to --output (<output>.prof or <output>.tracemalloc.txt)"""
+    batch: Literal['write', 'ingest'] = None
+    """Complete the prompts with the batch API: write the requests to --batchRequests, or read the completed batch from --batchResults and write --output"""
+    batchRequests: str = 'batch-requests.jsonl'
+    """The batch request JSONL to write (or to check the prompts against when ingesting, if it exists)"""
+    batchResults: List[str] = []
+    """The batch result JSONL files to ingest (e.g. the output and error files of the batch)"""
+    notesPerRequest: int = 1
+    """How many notes to ask for in each completion request (notes that can't be told apart in the answer are requested again one at a time)"""
+    maxContinuations: int = 2
+    """How many times to ask the model to continue a note that was cut off at the token limit"""
+    adaptiveMaxTokens: bool = False
+    """Ask for fewer tokens than --max_tokens, learned from the lengths of earlier notes of the same type and language (notes that are cut off are continued)"""
+    convert: List[Literal['csv', 'xml', 'labelstudio', 'spacy', 'text', 'all']] = []
+    """The formats to convert the notes to as they are completed, like convert.py does ('all' for every format)"""
+    convertOutput: str = None
+    """The filename (with one --convert format) or directory to write the converted notes to (by default next to --output, named after it)"""
+    spacyPipeline: str = 'nb_core_news_sm'
+    """The spaCy pipeline to tokenize notes with when converting to spacy"""
+    pipelineWorkers: int = 2
+    """The number of threads cleaning (and parsing) the notes as they are completed"""
 
-@dataclasses.dataclass
-class Scenario:
-    """Scenario contains the parameters used to prompt the language model for a generated note."""
-    locale: str
-    """The intended language of the generated note, as a two-letter code ('nb' for Norwegian, 'en' for American English)"""
-    noteType: str
-    """The note type (e.g. 'discharge summary')"""
-    translatedNoteType: str
-    """The note type translated to the intended language (e.g. 'epikrise')"""
-    givenName: str
-    """The given/first name of the patient."""
-    familyName: str
-    """The family/surname of the patient."""
-    age: int
-    """The age of the patient."""
-    phoneNumber: str
-    """The patient's phone number."""
-    city: str
-    """The patient's city of residence."""
-    healthCareUnit: str
-    """The institution where the patient has been admitted."""
-    diagnosis: str
-    """The diagnosis or primary symptoms the patient has been admitted with (as a partial sentence, e.g. [admitted with] 'generalized abdominal pain')"""
-    birthDate: str
-    """The date the patient was born."""
-    admissionDate: str
-    """The date the patient was admitted."""
-    socialSecurityNumber: str
-    """A unique identifier for the patient (the US Social Security Number for English, the fødsels/personnummer for Norwegian)"""
-    findings: list[str]
-    """Clinical observations to include"""
+# RESUMABLE_PARAMETERS must match between a checkpoint and the run resuming it
+RESUMABLE_PARAMETERS = ['n', 'seed', 'locale', 'split', 'withReplacement', 'model', 'max_tokens', 'temperature', 'topP',
+                        'backend', 'seeding', 'shardIndex', 'shardCount', 'start', 'end']
 
+# NOTE_MARKER starts each note in the answer to a prompt asking for several notes
+NOTE_MARKER = '===NOTE {}==='
+# _NOTE_MARKER matches the markers, allowing for the spacing and markdown models tend to add around them
+_NOTE_MARKER = re.compile(r'^[#*_\s]*=+\s*NOTE\s*(\d+)\s*=+[*_\s]*$', re.IGNORECASE | re.MULTILINE)
+# CONTINUE_PROMPT asks the model to go on with a note that was cut off at the token limit
+CONTINUE_PROMPT = "Continue the note exactly where it stopped, without repeating any of it."
+# With --adaptiveMaxTokens, a request asks for LENGTH_MARGIN times the LENGTH_QUANTILE of the lengths
+# of earlier notes of the same kind, once LENGTH_SAMPLES of them have been recorded
+LENGTH_QUANTILE = 0.95
+LENGTH_MARGIN = 1.2
+LENGTH_SAMPLES = 20
+# A continuation must repeat at least STITCH_MIN_OVERLAP characters of the note (and at most
+# STITCH_WINDOW) for the repetition to be removed
+STITCH_MIN_OVERLAP = 8
+STITCH_WINDOW = 400
+# _NOTE_KIND matches the request for each note in a prompt from format_scenario or format_packed
+_NOTE_KIND = re.compile(r'^Write an? (.+?) in (\w+) for a patient named', re.MULTILINE)
+# PIPELINE_QUEUE is the number of completed notes that may wait to be cleaned, and of cleaned notes that may
+# wait to be written, before the stage before them waits
+PIPELINE_QUEUE = 256
+# _TAG_FRAGMENT matches a tag cut off at the end of a text, and _OPEN_TAG a tag left open at the end
+_TAG_FRAGMENT = re.compile(r'</?\w*$')
+_OPEN_TAG = re.compile(r'<(\w+)>[^<]*$')
 
 def main(args: Arguments):
     if args.verbose:
@@ -97,7 +155,7 @@ def main(args: Arguments):
         logging.debug(f"Running with arguments {args}")
 
     random.seed(args.seed)
-    if args.openAIKey == OPENAI_PLACEHOLDER and os.getenv('OPENAI_API_KEY') is None:
+    if args.batch is None and args.openAIKey == OPENAI_PLACEHOLDER and os.getenv('OPENAI_API_KEY') is None:
         logging.warning(
             "Could not find OpenAI API key, running in dry-run mode.")
         args.dryRun = True
@@ -105,132 +163,543 @@ def main(args: Arguments):
     if args.dryRun:
         logging.warning(
             "In dry-run mode, will not send any queries to OpenAI.")
-    
-    
-    logging.info(f"Creating {args.n} test cases.")
-    scenarios = create_scenarios(args.n, args.locale, args.split)
+    validate_arguments(args)
+
+    metrics = utilities.metrics.Metrics('generate')
+    output_stem = os.path.splitext(args.output)[0]
+    try:
+        with utilities.metrics.profiled(args.profile, output_stem):
+            run(args, metrics)
+    finally:
+        if not args.noMetrics:
+            metrics.write_json(f'{output_stem}.metrics.json')
+            metrics.write_prometheus(f'{output_stem}.prom', labels={'model': args.model, 'locale': args.locale, 'output': args.output})
+            logging.info(f"Wrote metrics to {output_stem}.metrics.json and {output_stem}.prom")
+
+
+def run(args: Arguments, metrics: utilities.metrics.Metrics, cache: utilities.cache.CompletionCache = None):
+    """run creates the scenarios, completes them and writes the results, recording metrics as it goes.
+    The completions are kept in the given cache (by default the one at CACHE_PATH)."""
+    store = utilities.vocabulary.load_store(args.split, persist_index=args.vocabularyIndex)
+    scenarios = create_run_scenarios(args, store, metrics)
+
+    cache = cache or utilities.cache.CompletionCache(CACHE_PATH)
+    if args.batch == 'write':
+        write_batch(scenarios, cache, args, metrics)
+        return
+    if args.batch == 'ingest':
+        prompts = ingest_batch(scenarios, cache, args, metrics)
+        write_results(scenarios, prompts, [cache.get(completion_key(prompt, args)) for prompt in prompts],
+                      [is_truncated(prompt, cache, args) for prompt in prompts], args, metrics)
+        cache.save_counters()
+        return
+
+    if args.checkpoint is not None:
+        complete_to_checkpoint(scenarios, cache, args, metrics)
+        logging.info(f"Compacting {args.checkpoint} to {args.output}")
+        with metrics.timer('write_output'):
+            utilities.records.compact(args.checkpoint, args.output, parameters=public_parameters(args))
+        return
+
+    if args.notesPerRequest > 1:
+        prompts, completed_notes = complete_scenarios(scenarios, cache, args, metrics)
+        cleaned_notes, conversion_error = None, None
+    else:
+        prompts, completed_notes, cleaned_notes, conversion_error = complete_pipelined(scenarios, cache, args, metrics)
+    write_results(scenarios, prompts, completed_notes, [is_truncated(prompt, cache, args) for prompt in prompts], args, metrics,
+                  cleaned_notes)
+    if conversion_error is not None:
+        raise RuntimeError(f"Wrote the results to {args.output}, but could not convert them "
+                           f"(convert them with convert.py instead)") from conversion_error
+
+
+def validate_arguments(args: Arguments):
+    """validate_arguments raises a ValueError for combinations of arguments a run can't be made with."""
+    if args.notesPerRequest < 1:
+        raise ValueError(f"--notesPerRequest must be at least 1, got {args.notesPerRequest}")
+    if args.notesPerRequest > 1 and args.batch is not None:
+        raise ValueError("--batch sends one note per request, it can't be combined with --notesPerRequest")
+    if args.convert and (args.batch is not None or args.checkpoint is not None or args.notesPerRequest > 1):
+        raise ValueError("--convert converts the notes as they are completed one at a time, it can't be combined with "
+                         "--batch, --checkpoint or --notesPerRequest (use convert.py on the results instead)")
+    if args.pipelineWorkers < 1:
+        raise ValueError(f"--pipelineWorkers must be at least 1, got {args.pipelineWorkers}")
+
+
+def create_run_scenarios(args: Arguments, store: utilities.vocabulary.VocabularyStore,
+                         metrics: utilities.metrics.Metrics) -> Sequence[Scenario]:
+    """create_run_scenarios creates the scenarios of the records the arguments ask for, drawing sequential
+    scenarios from the global random generator."""
+    with metrics.timer('create_scenarios'):
+        if args.seeding == 'per-record':
+            indices = record_range(args)
+            logging.info(f"Creating test cases {indices.start} to {indices.stop - 1} of {args.n}.")
+            return create_record_scenarios(indices, args.locale, store, args.seed, args.withReplacement, args.backend)
+        if record_range(args) != range(args.n):
+            raise ValueError("Creating a subset of the records requires --seeding per-record")
+        logging.info(f"Creating {args.n} test cases.")
+        return create_scenarios(args.n, args.locale, args.split, store, args.withReplacement, args.backend)
 
+
+def complete_scenarios(scenarios: Sequence[Scenario], cache: utilities.cache.CompletionCache, args: Arguments,
+                       metrics: utilities.metrics.Metrics,
+                       limiters: Tuple[utilities.completion.RateLimiter, utilities.completion.RateLimiter] = None
+                       ) -> Tuple[List[str], List[str]]:
+    """complete_scenarios formats the scenarios as prompts and completes them (within the budgets of the
+    given limiters, if any, see create_engine), giving the prompts and the notes."""
     logging.info("Formatting test cases as prompts.")
-    prompts = [format_scenario(scenario) for scenario in scenarios]
+    with metrics.timer('format_scenario', calls=len(scenarios)):
+        prompts = [format_scenario(scenario) for scenario in scenarios]
 
     logging.info("Sending prompts to completion.")
-    memory = Memory(CACHE_DIRECTORY, verbose=0)
-    completed_notes = [complete_note(prompt, memory, args) for prompt in prompts]
+    if args.notesPerRequest > 1:
+        with metrics.timer('complete'):
+            completed_notes = complete_packed(scenarios, prompts, cache, args, metrics, limiters)
+    else:
+        engine = create_engine(cache, args, metrics, limiters=limiters)
+        with metrics.timer('complete'):
+            completed_notes = engine.complete_all(prompts)
+        record_completion_metrics(metrics, engine, cache)
+    return prompts, completed_notes
 
-    cleaned_notes = [clean_answer(note) for note in completed_notes]
-    
+
+def complete_pipelined(scenarios: Sequence[Scenario], cache: utilities.cache.CompletionCache, args: Arguments,
+                       metrics: utilities.metrics.Metrics) -> Tuple[List[str], List[str], List[str], Optional[BaseException]]:
+    """complete_pipelined completes the scenarios one note at a time, passing each note on as soon as it is
+    completed to args.pipelineWorkers threads that clean it (and parse its tags for args.convert), and from
+    them, in the order of the scenarios, to the writers of convert.py, while other notes are still being
+    completed. The queues between the stages are bounded, so a slow stage holds back the one before it.
+    The outputs of convert.py are prepared before any request is sent, so mistakes in them fail early.
+    Gives the prompts, the notes, the cleaned notes and the error that stopped the conversion, if any
+    (the notes are still completed and cleaned)."""
+    import convert
+    formats, convert_args, outputs = conversion_outputs(args)
+    if formats:
+        convert.prepare_outputs(outputs, convert_args)
+    parse = any(f in convert.PARSED_FORMATS for f in formats)
+    prompts: List[Optional[str]] = [None] * len(scenarios)
+    notes: List[Optional[str]] = [None] * len(scenarios)
+    cleaned_notes: List[Optional[str]] = [None] * len(scenarios)
+    completed = queue.Queue(maxsize=PIPELINE_QUEUE)
+    cleaned = queue.Queue(maxsize=PIPELINE_QUEUE)
+    errors = []
+    conversion_errors = []
+
+    def clean_notes():
+        try:
+            while (item := completed.get()) is not None:
+                index, note = item
+                with metrics.timer('clean_answer'):
+                    cleaned_note = clean_answer(note)
+                parsed = None
+                if parse:
+                    with metrics.timer('parse_note'):
+                        parsed = utilities.tags.parse_note(cleaned_note)
+                    if parsed.diagnostics:
+                        metrics.count('notes_with_tag_problems')
+                cleaned.put((index, cleaned_note, parsed))
+        except BaseException as error:
+            errors.append(error)
+            # Keep taking notes, so the completions aren't blocked by a worker that failed
+            while completed.get() is not None:
+                pass
+        finally:
+            cleaned.put(None)
+
+    def in_order() -> Iterator[Tuple[int, str, Optional[utilities.tags.ParsedNote]]]:
+        waiting = {}
+        next_index = 0
+        finished = 0
+        while finished < args.pipelineWorkers:
+            item = cleaned.get()
+            if item is None:
+                finished += 1
+                continue
+            waiting[item[0]] = item
+            while next_index in waiting:
+                yield waiting.pop(next_index)
+                next_index += 1
+
+    # The notes are taken in order from the workers by this one iterator, which counts their sentinels
+    ordered = in_order()
+
+    def chunks():
+        for chunk in convert.batched(ordered, convert.NOTE_CHUNK):
+            for index, cleaned_note, _ in chunk:
+                cleaned_notes[index] = cleaned_note
+            yield [convert.Note(cleaned_note, parsed) for _, cleaned_note, parsed in chunk]
+
+    def write_notes():
+        try:
+            if formats:
+                for timing in convert.write_chunks(chunks(), outputs, convert_args):
+                    logging.info(f"Wrote {timing.notes} notes as {timing.format} to {timing.output_path}")
+        except BaseException as error:
+            conversion_errors.append(error)
+        finally:
+            # Keep taking the notes that are left (all of them without args.convert, or those after
+            # a writer failed), so the workers aren't blocked
+            for index, cleaned_note, _ in ordered:
+                cleaned_notes[index] = cleaned_note
+
+    def pending():
+        for i, scenario in enumerate(scenarios):
+            with metrics.timer('format_scenario'):
+                prompts[i] = format_scenario(scenario)
+            yield i, prompts[i]
+
+    async def complete(engine: utilities.completion.CompletionEngine):
+        async for index, note in engine.stream(pending()):
+            notes[index] = note
+            try:
+                completed.put_nowait((index, note))
+            except queue.Full:
+                metrics.count('pipeline_stalls')
+                await asyncio.to_thread(completed.put, (index, note))
+
+    workers = [threading.Thread(target=clean_notes, name=f'clean-{i}') for i in range(args.pipelineWorkers)]
+    writer = threading.Thread(target=write_notes, name='write-notes')
+    for thread in workers + [writer]:
+        thread.start()
+    engine = create_engine(cache, args, metrics)
+    logging.info(f"Sending prompts to completion, cleaning{' and converting' if formats else ''} the notes as they are completed.")
+    try:
+        with metrics.timer('complete'):
+            asyncio.run(complete(engine))
+    finally:
+        finished = time.perf_counter()
+        for _ in workers:
+            completed.put(None)
+        for thread in workers + [writer]:
+            thread.join()
+        metrics.add_time('pipeline_drain', time.perf_counter() - finished)
+    record_completion_metrics(metrics, engine, cache)
+    logging.info(f"Finished the notes {time.perf_counter() - finished:.2f}s after the last completion")
+    if errors:
+        raise RuntimeError("Failed to clean the completed notes") from errors[0]
+    return prompts, notes, cleaned_notes, conversion_errors[0] if conversion_errors else None
+
+
+def conversion_outputs(args: Arguments) -> Tuple[List[str], Optional[Tap], Dict[str, pathlib.Path]]:
+    """conversion_outputs gives the formats of args.convert, the arguments of convert.py to write them
+    with and the path to write each format to (named after args.output, like convert.py names them)."""
+    if not args.convert:
+        return [], None, {}
+    import convert
+    formats = convert.FORMATS if 'all' in args.convert else list(dict.fromkeys(args.convert))
+    output = args.convertOutput or os.path.dirname(args.output) or '.'
+    convert_args = convert.Arguments().parse_args(['--input', args.output, '--output', output,
+                                                   '--spacyPipeline', args.spacyPipeline, '--format', *formats])
+    if args.convertOutput is None and len(formats) == 1:
+        stem = pathlib.Path(args.output).stem
+        outputs = {formats[0]: pathlib.Path(output) / convert.FORMAT_OUTPUTS[formats[0]].format(stem=stem)}
+    else:
+        outputs = convert.output_paths(formats, convert_args)
+    if 'text' in outputs:
+        outputs['text'].mkdir(parents=True, exist_ok=True)
+    return formats, convert_args, outputs
+
+
+def write_results(scenarios: Sequence[Scenario], prompts: List[str], completed_notes: List[str], truncated: List[bool],
+                  args: Arguments, metrics: utilities.metrics.Metrics, cleaned_notes: List[str] = None):
+    """write_results cleans the completed notes (unless given cleaned) and writes them to args.output with their
+    scenarios, prompts and whether they were cut off."""
+    results = results_document(scenarios, prompts, completed_notes, truncated, args, metrics, cleaned_notes)
     logging.info(f"Writing results to {args.output}")
     
-    with open(args.output, 'w', encoding='utf8') as result_file:
-        args.openAIKey = OPENAI_PLACEHOLDER
-        results = {'parameters': args.as_dict(), 'scenarios': [dataclasses.asdict(s) for s in scenarios], 'prompts': prompts, 'results': completed_notes, 'cleaned_results': cleaned_notes}
+    with metrics.timer('write_output'), open(args.output, 'w', encoding='utf8') as result_file:
         json.dump(results, result_file)
 
 
-def sample_lines(filename: pathlib.Path, n: int = 1):
-    with open(filename, 'r', encoding='utf8') as file:
-        lines = file.readlines()
+def results_document(scenarios: Sequence[Scenario], prompts: List[str], completed_notes: List[str], truncated: List[bool],
+                     args: Arguments, metrics: utilities.metrics.Metrics, cleaned_notes: List[str] = None) -> dict:
+    """results_document cleans the completed notes (unless given cleaned) and gives the results of a run as
+    they are written to args.output."""
+    if cleaned_notes is None:
+        with metrics.timer('clean_answer', calls=len(completed_notes)):
+            cleaned_notes = [clean_answer(note) for note in completed_notes]
+    return {'parameters': public_parameters(args), 'scenarios': [dataclasses.asdict(s) for s in scenarios], 'prompts': prompts,
+            'results': completed_notes, 'cleaned_results': cleaned_notes, 'truncated': truncated}
 
-    num_lines = len(lines)
-    if n > num_lines:
-        raise ValueError(
-            f"The file {filename} only has {num_lines} lines but we requested {n} unique choices.")
 
-    stripped_lines = [line.strip() for line in lines]
-    return random.sample(stripped_lines, n)
+def write_batch(scenarios: Sequence[Scenario], cache: utilities.cache.CompletionCache, args: Arguments,
+                metrics: utilities.metrics.Metrics):
+    """write_batch writes a batch request for each scenario that hasn't been completed yet to args.batchRequests,
+    with the record index as its custom_id."""
+    with metrics.timer('format_scenario', calls=len(scenarios)):
+        prompts = [format_scenario(scenario) for scenario in scenarios]
+    missing = [(index, prompt) for index, prompt in zip(record_range(args), prompts)
+               if completion_key(prompt, args) not in cache]
+    if len(missing) > utilities.batch.MAX_REQUESTS:
+        logging.warning(f"The batch API accepts at most {utilities.batch.MAX_REQUESTS} requests in a batch, "
+                        f"create the {len(missing)} records in smaller slices with --start and --end")
+    with metrics.timer('write_batch'):
+        written = utilities.batch.write_requests(args.batchRequests, (
+            (str(index), request_body(prompt, args.model, args.max_tokens, args.temperature, args.topP))
+            for index, prompt in missing))
+    metrics.count('batch_requests', written)
+    logging.info(f"Wrote {written} requests to {args.batchRequests} ({len(prompts) - written} were already completed). "
+                 f"Ingest the results with --batch ingest --batchResults <results.jsonl> and the same arguments.")
 
 
-def sample_with_replacement(filename: pathlib.Path, n: int = 1):
-    with open(filename, 'r', encoding='utf8') as file:
-        lines = file.readlines()
+def ingest_batch(scenarios: Sequence[Scenario], cache: utilities.cache.CompletionCache, args: Arguments,
+                 metrics: utilities.metrics.Metrics) -> List[str]:
+    """ingest_batch stores the completions in the batch results in the cache, giving the prompts of the scenarios.
+    Raises a ValueError if a scenario is neither in the results nor in the cache, or if the results
+    don't belong to these scenarios."""
+    with metrics.timer('format_scenario', calls=len(scenarios)):
+        prompts = [format_scenario(scenario) for scenario in scenarios]
+    by_index = dict(zip(map(str, record_range(args)), prompts))
+    if os.path.exists(args.batchRequests):
+        changed = [custom_id for custom_id, body in utilities.batch.read_requests(args.batchRequests)
+                   if custom_id in by_index and body['messages'][-1]['content'] != by_index[custom_id]]
+        if changed:
+            raise ValueError(f"The prompts of {len(changed)} requests in {args.batchRequests} differ from those of "
+                             f"these arguments (e.g. record {changed[0]}), the batch was written with different arguments")
 
-    stripped_lines = [line.strip() for line in lines]
-    return random.choices(stripped_lines, k=n)
+    failed = {}
+    with metrics.timer('ingest_batch'):
+        for path in args.batchResults:
+            for result in utilities.batch.read_results(path):
+                if result.custom_id not in by_index:
+                    raise ValueError(f"{path} has a result for record {result.custom_id}, which isn't among the records to create")
+                if result.error is not None:
+                    failed[result.custom_id] = result.error
+                    continue
+                failed.pop(result.custom_id, None)
+                completion = result.completion
+                cache.put(completion_key(by_index[result.custom_id], args), completion.content, model=args.model,
+                          finish_reason=completion.finish_reason, prompt_tokens=completion.prompt_tokens,
+                          completion_tokens=completion.completion_tokens)
+                metrics.count('batch_results')
+                metrics.count('prompt_tokens', completion.prompt_tokens or 0)
+                metrics.count('completion_tokens', completion.completion_tokens or 0)
+                if completion.finish_reason == 'length':
+                    metrics.count('truncated_notes')
+    metrics.count('batch_failures', len(failed))
+    for custom_id, error in failed.items():
+        logging.warning(f"Record {custom_id} failed in the batch: {error}")
 
-def sample_document_types(filename: pathlib.Path, task_locale: str, title_locale: str, n: int = 1) -> List[Tuple[str, str]]:
-    with open(filename, 'r', encoding='utf8') as file:
-        reader = csv.DictReader(file)
-        records = list(reader)
-    
-    random_types = random.choices(records, k=n)
-    return [(r[task_locale], r[title_locale]) for r in random_types]
+    missing = [custom_id for custom_id, prompt in by_index.items() if completion_key(prompt, args) not in cache]
+    if missing:
+        raise ValueError(f"{len(missing)} records have no completion (e.g. record {missing[0]}), "
+                         f"write a new batch for them with --batch write, or complete them without --batch")
+    logging.info(f"Ingested the batch results, all {len(prompts)} records are completed")
+    return prompts
+
+
+def record_completion_metrics(metrics: utilities.metrics.Metrics, engine: utilities.completion.CompletionEngine,
+                              cache: utilities.cache.CompletionCache):
+    """record_completion_metrics logs and records the requests made by the engine and its lookups
+    in the cache (see create_engine), and adds the lookups counted by the cache to its stored totals."""
+    logging.info(engine.stats.summary())
+    logging.info(engine.cache_counts.summary())
+    for name in ['completed', 'cached', 'requests', 'retries', 'rate_limited']:
+        metrics.count(f'prompts_{name}' if name in ('completed', 'cached') else name, getattr(engine.stats, name))
+    metrics.count('cache_hits', engine.cache_counts.hits)
+    metrics.count('cache_misses', engine.cache_counts.misses)
+    cache.save_counters()
+
+
+def pack_indices(indices: Sequence[int], notes_per_request: int) -> List[List[int]]:
+    """pack_indices divides the indices of the notes to create into groups to request together."""
+    return [list(indices[i:i + notes_per_request]) for i in range(0, len(indices), notes_per_request)]
+
+
+def complete_packed(scenarios: Sequence[Scenario], prompts: List[str], cache: utilities.cache.CompletionCache,
+                    args: Arguments, metrics: utilities.metrics.Metrics,
+                    limiters: Tuple[utilities.completion.RateLimiter, utilities.completion.RateLimiter] = None) -> List[str]:
+    """complete_packed completes the scenarios args.notesPerRequest at a time, and then
+    completes the notes that couldn't be split from the answers one at a time."""
+    groups = pack_indices(range(len(scenarios)), args.notesPerRequest)
+    packed_engine = create_engine(cache, args, metrics, notes=args.notesPerRequest, limiters=limiters)
+    with metrics.timer('format_scenario', calls=len(groups)):
+        packed_prompts = [format_packed([scenarios[i] for i in group]) for group in groups]
+    answers = packed_engine.complete_all(packed_prompts)
+    record_completion_metrics(metrics, packed_engine, cache)
+
+    notes = [None] * len(scenarios)
+    with metrics.timer('split_packed', calls=len(groups)):
+        for group, prompt, answer in zip(groups, packed_prompts, answers):
+            truncated = is_truncated(prompt, cache, args, len(group) * args.max_tokens)
+            for index, note in zip(group, split_packed(answer, [scenarios[i] for i in group], truncated)):
+                notes[index] = note
+    fallback = [i for i, note in enumerate(notes) if note is None]
+    metrics.count('packed_fallbacks', len(fallback))
+    if fallback:
+        logging.info(f"Could not split {len(fallback)} of {len(scenarios)} notes from the answers, requesting them one at a time.")
+        engine = create_engine(cache, args, metrics, limiters=limiters)
+        for index, note in zip(fallback, engine.complete_all([prompts[i] for i in fallback])):
+            notes[index] = note
+        record_completion_metrics(metrics, engine, cache)
+    return notes
+
+
+def public_parameters(args: Arguments) -> dict:
+    """public_parameters lists the arguments of a run to store with the results, without the API key."""
+    return {**args.as_dict(), 'openAIKey': OPENAI_PLACEHOLDER}
+
+
+def complete_to_checkpoint(scenarios: Sequence[Scenario], cache: utilities.cache.CompletionCache, args: Arguments,
+                           metrics: utilities.metrics.Metrics):
+    """complete_to_checkpoint completes the scenarios missing from args.checkpoint,
+    appending each note to it as soon as it is done."""
+    done = set()
+    if args.resume and os.path.exists(args.checkpoint):
+        stored = utilities.records.read_parameters(args.checkpoint)
+        current = public_parameters(args)
+        mismatched = [p for p in RESUMABLE_PARAMETERS if stored.get(p) != current[p]]
+        if mismatched:
+            raise ValueError(f"Can't resume {args.checkpoint}, it was generated with different {mismatched}")
+        done = utilities.records.completed_indices(args.checkpoint)
+        logging.info(f"Resuming {args.checkpoint}, {len(done)} of {len(scenarios)} notes already done.")
+
+    engine = create_engine(cache, args, metrics)
+    remaining = [i for i in range(len(scenarios)) if i not in done]
+    # The prompts in flight, kept to write them with their notes
+    prompts = {}
+
+    def pending(indices: List[int]):
+        for i in indices:
+            with metrics.timer('format_scenario'):
+                prompts[i] = format_scenario(scenarios[i])
+            yield i, prompts[i]
+
+    def write(writer: utilities.records.RecordWriter, index: int, note: str):
+        prompt = prompts.pop(index, None) or format_scenario(scenarios[index])
+        with metrics.timer('clean_answer'):
+            cleaned = clean_answer(note)
+        with metrics.timer('write_record'):
+            writer.write({'index': index,
+                          'scenario': dataclasses.asdict(scenarios[index]),
+                          'prompt': prompt,
+                          'result': note,
+                          'cleaned_result': cleaned,
+                          'truncated': is_truncated(prompt, cache, args)})
+
+    async def complete_packed_groups(writer: utilities.records.RecordWriter) -> List[int]:
+        groups = pack_indices(remaining, args.notesPerRequest)
+        packed_engine = create_engine(cache, args, metrics, notes=args.notesPerRequest)
+        fallback = []
+
+        packed_prompts = {}
+
+        def pending_groups():
+            for number, group in enumerate(groups):
+                with metrics.timer('format_scenario'):
+                    packed_prompts[number] = format_packed([scenarios[i] for i in group])
+                yield number, packed_prompts[number]
+
+        async for number, answer in packed_engine.stream(pending_groups()):
+            group = groups[number]
+            truncated = is_truncated(packed_prompts.pop(number), cache, args, len(group) * args.max_tokens)
+            with metrics.timer('split_packed'):
+                notes = split_packed(answer, [scenarios[i] for i in group], truncated)
+            for index, note in zip(group, notes):
+                if note is None:
+                    fallback.append(index)
+                else:
+                    write(writer, index, note)
+        record_completion_metrics(metrics, packed_engine, cache)
+        metrics.count('packed_fallbacks', len(fallback))
+        if fallback:
+            logging.info(f"Could not split {len(fallback)} of {len(remaining)} notes from the answers, requesting them one at a time.")
+        return sorted(fallback)
+
+    async def complete():
+        with utilities.records.RecordWriter(args.checkpoint, public_parameters(args), resume=args.resume) as writer:
+            singles = await complete_packed_groups(writer) if args.notesPerRequest > 1 else remaining
+            async for index, note in engine.stream(pending(singles)):
+                write(writer, index, note)
+
+    logging.info("Sending prompts to completion.")
+    with metrics.timer('complete'):
+        asyncio.run(complete())
+    record_completion_metrics(metrics, engine, cache)
 
-def generate_random_date(start_date: datetime.date, end_date: datetime.date) -> str:
-    random_days = random.randint(0, (end_date - start_date).days)
+
+def generate_random_date(start_date: datetime.date, end_date: datetime.date, rng: random.Random = random) -> str:
+    random_days = rng.randint(0, (end_date - start_date).days)
     random_date = start_date + datetime.timedelta(days=random_days)
 
     return random_date
 
 
-def generate_random_phone(locale: str) -> str:
+def generate_random_phone(locale: str, rng: random.Random = random) -> str:
     if locale == 'nb':
-        phone = str(random.randint(0, 1e8-1)).zfill(8)
-        return random.choice([phone, f'0047{phone}', f'+47{phone}'])
+        phone = str(rng.randint(0, 1e8-1)).zfill(8)
+        return rng.choice([phone, f'0047{phone}', f'+47{phone}'])
     elif locale == 'en':
-        phone = str(random.randint(0, 1e10-1)).zfill(10)
-        return random.choice([phone, f'({phone[0:3]}) {phone[3:7]}-{phone[7:]}', f'+1 ({phone[0:3]}) {phone[3:7]}-{phone[7:]}'])
+        phone = str(rng.randint(0, 1e10-1)).zfill(10)
+        return rng.choice([phone, f'({phone[0:3]}) {phone[3:7]}-{phone[7:]}', f'+1 ({phone[0:3]}) {phone[3:7]}-{phone[7:]}'])
     else:
-        raise ValueError(f"Can't generate phone number for locale {args.locale}")
+        raise ValueError(f"Can't generate phone number for locale {locale}")
 
 
-def generate_random_ssn(locale: str) -> str:
+def generate_random_ssn(locale: str, rng: random.Random = random) -> str:
     if locale == 'nb':
-        ssn = str(random.randint(0, 1e11-1)).zfill(11)
-        return random.choice([ssn, f'{ssn[0:6]} {ssn[6:]}'])
+        ssn = str(rng.randint(0, 1e11-1)).zfill(11)
+        return rng.choice([ssn, f'{ssn[0:6]} {ssn[6:]}'])
     elif locale == 'en':
         # Use US SSNs
-        ssn = str(random.randint(0, 1e9-1)).zfill(9)
-        return random.choice([ssn, f'{ssn[0:3]}-{ssn[3:5]}-{ssn[5:]}', f'{ssn[0:3]} {ssn[3:5]} {ssn[5:]}'])
+        ssn = str(rng.randint(0, 1e9-1)).zfill(9)
+        return rng.choice([ssn, f'{ssn[0:3]}-{ssn[3:5]}-{ssn[5:]}', f'{ssn[0:3]} {ssn[3:5]} {ssn[5:]}'])
     else:
-        raise ValueError(f"Can't generate SSN for locale {args.locale}")
+        raise ValueError(f"Can't generate SSN for locale {locale}")
     
-def sample_findings(findings_source, n: int, locale: str) -> list[list[str]]:
+def sample_findings(findings_source, n: int, locale: str, rng: random.Random = random) -> list[list[str]]:
     patient_findings = []
     for _ in range(n):
-        finding_list = [random.choice(findings_source[v]) for v in findings_source.keys()]
-        random.shuffle(finding_list)
+        finding_list = [rng.choice(findings_source[v]) for v in findings_source.keys()]
+        rng.shuffle(finding_list)
         patient_findings.append(finding_list)
     return patient_findings
 
-def create_scenarios(n: int, locale: str, split: str='all') -> List[Scenario]:
-    document_types = sample_document_types(os.path.join('vocabularies', 'document_types.csv'), 'en', locale, n)
-    if args.withReplacement:
-        given_names = sample_with_replacement(os.path.join('vocabularies', split, 'nb_given_names.csv'), n)
-        family_names = sample_with_replacement(os.path.join('vocabularies', split, 'nb_family_names.csv'), n)
-        cities = sample_with_replacement(os.path.join('vocabularies', split, 'nb_cities.csv'), n)
+def create_scenarios(n: int, locale: str, split: str='all', store: utilities.vocabulary.VocabularyStore = None,
+                     with_replacement: bool = False, backend: str = 'random') -> Sequence[Scenario]:
+    if store is None:
+        store = utilities.vocabulary.load_store(split)
+    if backend == 'numpy':
+        import numpy as np
+        from utilities import vectorized
+        # Seeding NumPy from the seeded global generator keeps --seed reproducible
+        rng = np.random.default_rng(random.getrandbits(64))
+        return vectorized.create_batch(n, locale, store, rng, with_replacement)
+
+    document_types = store.sample_document_types('en', locale, n)
+    if with_replacement:
+        given_names = store.given_names.choices(n)
+        family_names = store.family_names.choices(n)
+        cities = store.cities.choices(n)
     else: 
-        given_names = sample_lines(os.path.join('vocabularies', split, 'nb_given_names.csv'), n)
-        family_names = sample_lines(os.path.join('vocabularies', split, 'nb_family_names.csv'), n)
-        cities = sample_lines(os.path.join('vocabularies', split, 'nb_cities.csv'), n)
-    diagnoses = sample_with_replacement(os.path.join('vocabularies', split, 'en_diagnoses.csv'), n)
-    healthcare_units = sample_with_replacement(
-        os.path.join('vocabularies', split, 'nb_healthcare_units.csv'), n)
-    with open('vocabularies/en_findings.json', 'r') as findings_file:
-        findings_source = json.load(findings_file)
-
-    start_births, end_births = datetime.date(
-        1943, 1, 1), datetime.date(2010, 1, 1)
+        given_names = store.given_names.sample(n)
+        family_names = store.family_names.sample(n)
+        cities = store.cities.sample(n)
+    diagnoses = store.diagnoses.choices(n)
+    healthcare_units = store.healthcare_units.choices(n)
+    findings_source = store.findings
+
+    start_births, end_births = BIRTH_DATES
     birth_dates = [generate_random_date(
         start_births, end_births) for _ in range(n)]
-    written_birth_dates = [b.strftime("%B %d. %Y") for b in birth_dates]
+    written_birth_dates = [b.strftime(DATE_FORMAT) for b in birth_dates]
     today = datetime.date.today()
 
     # Not correct, doesn't take leap years into account
     # but should be OK for the purposes of testing deidentification
     ages = [(today - b).days // 365 for b in birth_dates]
 
-    start_admissions, end_admissions = datetime.date(
-        2012, 1, 1), datetime.date(2023, 1, 1)
+    start_admissions, end_admissions = ADMISSION_DATES
     admission_dates = [generate_random_date(
         start_admissions, end_admissions) for _ in range(n)]
-    written_admissions = [b.strftime("%B %d. %Y") for b in admission_dates]
+    written_admissions = [b.strftime(DATE_FORMAT) for b in admission_dates]
     phone_numbers = [generate_random_phone(locale) for _ in range(n)]
 
     ssns = [generate_random_ssn(locale) for _ in range(n)]
 
     findings = sample_findings(findings_source, n, locale)
 
-    return [Scenario(locale=args.locale,
+    return [Scenario(locale=locale,
                      noteType=document_types[i][0],
                      translatedNoteType=document_types[i][1],
                      givenName=given_names[i],
@@ -247,23 +716,69 @@ def create_scenarios(n: int, locale: str, split: str='all') -> List[Scenario]:
             for i in range(n)]
 
 
+def create_record_scenarios(indices: range, locale: str, store: utilities.vocabulary.VocabularyStore, seed: int,
+                            with_replacement: bool = False, backend: str = 'random') -> Sequence[Scenario]:
+    """create_record_scenarios creates the scenarios for the records with the given indices,
+    where each record depends only on the seed and its index."""
+    if backend == 'numpy':
+        from utilities import vectorized
+        rng = utilities.seeding.CounterGenerator(seed, indices)
+        return vectorized.create_batch(len(indices), locale, store, rng, with_replacement)
+
+    vocabularies = {'given_names': store.given_names, 'family_names': store.family_names, 'cities': store.cities}
+    if not with_replacement:
+        for name, vocabulary in vocabularies.items():
+            if indices.stop > len(vocabulary):
+                raise ValueError(f"The vocabulary {name} only has {len(vocabulary)} lines but we requested {indices.stop} unique choices.")
+        permutations = {name: utilities.seeding.KeyedPermutation(len(vocabulary), utilities.seeding.stable_hash(seed, name))
+                        for name, vocabulary in vocabularies.items()}
+    today = datetime.date.today()
+
+    scenarios = []
+    for i in indices:
+        rng = utilities.seeding.record_random(seed, i)
+        if with_replacement:
+            drawn = {name: vocabulary[rng.randrange(len(vocabulary))] for name, vocabulary in vocabularies.items()}
+        else:
+            drawn = {name: vocabulary[permutations[name][i]] for name, vocabulary in vocabularies.items()}
+        note_type, translated_note_type = store.sample_document_types('en', locale, 1, rng)[0]
+        birth_date = generate_random_date(*BIRTH_DATES, rng)
+        scenarios.append(Scenario(locale=locale,
+                                  noteType=note_type,
+                                  translatedNoteType=translated_note_type,
+                                  givenName=drawn['given_names'],
+                                  familyName=drawn['family_names'],
+                                  age=(today - birth_date).days // 365,
+                                  phoneNumber=generate_random_phone(locale, rng),
+                                  city=drawn['cities'],
+                                  healthCareUnit=store.healthcare_units.choices(1, rng)[0],
+                                  diagnosis=store.diagnoses.choices(1, rng)[0],
+                                  birthDate=birth_date.strftime(DATE_FORMAT),
+                                  admissionDate=generate_random_date(*ADMISSION_DATES, rng).strftime(DATE_FORMAT),
+                                  socialSecurityNumber=generate_random_ssn(locale, rng),
+                                  findings=sample_findings(store.findings, 1, locale, rng)[0]))
+    return scenarios
+
+
+def record_range(args: Arguments) -> range:
+    """record_range gives the indices of the records this run creates, out of the --n records in total."""
+    if args.shardCount > 1:
+        if not 0 <= args.shardIndex < args.shardCount:
+            raise ValueError(f"--shardIndex must be between 0 and {args.shardCount - 1}")
+        return range(args.shardIndex * args.n // args.shardCount, (args.shardIndex + 1) * args.n // args.shardCount)
+    end = args.n if args.end is None else min(args.end, args.n)
+    return range(args.start, end)
+
+
 def format_scenario(scenario: Scenario) -> str:
     lang_name = {'en': 'English', 'nb': 'Norwegian'}
     if scenario.locale not in lang_name:
         raise ValueError(f"Unknown locale {args.locale}")
     
-    language = lang_name[scenario.locale]
-    formatted_findings = ', '.join(scenario.findings)
-    return f"""
-Write a {scenario.noteType} in {language} for a patient named {scenario.givenName} {scenario.familyName}, who has been admitted with the primary diagnosis code \"{scenario.diagnosis}\".
-It should explain that at the time of admission, the patient had {formatted_findings}.
-Additionally, include the following information:
-- The patient is {scenario.age} years old.
-- The patient was admitted to {scenario.healthCareUnit} on {scenario.admissionDate}.
-- The patient was born in {scenario.city} on {scenario.birthDate}.
-- The patient's phone number is {scenario.phoneNumber}.
-- The patient's social security number is {scenario.socialSecurityNumber}.
+    return f"\n{describe_scenario(scenario)}{TAGGING_INSTRUCTIONS}"
 
+# TAGGING_INSTRUCTIONS end every prompt, telling the model how to annotate the notes
+TAGGING_INSTRUCTIONS = """
 For every first name in the text, add surrounding <First_Name> tags.
 For every last name in the text, add surrounding <Last_Name> tags.
 For every person's age in the text, add surrounding <Age> tags.
@@ -276,6 +791,95 @@ Do not add any other tags.
 
 """
 
+def describe_scenario(scenario: Scenario) -> str:
+    """describe_scenario asks for a note about the patient of a scenario, without the tagging instructions."""
+    language = {'en': 'English', 'nb': 'Norwegian'}[scenario.locale]
+    formatted_findings = ', '.join(scenario.findings)
+    return f"""Write a {scenario.noteType} in {language} for a patient named {scenario.givenName} {scenario.familyName}, who has been admitted with the primary diagnosis code \"{scenario.diagnosis}\".
+It should explain that at the time of admission, the patient had {formatted_findings}.
+Additionally, include the following information:
+- The patient is {scenario.age} years old.
+- The patient was admitted to {scenario.healthCareUnit} on {scenario.admissionDate}.
+- The patient was born in {scenario.city} on {scenario.birthDate}.
+- The patient's phone number is {scenario.phoneNumber}.
+- The patient's social security number is {scenario.socialSecurityNumber}.
+"""
+
+def format_packed(scenarios: Sequence[Scenario]) -> str:
+    """format_packed asks for a note for each scenario in a single prompt, giving the tagging instructions once.
+    Each note is to start with its marker (see NOTE_MARKER), so split_packed can tell them apart."""
+    sections = '\n'.join(f"{NOTE_MARKER.format(number)}\n{describe_scenario(scenario)}"
+                         for number, scenario in enumerate(scenarios, start=1))
+    return f"""
+Write {len(scenarios)} separate notes, one for each of the patients below. Start each note with a line containing only its marker ({NOTE_MARKER.format(1)}, {NOTE_MARKER.format(2)} and so on), and write nothing after the last note.
+
+{sections}{TAGGING_INSTRUCTIONS}"""
+
+def split_packed(answer: str, scenarios: Sequence[Scenario], truncated: bool = False) -> List[Optional[str]]:
+    """split_packed splits the answer to a prompt from format_packed into the note for each scenario.
+    A note is None if its marker is missing or repeated, if it is empty, or if it doesn't mention
+    the patient by name (which is how notes written for the wrong patient are caught).
+    If the answer was cut off, so is its last note, which is None too."""
+    markers = list(_NOTE_MARKER.finditer(answer))
+    sections = {}
+    repeated = set()
+    for marker, following in zip(markers, markers[1:] + [None]):
+        number = int(marker.group(1))
+        if number in sections:
+            repeated.add(number)
+        sections[number] = answer[marker.end():following.start() if following else len(answer)].strip('\n')
+
+    notes = []
+    for number, scenario in enumerate(scenarios, start=1):
+        note = sections.get(number)
+        if note is None or number in repeated or not note.strip():
+            notes.append(None)
+            continue
+        text = utilities.tags.remove_tags(note)
+        notes.append(note if scenario.givenName in text or scenario.familyName in text else None)
+    if truncated and markers:
+        last = int(markers[-1].group(1))
+        if 1 <= last <= len(notes):
+            notes[last - 1] = None
+    return notes
+
+def note_kinds(prompt: str) -> List[str]:
+    """note_kinds lists the language and type of each note a prompt asks for (e.g. 'Norwegian/referral')."""
+    return [f"{language}/{note_type}" for note_type, language in _NOTE_KIND.findall(prompt)]
+
+def learn_token_limits(cache: utilities.cache.CompletionCache, args: Arguments) -> Dict[str, int]:
+    """learn_token_limits gives the number of tokens to ask for each kind of note that enough lengths were recorded for."""
+    limits = {}
+    for kind, lengths in cache.lengths(args.model).items():
+        if len(lengths) >= LENGTH_SAMPLES:
+            ordered = sorted(lengths)
+            quantile = ordered[min(len(ordered) - 1, int(LENGTH_QUANTILE * len(ordered)))]
+            limits[kind] = min(args.max_tokens, math.ceil(LENGTH_MARGIN * quantile))
+    logging.debug(f"Learned token limits {limits}")
+    return limits
+
+def token_limit(prompt: str, max_tokens: int, limits: Optional[Dict[str, int]]) -> int:
+    """token_limit gives the number of tokens to ask for in a request for a prompt, at most max_tokens
+    (shared between the notes it asks for)."""
+    kinds = note_kinds(prompt)
+    if not limits or not kinds:
+        return max_tokens
+    return min(max_tokens, sum(limits.get(kind, max_tokens // len(kinds)) for kind in kinds))
+
+def stitch(partial: str, continuation: str) -> str:
+    """stitch joins a note that was cut off with its continuation. A tag left open at the end of the
+    note is dropped if the continuation starts by opening it again, and so is the start of the
+    continuation if it repeats the end of the note."""
+    partial = _TAG_FRAGMENT.sub('', partial)
+    open_tag = _OPEN_TAG.search(partial)
+    if open_tag and continuation.lstrip().startswith(f'<{open_tag.group(1)}>'):
+        partial = partial[:open_tag.start()]
+        continuation = continuation.lstrip()
+    for overlap in range(min(len(partial), len(continuation), STITCH_WINDOW), STITCH_MIN_OVERLAP - 1, -1):
+        if partial.endswith(continuation[:overlap]):
+            return partial + continuation[overlap:]
+    return partial + continuation
+
 def clean_answer(answer: str):
     """clean_answer attempts to remove trivial PHI cases from the dataset
     (of the title-PHI form e.g. "Phone Number: 555-12345")"""
@@ -296,30 +900,143 @@ def clean_answer(answer: str):
     return '\n'.join(cleaned)
 
 
-def complete_note(prompt: str, memory: joblib.Memory, args: Arguments) -> str:
+def create_engine(cache: utilities.cache.CompletionCache, args: Arguments,
+                  metrics: utilities.metrics.Metrics = None, notes: int = 1, attempt: int = 0,
+                  limiters: Tuple[utilities.completion.RateLimiter, utilities.completion.RateLimiter] = None
+                  ) -> utilities.completion.CompletionEngine:
+    """create_engine sets up concurrent completion of prompts with the budgets given in args (or those of the
+    given request and token limiters), for prompts asking for the given number of notes (each allowed up to
+    args.max_tokens). A later attempt completes the prompts again, caching the answers under keys of its own.
+    The cache_counts of the engine count its own lookups in the cache."""
+    max_tokens = notes * args.max_tokens
+    token_limits = learn_token_limits(cache, args) if args.adaptiveMaxTokens else None
+
+    def is_cached(prompt: str) -> bool:
+        return args.dryRun or completion_key(prompt, args, max_tokens, attempt) in cache
+
+    # The lookups of this engine are counted apart from those of other runs sharing the cache (see serve.py)
+    counts = utilities.cache.CacheCounts()
+    # Continuations are requested from within complete_note, throttled by the budgets of the engine
+    engine = utilities.completion.CompletionEngine(
+        lambda prompt: complete_note(prompt, cache, args, metrics, max_tokens, token_limits, attempt, engine.throttle,
+                                     counts),
+        concurrency=args.concurrency,
+        requests_per_minute=args.requestsPerMinute,
+        tokens_per_minute=args.tokensPerMinute,
+        max_tokens=max_tokens,
+        max_retries=args.maxRetries,
+        is_cached=is_cached,
+        limiters=limiters)
+    engine.cache_counts = counts
+    return engine
+
+def completion_key(prompt: str, args: Arguments, max_tokens: int = None, attempt: int = 0) -> str:
+    """completion_key gives the key the completion of a prompt (in the given attempt) is cached under."""
+    return utilities.cache.cache_key(SYSTEM_PROMPT, prompt, args.model, max_tokens or args.max_tokens, args.temperature, args.topP,
+                                     attempt)
+
+def is_truncated(prompt: str, cache: utilities.cache.CompletionCache, args: Arguments, max_tokens: int = None,
+                 attempt: int = 0) -> bool:
+    """is_truncated tells whether the cached answer to a prompt was cut off at the token limit."""
+    return cache.finish_reason(completion_key(prompt, args, max_tokens, attempt)) == 'length'
+
+def complete_note(prompt: str, cache: utilities.cache.CompletionCache, args: Arguments,
+                  metrics: utilities.metrics.Metrics = None, max_tokens: int = None,
+                  token_limits: Dict[str, int] = None, attempt: int = 0, throttle: Callable[[int], None] = None,
+                  counts: utilities.cache.CacheCounts = None) -> str:
+    """complete_note gives the answer to a prompt, from the cache or by requesting it. Answers that are
+    cut off (including those cached by earlier runs) are continued up to args.maxContinuations times,
+    calling throttle (if given) with the tokens of each continuation before requesting it. The answer so
+    far is cached before each continuation, so a continuation that fails is retried from there.
+    The request asks for the number of tokens learned for the notes in token_limits, if given, and the
+    answer is cached under the key of the given attempt (its lookup counted in counts, if given)."""
     if args.dryRun:
         return ""
 
+    import openai
     if os.getenv('OPENAI_API_KEY') is None:
         openai.api_key = args.openAIKey
+    if args.apiBase is not None:
+        openai.api_base = args.apiBase
 
-    get_answer = memory.cache(_complete, verbose=0)
-    answer = get_answer(prompt, args.model, args.max_tokens, args.temperature, args.topP)
-    return answer
+    max_tokens = max_tokens or args.max_tokens
+    key = completion_key(prompt, args, max_tokens, attempt)
+    answer = cache.get(key, counts)
+    if answer is not None and (args.maxContinuations == 0 or cache.finish_reason(key) != 'length'):
+        return answer
 
-def _complete(prompt: str, model: str, max_tokens: int, temperature: float, topP: float):
-    completion = openai.ChatCompletion.create(
+    limit = token_limit(prompt, max_tokens, token_limits)
+    if answer is None:
+        completion = _request(prompt, None, limit, args, metrics)
+    else:
+        # The answer was cut off in an earlier run, which didn't record its length
+        completion = utilities.completion.Completion(answer, 'length')
+    continuations = 0
+    while completion.finish_reason == 'length' and continuations < args.maxContinuations:
+        cache.put(key, completion.content, model=args.model, finish_reason=completion.finish_reason,
+                  prompt_tokens=completion.prompt_tokens, completion_tokens=completion.completion_tokens)
+        partial = _TAG_FRAGMENT.sub('', completion.content)
+        if throttle is not None:
+            throttle(utilities.completion.estimate_tokens(prompt + partial) + limit)
+        continued = _request(prompt, partial, limit, args, metrics)
+        continuations += 1
+        completion = utilities.completion.Completion(
+            stitch(partial, continued.content), continued.finish_reason,
+            _total(completion.prompt_tokens, continued.prompt_tokens),
+            _total(completion.completion_tokens, continued.completion_tokens))
+    if metrics is not None:
+        metrics.count('continuations', continuations)
+        if completion.finish_reason == 'length':
+            metrics.count('truncated_notes')
+
+    cache.put(key, completion.content, model=args.model, finish_reason=completion.finish_reason,
+              prompt_tokens=completion.prompt_tokens, completion_tokens=completion.completion_tokens)
+    kinds = note_kinds(prompt)
+    if completion.finish_reason == 'stop' and completion.completion_tokens is not None and len(kinds) == 1:
+        cache.record_length(kinds[0], args.model, completion.completion_tokens)
+    return completion.content
+
+def _total(first: Optional[int], second: Optional[int]) -> Optional[int]:
+    return first + second if first is not None and second is not None else None
+
+def _request(prompt: str, partial: Optional[str], max_tokens: int, args: Arguments,
+             metrics: Optional[utilities.metrics.Metrics]) -> utilities.completion.Completion:
+    """_request asks for the answer to a prompt (or for the rest of a partial answer), recording its latency and usage."""
+    started = time.perf_counter()
+    try:
+        completion = _complete(prompt, args.model, max_tokens, args.temperature, args.topP, partial)
+    finally:
+        if metrics is not None:
+            metrics.observe_latency(time.perf_counter() - started)
+    if metrics is not None:
+        metrics.count('prompt_tokens', completion.prompt_tokens or 0)
+        metrics.count('completion_tokens', completion.completion_tokens or 0)
+        if completion.finish_reason == 'length':
+            metrics.count('truncated_requests')
+    return completion
+
+def request_body(prompt: str, model: str, max_tokens: int, temperature: float, topP: float, partial: str = None) -> dict:
+    """request_body gives the parameters of the chat completion request for a prompt (sent directly, or in a batch).
+    Given the partial answer of a request that was cut off, it asks for the rest of it instead."""
+    messages = [
+        {'role': 'system', 'content': SYSTEM_PROMPT},
+        {'role': 'user', 'content': prompt}
+        ]
+    if partial is not None:
+        messages += [{'role': 'assistant', 'content': partial}, {'role': 'user', 'content': CONTINUE_PROMPT}]
+    return dict(
         model=model,
-        messages=[
-            {'role': 'system', 'content': SYSTEM_PROMPT},
-            {'role': 'user', 'content': prompt}
-            ],
+        messages=messages,
         max_tokens=max_tokens,
         temperature=temperature,
         top_p=topP,
         )
-    answer = completion.choices[0].message.content
-    return answer
+
+def _complete(prompt: str, model: str, max_tokens: int, temperature: float, topP: float,
+              partial: str = None) -> utilities.completion.Completion:
+    import openai
+    completion = openai.ChatCompletion.create(**request_body(prompt, model, max_tokens, temperature, topP, partial))
+    return utilities.batch.parse_completion(completion)
 
 
 if __name__ == '__main__':
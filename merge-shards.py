@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+merge-shards.py combines the results of generation runs that each created a slice of the
+records (with --shardIndex/--shardCount or --start/--end and --seeding per-record) into
+the results of a single run over all of them.
+"""
+import json
+import logging
+import pathlib
+from typing import List
+from tap import Tap
+
+import utilities.records
+
+# CONTENT_PARAMETERS determine the records a run creates, so they must match between the shards of a run
+# (like generate.RESUMABLE_PARAMETERS, without the slice of the records each shard creates). The other
+# parameters (e.g. --concurrency or --apiBase) only change how the records were created.
+CONTENT_PARAMETERS = ['n', 'seed', 'locale', 'split', 'withReplacement', 'model', 'max_tokens', 'temperature', 'topP',
+                      'backend', 'seeding', 'dryRun', 'notesPerRequest', 'maxContinuations', 'adaptiveMaxTokens']
+
+class Arguments(Tap):
+    inputs: List[pathlib.Path]
+    """The results of each shard."""
+    output: pathlib.Path = 'results.json'
+    """The JSON file to write the merged results to."""
+    verbose: bool = False
+    """Whether to output debugging information"""
+
+def shard_start(parameters: dict) -> int:
+    """shard_start gives the index of the first record in a shard."""
+    if parameters.get('shardCount', 1) > 1:
+        return parameters['shardIndex'] * parameters['n'] // parameters['shardCount']
+    return parameters.get('start', 0)
+
+def main(args: Arguments):
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    shards = []
+    for path in args.inputs:
+        with open(path, 'r', encoding='utf8') as shard_file:
+            shard = json.load(shard_file)
+        shards.append((shard_start(shard['parameters']), len(shard['scenarios']), path, shard['parameters']))
+    shards.sort(key=lambda s: s[0])
+
+    first_parameters = shards[0][3]
+    if first_parameters.get('seeding') != 'per-record':
+        raise ValueError("Only shards created with --seeding per-record can be merged")
+    expected_start = 0
+    for start, length, path, parameters in shards:
+        mismatched = [p for p in CONTENT_PARAMETERS if parameters.get(p) != first_parameters.get(p)]
+        if mismatched:
+            raise ValueError(f"{path} was generated with different {mismatched} than {shards[0][2]}")
+        if start != expected_start:
+            raise ValueError(f"Expected a shard starting at record {expected_start}, but {path} starts at {start}")
+        expected_start = start + length
+    if expected_start != first_parameters['n']:
+        raise ValueError(f"The shards only cover {expected_start} of {first_parameters['n']} records")
+
+    parameters = {**first_parameters, 'shardIndex': 0, 'shardCount': 1, 'start': 0, 'end': None,
+                  'output': str(args.output), 'checkpoint': None, 'resume': False}
+
+    # Write one section at a time, reading the shards again for each,
+    # so that only one shard is held in memory.
+    with open(args.output, 'w', encoding='utf8') as output:
+        output.write('{"parameters": ')
+        json.dump(parameters, output)
+        for section in utilities.records.SECTIONS:
+            output.write(f', "{section}": [')
+            written = 0
+            for _, length, path, _ in shards:
+                with open(path, 'r', encoding='utf8') as shard_file:
+                    # Shards written before a section was added don't have it
+                    entries = json.load(shard_file).get(section, [None] * length)
+                for entry in entries:
+                    if written > 0:
+                        output.write(', ')
+                    json.dump(entry, output)
+                    written += 1
+            output.write(']')
+        output.write('}')
+    logging.info(f"Merged {len(shards)} shards with {expected_start} records to {args.output}")
+
+if __name__ == '__main__':
+    args = Arguments()
+    args.parse_args()
+    main(args)
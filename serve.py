@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+serve.py keeps the work generate.py repeats on every run warm in a long-running local service:
+the vocabularies of each split stay loaded, one completion cache stays open, and requests to the
+model endpoint reuse a pool of keep-alive HTTP connections. It suits test harnesses that ask for
+many small batches of notes:
+
+    python serve.py --apiBase http://localhost:8000/v1 --openAIKey stub --preload all
+    python generate-client.py --n 10 --output results.json
+
+The service listens on --host and --port, or on the Unix socket --socket. Each endpoint takes a
+JSON object with the 'parameters' of the run, named like the arguments of generate.py (those not
+given keep their defaults), and answers with a JSON object:
+
+    POST /scenarios   creates the scenarios ({'scenarios': [...]})
+    POST /prompts     formats the given 'scenarios', or those of the parameters, as prompts ({'prompts': [...]})
+    POST /complete    completes the given 'prompts' ({'results', 'cleaned_results', 'truncated'})
+    POST /generate    does all of the above, answering with the results as generate.py writes them
+                      (and the 'metrics' of the run)
+    GET  /status      tells what the service has loaded and done so far
+
+The model endpoint, its key and the request and token budgets are those of the service, whatever
+the parameters say, so that every run shares them. Runs with --batch, --checkpoint, --profile or
+--convert are not served, use generate.py for those.
+"""
+import dataclasses
+import http.server
+import json
+import logging
+import os
+import random
+import socketserver
+import threading
+import time
+from typing import List, Literal, Tuple
+
+from tap import Tap
+
+import generate
+import utilities.cache
+import utilities.completion
+import utilities.metrics
+import utilities.vocabulary
+from utilities.scenarios import Scenario
+
+# UNSERVED_PARAMETERS are the options of generate.py the service doesn't run, with their default values
+UNSERVED_PARAMETERS = {'batch': None, 'checkpoint': None, 'profile': None, 'convert': []}
+
+class Arguments(Tap):
+    host: str = 'localhost'
+    """The interface to listen on"""
+    port: int = 8100
+    """The port to listen on"""
+    socket: str = None
+    """A Unix socket to listen on instead of --host and --port"""
+    openAIKey: str = generate.OPENAI_PLACEHOLDER
+    """The API key to OpenAI (or to the endpoint at --apiBase)"""
+    apiBase: str = None
+    """The base URL of an OpenAI-compatible API to use instead of OpenAI (e.g. utilities/stub_server.py)"""
+    preload: List[Literal['all', 'training', 'holdout']] = ['all']
+    """The splits to load the vocabularies of before serving (others are loaded by the first request for them)"""
+    vocabularyIndex: bool = False
+    """Keep a memory-mapped index next to each vocabulary file to load it faster next time"""
+    requestsPerMinute: float = None
+    """The budget of completion requests per minute, shared by all runs (unlimited if not set)"""
+    tokensPerMinute: float = None
+    """The budget of prompt and completion tokens per minute, shared by all runs (unlimited if not set)"""
+    connections: int = 32
+    """The number of keep-alive connections to the model endpoint to keep open (at least the --concurrency of the runs)"""
+    verbose: bool = False
+    """Whether to output debugging information"""
+
+
+def keep_alive_session(connections: int):
+    """keep_alive_session gives the HTTP session all requests to the model endpoint share, holding on to
+    up to the given number of connections between requests."""
+    import openai
+    import openai.api_requestor
+    import requests
+    import requests.adapters
+
+    class KeepAliveSession(requests.Session):
+        # openai closes the session of a thread once it is a few minutes old, which would
+        # drop the connections in use by every other thread.
+        def close(self):
+            pass
+
+    session = KeepAliveSession()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=connections,
+                                            max_retries=openai.api_requestor.MAX_CONNECTION_RETRIES)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    openai.requestssession = session
+    return session
+
+
+class GenerationService:
+    """GenerationService answers the requests of the service from the preloaded vocabularies and the shared cache."""
+    def __init__(self, options: Arguments):
+        self.options = options
+        self.dry_run = options.openAIKey == generate.OPENAI_PLACEHOLDER and os.getenv('OPENAI_API_KEY') is None
+        if self.dry_run:
+            logging.warning("Could not find OpenAI API key, serving in dry-run mode.")
+        self.session = keep_alive_session(options.connections)
+        self.cache = utilities.cache.CompletionCache(generate.CACHE_PATH)
+        self.limiters = (utilities.completion.RateLimiter(options.requestsPerMinute),
+                         utilities.completion.RateLimiter(options.tokensPerMinute))
+        for split in options.preload:
+            started = time.perf_counter()
+            utilities.vocabulary.load_store(split, persist_index=options.vocabularyIndex)
+            logging.info(f"Loaded the vocabularies of the {split} split in {time.perf_counter() - started:.1f}s")
+        self.started = time.time()
+        self.served = {}
+        self.totals = {}
+        self._lock = threading.Lock()
+        # Sequential scenarios are drawn from the global random generator, one run at a time
+        self._random_lock = threading.Lock()
+
+    def arguments(self, request: dict) -> generate.Arguments:
+        """arguments gives the arguments of generate.py for the parameters of a request."""
+        parameters = request.get('parameters', {})
+        args = generate.Arguments().parse_args([])
+        unknown = set(parameters) - set(args.as_dict())
+        if unknown:
+            raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+        args.from_dict(parameters)
+        for name, default in UNSERVED_PARAMETERS.items():
+            if getattr(args, name) != default:
+                raise ValueError(f"The service doesn't run generate.py --{name}, run generate.py instead")
+        generate.validate_arguments(args)
+        args.openAIKey = self.options.openAIKey
+        args.apiBase = self.options.apiBase
+        args.requestsPerMinute = self.options.requestsPerMinute
+        args.tokensPerMinute = self.options.tokensPerMinute
+        args.dryRun = args.dryRun or self.dry_run
+        return args
+
+    def record(self, endpoint: str, metrics: utilities.metrics.Metrics):
+        """record adds a request to an endpoint, and the counters of its metrics, to the totals of the service."""
+        with self._lock:
+            self.served[endpoint] = self.served.get(endpoint, 0) + 1
+            for name, value in metrics.to_dict()['counters'].items():
+                self.totals[name] = self.totals.get(name, 0) + value
+
+    def scenarios(self, args: generate.Arguments, metrics: utilities.metrics.Metrics) -> List[Scenario]:
+        store = utilities.vocabulary.load_store(args.split, persist_index=self.options.vocabularyIndex)
+        if args.seeding == 'per-record':
+            return generate.create_run_scenarios(args, store, metrics)
+        with self._random_lock:
+            random.seed(args.seed)
+            return generate.create_run_scenarios(args, store, metrics)
+
+    def complete(self, args: generate.Arguments, prompts: List[str], metrics: utilities.metrics.Metrics) -> Tuple[List[str], List[bool]]:
+        engine = generate.create_engine(self.cache, args, metrics, limiters=self.limiters)
+        with metrics.timer('complete'):
+            notes = engine.complete_all(prompts)
+        generate.record_completion_metrics(metrics, engine, self.cache)
+        return notes, [generate.is_truncated(prompt, self.cache, args) for prompt in prompts]
+
+    def handle(self, endpoint: str, request: dict) -> dict:
+        """handle gives the answer of an endpoint to a request, raising a KeyError for unknown
+        endpoints and a ValueError for requests it can't answer."""
+        if endpoint not in ('scenarios', 'prompts', 'complete', 'generate'):
+            raise KeyError(endpoint)
+        args = self.arguments(request)
+        metrics = utilities.metrics.Metrics('generate')
+        response = self._answer(endpoint, request, args, metrics)
+        self.record(endpoint, metrics)
+        return response
+
+    def _answer(self, endpoint: str, request: dict, args: generate.Arguments, metrics: utilities.metrics.Metrics) -> dict:
+        if endpoint == 'scenarios':
+            return {'scenarios': [dataclasses.asdict(s) for s in self.scenarios(args, metrics)]}
+        if endpoint == 'prompts':
+            if 'scenarios' in request:
+                scenarios = [Scenario(**scenario) for scenario in request['scenarios']]
+            else:
+                scenarios = self.scenarios(args, metrics)
+            return {'prompts': [generate.format_scenario(scenario) for scenario in scenarios]}
+        if endpoint == 'complete':
+            prompts = request.get('prompts')
+            if not isinstance(prompts, list):
+                raise ValueError("Expected a list of 'prompts' to complete")
+            notes, truncated = self.complete(args, prompts, metrics)
+            return {'results': notes, 'cleaned_results': [generate.clean_answer(note) for note in notes], 'truncated': truncated}
+
+        scenarios = self.scenarios(args, metrics)
+        prompts, notes = generate.complete_scenarios(scenarios, self.cache, args, metrics, self.limiters)
+        truncated = [generate.is_truncated(prompt, self.cache, args) for prompt in prompts]
+        return {**generate.results_document(scenarios, prompts, notes, truncated, args, metrics), 'metrics': metrics.to_dict()}
+
+    def status(self) -> dict:
+        return {'uptime': time.time() - self.started, 'dry_run': self.dry_run, 'api_base': self.options.apiBase,
+                'splits': self.options.preload, 'served': dict(self.served), 'counters': dict(self.totals)}
+
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/status':
+            return self._respond(404, {'error': f'Unknown path {self.path}'})
+        self._respond(200, self.server.service.status())
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        started = time.perf_counter()
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+            response = self.server.service.handle(self.path.strip('/'), request)
+        except KeyError:
+            return self._respond(404, {'error': f'Unknown path {self.path}'})
+        except (ValueError, TypeError, AttributeError) as error:
+            return self._respond(400, {'error': str(error)})
+        except Exception as error:
+            logging.exception(f"Failed to answer {self.path}")
+            return self._respond(500, {'error': f'{type(error).__name__}: {error}'})
+        logging.info(f"Answered {self.path} in {time.perf_counter() - started:.2f}s")
+        self._respond(200, response)
+
+    def _respond(self, status: int, body: dict):
+        payload = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class ServiceServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, options: Arguments, service: GenerationService):
+        super().__init__((options.host, options.port), ServiceHandler)
+        self.service = service
+
+
+class UnixServiceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, options: Arguments, service: GenerationService):
+        if os.path.exists(options.socket):
+            os.remove(options.socket)
+        super().__init__(options.socket, ServiceHandler)
+        self.service = service
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def main(args: Arguments):
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    service = GenerationService(args)
+    server = UnixServiceServer(args, service) if args.socket else ServiceServer(args, service)
+    logging.info(f"Serving generation on {args.socket or f'http://{args.host}:{server.server_address[1]}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.cache.save_counters()
+
+
+if __name__ == '__main__':
+    args = Arguments()
+    args.parse_args()
+    main(args)
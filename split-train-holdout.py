@@ -1,55 +1,122 @@
 #!/usr/bin/env python3
 
 """
-split-train-holdout.py randomly samples lines from a text file to generate a training set
-and holdout set of unseen examples.
+split-train-holdout.py splits the lines of text files into a training set and a holdout
+set of unseen examples (or any other splits, e.g. training, validation and holdout).
+
+Each line is assigned by a keyed hash of its contents, so the same line always lands in the
+same split: adding lines to a file never moves the existing ones between splits, and a line
+that occurs twice is never in two splits. Files are read and written one line at a time,
+and several files are split at the same time.
 """
+import bisect
+import hashlib
+import logging
+import multiprocessing
 import pathlib
-from typing import Literal
+from typing import Dict, List, Tuple
 from tap import Tap
-import logging
-import random
 
 class Arguments(Tap):
-    input: pathlib.Path
-    """The path to the file to split."""
-    training: pathlib.Path
-    """The filename to write the training sample to."""
-    holdout: pathlib.Path
-    """The filename to write the holdout sample to."""
-    seed: int = None
-    """The seed to use when splitting """
+    input: List[pathlib.Path]
+    """The paths to the files to split."""
+    training: pathlib.Path = None
+    """The filename to write the training sample to (with a single input, instead of --output)."""
+    holdout: pathlib.Path = None
+    """The filename to write the holdout sample to (with a single input, instead of --output)."""
+    output: str = 'vocabularies/{split}/{name}'
+    """Where to write each split of each input, with {split} replaced by the name of the split and {name} by the file name of the input."""
+    splits: List[str] = ['training', 'holdout']
+    """The names of the splits."""
+    ratios: List[float] = None
+    """The ratio of lines to put in each split (by default 1 - holdout_size and holdout_size)."""
+    seed: int = 0
+    """The key of the hash that assigns lines to splits (the same key always splits a line the same way)."""
     holdout_size: float = 0.1
     """The ratio of lines to include in the holdout sample."""
+    processes: int = None
+    """The number of files to split at the same time (by default one per CPU)."""
     verbose: bool = False
     """Whether to output debugging information"""
 
+def split_bounds(ratios: List[float]) -> List[int]:
+    """split_bounds gives the upper bound of the 64-bit hashes of the lines in each split but the last."""
+    total = sum(ratios)
+    bounds = []
+    cumulative = 0.0
+    for ratio in ratios[:-1]:
+        cumulative += ratio / total
+        bounds.append(min(round(cumulative * 2 ** 64), 2 ** 64))
+    return bounds
+
+def split_file(job: Tuple[pathlib.Path, List[pathlib.Path], bytes, List[int]]) -> Tuple[pathlib.Path, List[int]]:
+    """split_file writes each line of a file to the output of the split its hash falls in,
+    giving the number of lines written to each."""
+    source_path, output_paths, key, bounds = job
+    counts = [0] * len(output_paths)
+    outputs = []
+    try:
+        for path in output_paths:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            outputs.append(open(path, 'wb', buffering=1 << 20))
+        with open(source_path, 'rb', buffering=1 << 20) as source:
+            for line in source:
+                # Lines are hashed without their line ending, so a file saved with other line endings splits the same way
+                content = line.rstrip(b'\r\n')
+                digest = hashlib.blake2b(content, key=key, digest_size=8).digest()
+                split = bisect.bisect_right(bounds, int.from_bytes(digest, 'big'))
+                outputs[split].write(line if line.endswith(b'\n') else line + b'\n')
+                counts[split] += 1
+    finally:
+        for output in outputs:
+            output.close()
+    return source_path, counts
+
+def output_paths(args: Arguments, source: pathlib.Path) -> List[pathlib.Path]:
+    """output_paths gives the file to write each split of source to."""
+    explicit: Dict[str, pathlib.Path] = {'training': args.training, 'holdout': args.holdout}
+    return [explicit.get(split) or pathlib.Path(args.output.format(split=split, name=source.name)) for split in args.splits]
+
 def main(args: Arguments):
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG)
 
-    if args.seed:
-        random.seed(args.seed)
-        logging.debug(f'Setting seed to {args.seed}')
-    
-    with open(args.input, 'r', encoding='utf-8') as source:
-        source_lines = source.readlines()
-
-    total_holdout_lines = int(len(source_lines) * args.holdout_size)
-    logging.info(f"Setting aside k={args.holdout_size} of the {len(source_lines)} lines ({total_holdout_lines} lines) for the holdout set")
-    holdout_indices = random.sample(range(len(source_lines)), k=total_holdout_lines)
-
-    training = open(args.training, 'w', encoding='utf-8')
-    holdout = open(args.holdout, 'w', encoding='utf-8')
-    for i, l in enumerate(source_lines):
-        if i in holdout_indices:
-            holdout.write(l)
-        else:
-            training.write(l)
-    training.close()
-    holdout.close()
-    logging.info(f"Wrote training set to {args.training}")
-    logging.info(f"Wrote holdout set to {args.holdout}")
+    ratios = args.ratios
+    if ratios is None:
+        if len(args.splits) != 2:
+            raise ValueError("--ratios must be given for other splits than training and holdout")
+        ratios = [1 - args.holdout_size, args.holdout_size]
+    if len(ratios) != len(args.splits) or any(ratio < 0 for ratio in ratios) or sum(ratios) <= 0:
+        raise ValueError("--ratios must give a non-negative ratio for each of --splits")
+    if len(args.input) > 1 and (args.training is not None or args.holdout is not None):
+        raise ValueError("--training and --holdout can only be used with a single input, use --output instead")
+
+    key = str(args.seed).encode('utf-8')
+    bounds = split_bounds(ratios)
+    jobs = [(source, output_paths(args, source), key, bounds) for source in args.input]
+    written: Dict[pathlib.Path, pathlib.Path] = {}
+    for source, outputs, _, _ in jobs:
+        if source.resolve() in {output.resolve() for output in outputs}:
+            raise ValueError(f"{source} would be overwritten by one of its splits")
+        for output in outputs:
+            if output.resolve() in written:
+                raise ValueError(f"{source} and {written[output.resolve()]} would both be split into {output}, "
+                                 "split them separately")
+            written[output.resolve()] = source
+    logging.info(f"Splitting {len(jobs)} files into {', '.join(f'{s} ({r / sum(ratios):.0%})' for s, r in zip(args.splits, ratios))}")
+
+    processes = min(args.processes or multiprocessing.cpu_count(), len(jobs))
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            results = list(pool.imap_unordered(split_file, jobs))
+    else:
+        results = [split_file(job) for job in jobs]
+
+    outputs = {source: paths for source, paths, _, _ in jobs}
+    for source, counts in sorted(results):
+        total = sum(counts)
+        for split, path, count in zip(args.splits, outputs[source], counts):
+            logging.info(f"Wrote {count} of the {total} lines of {source} ({count / max(total, 1):.1%}) to the {split} set in {path}")
 
 if __name__ == '__main__':
     args = Arguments()
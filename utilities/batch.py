@@ -0,0 +1,77 @@
+"""
+batch.py reads and writes the JSONL files of OpenAI's batch API, so that prompts can be
+completed as one batch (which is cheaper, and not limited by the per-minute budgets)
+instead of one request at a time.
+
+Each line of a request file asks for one chat completion, identified by its custom_id:
+
+    {"custom_id": "0", "method": "POST", "url": "/v1/chat/completions", "body": {"model": ..., "messages": [...], ...}}
+
+and each line of a result file holds the response (or error) for one custom_id, in any order:
+
+    {"id": "...", "custom_id": "0", "response": {"status_code": 200, "body": {<chat completion>}}, "error": null}
+"""
+import dataclasses
+import json
+import pathlib
+from typing import Iterable, Iterator, Optional, Tuple
+
+from utilities.completion import Completion
+
+# COMPLETIONS_URL is the endpoint every request of a batch is sent to
+COMPLETIONS_URL = '/v1/chat/completions'
+# MAX_REQUESTS is the largest number of requests the batch API accepts in one file
+MAX_REQUESTS = 50000
+
+
+@dataclasses.dataclass
+class BatchResult:
+    """BatchResult is the outcome of one request of a batch: a completion, or the error it failed with."""
+    custom_id: str
+    completion: Optional[Completion] = None
+    error: Optional[str] = None
+
+
+def write_requests(path: pathlib.Path, requests: Iterable[Tuple[str, dict]]) -> int:
+    """write_requests writes a request file with a line for each (custom_id, body), returning how many were written."""
+    written = 0
+    with open(path, 'w', encoding='utf8') as request_file:
+        for custom_id, body in requests:
+            request_file.write(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': COMPLETIONS_URL, 'body': body}) + '\n')
+            written += 1
+    return written
+
+
+def read_requests(path: pathlib.Path) -> Iterator[Tuple[str, dict]]:
+    """read_requests yields the custom_id and body of each request in a request file."""
+    with open(path, 'r', encoding='utf8') as request_file:
+        for line in request_file:
+            if line.strip():
+                request = json.loads(line)
+                yield request['custom_id'], request['body']
+
+
+def parse_completion(body: dict) -> Completion:
+    """parse_completion reads the answer, finish reason and token usage from the body of a chat completion."""
+    choice = body['choices'][0]
+    usage = body.get('usage') or {}
+    return Completion(content=choice['message']['content'], finish_reason=choice.get('finish_reason'),
+                      prompt_tokens=usage.get('prompt_tokens'), completion_tokens=usage.get('completion_tokens'))
+
+
+def read_results(path: pathlib.Path) -> Iterator[BatchResult]:
+    """read_results yields the result of each line of a result file (or an error file, whose lines only have errors)."""
+    with open(path, 'r', encoding='utf8') as result_file:
+        for line in result_file:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get('response') or {}
+            if result.get('error') is not None:
+                error = result['error']
+                yield BatchResult(result['custom_id'], error=error.get('message', str(error)) if isinstance(error, dict) else str(error))
+            elif response.get('status_code') != 200:
+                error = (response.get('body') or {}).get('error') or {}
+                yield BatchResult(result['custom_id'], error=f"HTTP {response.get('status_code')}: {error.get('message', 'no message')}")
+            else:
+                yield BatchResult(result['custom_id'], completion=parse_completion(response['body']))
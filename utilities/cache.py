@@ -0,0 +1,215 @@
+"""
+cache.py keeps completed notes in a single SQLite file, keyed by a hash of everything
+that determines the completion (system prompt, prompt, model and sampling parameters).
+
+The database runs in WAL mode, so several threads or processes can read and write
+the cache at the same time.
+"""
+import ast
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS completions (
+    key TEXT PRIMARY KEY,
+    model TEXT,
+    answer TEXT NOT NULL,
+    finish_reason TEXT,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lengths (
+    kind TEXT NOT NULL,
+    model TEXT NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lengths_kind ON lengths (model, kind, created);
+"""
+
+# _LENGTH_HISTORY is the number of most recent lengths kept for each kind of note
+_LENGTH_HISTORY = 1000
+
+
+def cache_key(system_prompt: str, prompt: str, model: str, max_tokens: int, temperature: float, top_p: float,
+              attempt: int = 0) -> str:
+    """cache_key hashes the parameters of a completion request to the key it is cached under. Further attempts
+    at the same request (e.g. notes requested again by validate-coverage.py) are cached under keys of their own,
+    and the first attempt under the key of the request alone."""
+    fields = [system_prompt, prompt, model, max_tokens, float(temperature), float(top_p)]
+    parameters = json.dumps(fields + [attempt] if attempt else fields)
+    return hashlib.sha256(parameters.encode('utf8')).hexdigest()
+
+
+@dataclasses.dataclass
+class CacheCounts:
+    """CacheCounts counts the hits and misses of some of the lookups in a cache (e.g. those of one run,
+    when several runs share the cache)."""
+    hits: int = 0
+    misses: int = 0
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total > 0 else 0.0
+        return f"Completion cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate)"
+
+
+class CompletionCache:
+    """CompletionCache stores completions by key in a SQLite database at `path`,
+    counting hits and misses. Every thread gets its own connection."""
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def __contains__(self, key: str) -> bool:
+        row = self._connection().execute('SELECT 1 FROM completions WHERE key = ?', (key,)).fetchone()
+        return row is not None
+
+    def get(self, key: str, counts: CacheCounts = None) -> Optional[str]:
+        """get returns the cached answer for a key, or None if it hasn't been completed.
+        The lookup is also counted in the given counts, if any."""
+        connection = self._connection()
+        row = connection.execute('SELECT answer FROM completions WHERE key = ?', (key,)).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                if counts is not None:
+                    counts.misses += 1
+                return None
+            self.hits += 1
+            if counts is not None:
+                counts.hits += 1
+        connection.execute('UPDATE completions SET accessed = ? WHERE key = ?', (time.time(), key))
+        return row[0]
+
+    def finish_reason(self, key: str) -> Optional[str]:
+        """finish_reason returns why the model stopped writing the cached answer for a key ('length' if it was cut off)."""
+        row = self._connection().execute('SELECT finish_reason FROM completions WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, key: str, answer: str, model: str = None, finish_reason: str = None,
+            prompt_tokens: int = None, completion_tokens: int = None, created: float = None):
+        now = time.time()
+        self._connection().execute(
+            'INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (key, model, answer, finish_reason, prompt_tokens, completion_tokens,
+             len(answer.encode('utf8')), created or now, now))
+
+    def record_length(self, kind: str, model: str, completion_tokens: int):
+        """record_length stores the number of tokens a complete note of some kind (e.g. its type and language) took."""
+        self._connection().execute('INSERT INTO lengths VALUES (?, ?, ?, ?)', (kind, model, completion_tokens, time.time()))
+
+    def lengths(self, model: str) -> Dict[str, List[int]]:
+        """lengths gives the most recent lengths recorded for each kind of note written by a model."""
+        rows = self._connection().execute(
+            'SELECT kind, completion_tokens FROM (SELECT kind, completion_tokens, '
+            'ROW_NUMBER() OVER (PARTITION BY kind ORDER BY created DESC) AS age FROM lengths WHERE model = ?) '
+            'WHERE age <= ?', (model, _LENGTH_HISTORY)).fetchall()
+        found = {}
+        for kind, completion_tokens in rows:
+            found.setdefault(kind, []).append(completion_tokens)
+        return found
+
+    def evict(self, max_entries: int = None, max_bytes: int = None, max_age_days: float = None) -> int:
+        """evict removes entries created more than max_age_days ago, then the least recently
+        used entries until at most max_entries entries and max_bytes bytes of answers remain.
+        Returns the number of entries removed."""
+        connection = self._connection()
+        removed = 0
+        if max_age_days is not None:
+            cutoff = time.time() - max_age_days * 24 * 3600
+            removed += connection.execute('DELETE FROM completions WHERE created < ?', (cutoff,)).rowcount
+        if max_entries is not None:
+            removed += connection.execute(
+                'DELETE FROM completions WHERE key IN '
+                '(SELECT key FROM completions ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (max_entries,)).rowcount
+        if max_bytes is not None:
+            # Keep the most recently used entries whose running total of sizes fits within max_bytes
+            removed += connection.execute(
+                'DELETE FROM completions WHERE key IN (SELECT key FROM '
+                '(SELECT key, SUM(size) OVER (ORDER BY accessed DESC, key) AS total FROM completions) '
+                'WHERE total > ?)', (max_bytes,)).rowcount
+        if removed > 0:
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return removed
+
+    def save_counters(self):
+        """save_counters adds the hits and misses counted so far to the totals stored in the cache."""
+        connection = self._connection()
+        with self._lock:
+            for name, value in [('hits', self.hits), ('misses', self.misses)]:
+                connection.execute('INSERT INTO counters VALUES (?, ?) '
+                                   'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value', (name, value))
+            self.hits, self.misses = 0, 0
+
+    def stats(self) -> dict:
+        """stats describes the size of the cache and the hits and misses stored in it."""
+        connection = self._connection()
+        entries, total_bytes = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions').fetchone()
+        counters = dict(connection.execute('SELECT name, value FROM counters').fetchall())
+        hits, misses = counters.get('hits', 0), counters.get('misses', 0)
+        return {'entries': entries, 'bytes': total_bytes, 'hits': hits, 'misses': misses,
+                'hit_rate': hits / (hits + misses) if hits + misses > 0 else 0.0}
+
+    def summary(self) -> str:
+        """summary describes the hits and misses counted since the last save_counters."""
+        return CacheCounts(self.hits, self.misses).summary()
+
+    def import_joblib(self, directory: pathlib.Path, system_prompt: str) -> int:
+        """import_joblib copies the completions cached by joblib.Memory(directory).cache(_complete)
+        in earlier versions of generate.py, assuming they were made with `system_prompt`.
+        Returns the number of completions imported."""
+        import joblib
+
+        imported = 0
+        connection = self._connection()
+        connection.execute('BEGIN')
+        for metadata_path in pathlib.Path(directory).glob('joblib/*/_complete/*/metadata.json'):
+            output_path = metadata_path.parent / 'output.pkl'
+            if not output_path.exists():
+                continue
+            try:
+                with open(metadata_path, 'r', encoding='utf8') as metadata_file:
+                    metadata = json.load(metadata_file)
+                arguments = {k: ast.literal_eval(v) for k, v in metadata['input_args'].items()}
+                answer = joblib.load(output_path)
+            except (ValueError, SyntaxError, KeyError, EOFError) as error:
+                logging.warning(f"Skipping unreadable cache entry {metadata_path.parent}: {error}")
+                continue
+            key = cache_key(system_prompt, arguments['prompt'], arguments['model'], arguments['max_tokens'],
+                            arguments['temperature'], arguments['topP'])
+            self.put(key, answer, model=arguments['model'], created=metadata.get('time'))
+            imported += 1
+        connection.execute('COMMIT')
+        return imported
@@ -0,0 +1,231 @@
+"""
+completion.py drives chat completion requests concurrently, keeping the number
+of requests in flight bounded and staying within the request and token budgets
+of the API.
+"""
+import asyncio
+import concurrent.futures
+import dataclasses
+import email.utils
+import logging
+import math
+import random
+import threading
+import time
+from typing import AsyncIterator, Callable, Iterable, List, Optional, Tuple
+
+# Status codes worth retrying: rate limiting, and transient server errors.
+_RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# Backoff jitter gets its own generator so retries don't disturb the seeded global one.
+_jitter = random.Random()
+
+
+def estimate_tokens(text: str) -> int:
+    """estimate_tokens gives a rough token count for a text (about four characters per token),
+    which is good enough for budgeting requests without loading a tokenizer."""
+    return math.ceil(len(text) / 4)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """retry_after reads the number of seconds the server asked us to wait
+    from the Retry-After header of a failed request, if any."""
+    headers = getattr(error, 'headers', None) or {}
+    value = headers.get('retry-after') or headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_date.timestamp() - time.time())
+
+
+def is_retryable(error: Exception) -> bool:
+    """is_retryable decides whether a failed request should be attempted again."""
+    import openai.error
+    if isinstance(error, (openai.error.RateLimitError, openai.error.Timeout,
+                          openai.error.APIConnectionError, openai.error.ServiceUnavailableError)):
+        return True
+    return getattr(error, 'http_status', None) in _RETRYABLE_STATUS
+
+
+class RateLimiter:
+    """RateLimiter is a token bucket holding at most `per_minute` units,
+    refilled continuously at `per_minute` units per minute. It may be shared
+    by engines running on different threads."""
+    def __init__(self, per_minute: Optional[float]):
+        self.capacity = per_minute
+        self.available = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    async def acquire(self, amount: float = 1.0):
+        if self.capacity is None:
+            return
+        # A single request larger than the whole budget would wait forever,
+        # so we let it through once the bucket is full.
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60)
+                self.updated = now
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                missing = amount - self.available
+            await asyncio.sleep(missing * 60 / self.capacity)
+
+
+@dataclasses.dataclass
+class Completion:
+    """Completion is the answer to a chat completion request, with what it cost."""
+    content: str
+    finish_reason: Optional[str] = None
+    """Why the model stopped ('stop', or 'length' if it ran out of tokens)."""
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+
+
+@dataclasses.dataclass
+class EngineStats:
+    """EngineStats summarizes the requests made by a CompletionEngine."""
+    completed: int = 0
+    """The number of prompts that have been completed."""
+    cached: int = 0
+    """The number of prompts that were answered without a request (cache hits, dry runs)."""
+    requests: int = 0
+    """The number of requests sent, including retries."""
+    retries: int = 0
+    """The number of requests that had to be repeated."""
+    rate_limited: int = 0
+    """The number of requests rejected with HTTP 429."""
+    elapsed: float = 0.0
+    """Wall time spent completing prompts, in seconds."""
+
+    def summary(self) -> str:
+        per_second = self.completed / self.elapsed if self.elapsed > 0 else 0.0
+        requests_per_minute = 60 * self.requests / self.elapsed if self.elapsed > 0 else 0.0
+        return (f"Completed {self.completed} prompts in {self.elapsed:.1f}s "
+                f"({per_second:.2f} prompts/s, {requests_per_minute:.1f} requests/min); "
+                f"{self.cached} cached, {self.requests} requests, {self.retries} retries, "
+                f"{self.rate_limited} rate limited")
+
+
+class CompletionEngine:
+    """CompletionEngine calls a blocking completion function from a pool of threads,
+    with at most `concurrency` prompts in flight at any time.
+
+    Requests are throttled by the requests-per-minute and tokens-per-minute budgets,
+    and failed requests are retried with exponential backoff (or as long as the server
+    asks us to wait through Retry-After). Prompts for which `is_cached` returns True
+    are answered without touching the budgets. Engines given the same `limiters` (the
+    request and token buckets) share one budget instead of each having its own."""
+    def __init__(self, complete: Callable[[str], str],
+                 concurrency: int = 8,
+                 requests_per_minute: Optional[float] = None,
+                 tokens_per_minute: Optional[float] = None,
+                 max_tokens: int = 0,
+                 max_retries: int = 6,
+                 is_cached: Optional[Callable[[str], bool]] = None,
+                 limiters: Optional[Tuple[RateLimiter, RateLimiter]] = None):
+        if concurrency < 1:
+            raise ValueError(f"Concurrency must be at least 1, got {concurrency}")
+        self.complete = complete
+        self.concurrency = concurrency
+        self.max_tokens = max_tokens
+        self.max_retries = max_retries
+        self.is_cached = is_cached
+        if limiters is None:
+            limiters = RateLimiter(requests_per_minute), RateLimiter(tokens_per_minute)
+        self.requests, self.tokens = limiters
+        self.stats = EngineStats()
+        self._resume_at = 0.0
+        self._loop = None
+
+    async def stream(self, prompts: Iterable[Tuple[int, str]]) -> AsyncIterator[Tuple[int, str]]:
+        """stream completes (index, prompt) pairs, yielding (index, answer) pairs
+        in the order they finish. The prompts are consumed lazily, so only
+        `concurrency` of them are held at a time."""
+        loop = asyncio.get_running_loop()
+        self._loop = loop
+        started = time.monotonic()
+        pending = set()
+        prompt_iterator = iter(prompts)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            try:
+                while True:
+                    while len(pending) < self.concurrency:
+                        next_prompt = next(prompt_iterator, None)
+                        if next_prompt is None:
+                            break
+                        index, prompt = next_prompt
+                        pending.add(asyncio.ensure_future(self._complete_one(loop, executor, index, prompt)))
+                    if not pending:
+                        break
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        self.stats.completed += 1
+                        yield task.result()
+            finally:
+                for task in pending:
+                    task.cancel()
+                self._loop = None
+                self.stats.elapsed += time.monotonic() - started
+
+    async def _complete_one(self, loop, executor, index: int, prompt: str) -> Tuple[int, str]:
+        for attempt in range(self.max_retries + 1):
+            # A cached answer takes no request of its own (though continuing it may, see throttle), and
+            # neither does a retry that finds the part of the answer cached before the attempt failed
+            cached = self.is_cached is not None and self.is_cached(prompt)
+            if cached and attempt == 0:
+                self.stats.cached += 1
+            if not cached:
+                await self._admit(estimate_tokens(prompt) + self.max_tokens)
+            try:
+                answer = await loop.run_in_executor(executor, self.complete, prompt)
+                return index, answer
+            except Exception as error:
+                if attempt == self.max_retries or not is_retryable(error):
+                    raise
+                if getattr(error, 'http_status', None) == 429:
+                    self.stats.rate_limited += 1
+                self.stats.retries += 1
+                delay = retry_after(error)
+                if delay is None:
+                    delay = min(60.0, 2 ** attempt) * (0.5 + _jitter.random() / 2)
+                # Every worker should back off when the server tells us to slow down,
+                # not just the one that got the error.
+                self._resume_at = max(self._resume_at, time.monotonic() + delay)
+                logging.debug(f"Request for prompt {index} failed ({error}), retrying in {delay:.1f}s")
+
+    async def _admit(self, tokens: int):
+        """_admit waits until the budgets allow a request of the given number of tokens, and counts it."""
+        await self.requests.acquire(1)
+        await self.tokens.acquire(tokens)
+        wait = self._resume_at - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self.stats.requests += 1
+
+    def throttle(self, tokens: int):
+        """throttle is called by the completion function, on its own thread, before each further request it makes
+        for a prompt (e.g. to continue an answer that was cut off). It waits until the budgets allow the request,
+        and counts it with the requests of the engine."""
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._admit(tokens), self._loop).result()
+
+    def complete_all(self, prompts: List[str]) -> List[str]:
+        """complete_all completes every prompt, returning the answers in the same order as the prompts."""
+        async def collect():
+            answers = [None] * len(prompts)
+            async for index, answer in self.stream(enumerate(prompts)):
+                answers[index] = answer
+            return answers
+        return asyncio.run(collect())
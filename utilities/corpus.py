@@ -0,0 +1,325 @@
+"""
+corpus.py stores the results of generate.py in a columnar file that is memory-mapped
+instead of parsed, so reading one note, or a slice of them, takes the same time however
+large the corpus is, and the columns are read without copying them.
+
+A corpus file (e.g. dataset/training.corpus) starts with a header and a JSON table of
+contents, followed by the columns, each aligned to 8 bytes:
+
+- each section of the results (scenarios as JSON, prompts, results and cleaned_results),
+  and the text of the cleaned results with the tags removed, is a text column: a UTF-8
+  buffer, the offsets of each element in it (n + 1 uint64) and whether each element is
+  null (n uint8)
+- the tags of the cleaned results are span columns: their start and end (as character
+  offsets into the text), label id (into the labels in the table of contents) and whether
+  they are outside of every other tag, with the offsets of the spans of each note. The
+  redacted text is made from these when a note is read
+- truncated is an int8 column (-1 where it is unknown), and text.hash holds a hash of the
+  text of each note, to find a note by its text
+"""
+import array
+import hashlib
+import json
+import mmap
+import os
+import pathlib
+import struct
+import tempfile
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import utilities.records
+import utilities.stream
+from utilities.tags import ParsedNote, parse_note
+
+_MAGIC = b'NOTECORP'
+# magic, length of the table of contents
+_HEADER = struct.Struct('<8sQ')
+_ALIGNMENT = 8
+# TEXT_SECTIONS are the sections of the results stored as text columns
+TEXT_SECTIONS = ['scenarios', 'prompts', 'results', 'cleaned_results']
+
+
+def is_corpus(path: pathlib.Path) -> bool:
+    return str(path).endswith('.corpus')
+
+
+def text_hash(text: str) -> int:
+    """text_hash gives the 64-bit hash of a text stored in the text.hash column."""
+    return int.from_bytes(hashlib.blake2b(text.encode('utf8'), digest_size=8).digest(), 'little')
+
+
+class TextColumn:
+    """TextColumn gives random access to the elements of a text column (as str, or None for nulls),
+    decoding only the elements that are read. Slicing gives a list."""
+    def __init__(self, data: memoryview, offsets: np.ndarray, nulls: np.ndarray, decode: Callable[[str], Any] = None):
+        self._data = data
+        self._offsets = offsets
+        self._nulls = nulls
+        self._decode = decode
+
+    def __len__(self) -> int:
+        return len(self._nulls)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Corpus index {i} out of range")
+        if self._nulls[i]:
+            return None
+        value = str(self._data[self._offsets[i]:self._offsets[i + 1]], 'utf8')
+        return self._decode(value) if self._decode is not None else value
+
+    def __iter__(self) -> Iterator:
+        return (self[i] for i in range(len(self)))
+
+
+class CorpusFile:
+    """CorpusFile reads a corpus file, memory-mapping its columns."""
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        with open(path, 'rb') as corpus_file:
+            self._mapped = mmap.mmap(corpus_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, contents_length = _HEADER.unpack_from(self._mapped)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a corpus file")
+        contents = json.loads(bytes(self._mapped[_HEADER.size:_HEADER.size + contents_length]))
+        self._data_start = _aligned(_HEADER.size + contents_length)
+        self._columns: Dict[str, dict] = contents['columns']
+        self.parameters: dict = contents['parameters']
+        self.labels: List[str] = contents['labels']
+        self.sections: List[str] = contents['sections']
+        """The sections of the results the corpus was built from."""
+        self._count = contents['count']
+        self._arrays: Dict[str, np.ndarray] = {}
+        self._text_columns: Dict[str, TextColumn] = {}
+
+    def __len__(self) -> int:
+        return self._count
+
+    def array(self, name: str) -> np.ndarray:
+        """array gives a column as a (read-only) NumPy array backed by the mapped file."""
+        if name not in self._arrays:
+            column = self._columns[name]
+            self._arrays[name] = np.frombuffer(self._mapped, dtype=column['dtype'], count=column['length'],
+                                               offset=self._data_start + column['offset'])
+        return self._arrays[name]
+
+    def text_column(self, name: str) -> TextColumn:
+        """text_column gives a text column, with the scenarios decoded from JSON."""
+        if name not in self._text_columns:
+            data = self._columns[f'{name}.data']
+            start = self._data_start + data['offset']
+            self._text_columns[name] = TextColumn(memoryview(self._mapped)[start:start + data['length']],
+                                                  self.array(f'{name}.offsets'), self.array(f'{name}.null'),
+                                                  json.loads if name == 'scenarios' else None)
+        return self._text_columns[name]
+
+    def section(self, section: str):
+        """section gives the elements of a section of the results (e.g. 'cleaned_results') as a sequence,
+        raising a KeyError for sections the corpus was not built from."""
+        if section not in self.sections:
+            raise KeyError(section)
+        if section == 'truncated':
+            return [None if value < 0 else bool(value) for value in self.array('truncated').tolist()]
+        return self.text_column(section)
+
+    def span_arrays(self, i: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """span_arrays gives the starts, ends, label ids and outermost flags of the spans of a note, without copying them."""
+        offsets = self.array('spans.offsets')
+        start, end = offsets[i], offsets[i + 1]
+        return (self.array('spans.start')[start:end], self.array('spans.end')[start:end],
+                self.array('spans.label')[start:end], self.array('spans.outermost')[start:end])
+
+    def spans(self, i: int) -> List[Tuple[int, int, str]]:
+        """spans gives the (start, end, label) of the tags of a note, like utilities.tags.list_annotations."""
+        starts, ends, labels, _ = self.span_arrays(i)
+        return [(start, end, self.labels[label]) for start, end, label in zip(starts.tolist(), ends.tolist(), labels.tolist())]
+
+    def parsed(self, i: int) -> Optional[ParsedNote]:
+        """parsed gives a note as utilities.tags.parse_note would parse it, without parsing it."""
+        text = self.text_column('text')[i]
+        if text is None:
+            return None
+        starts, ends, labels, outermost = (column.tolist() for column in self.span_arrays(i))
+        names = [self.labels[label] for label in labels]
+        redacted, destroyed = [], []
+        position = 0
+        for start, end, name, outer in zip(starts, ends, names, outermost):
+            if outer:
+                redacted += [text[position:start], f'[{name}]']
+                destroyed.append(text[position:start])
+                position = end
+        redacted.append(text[position:])
+        destroyed.append(text[position:])
+        tag_counts = {}
+        for name in names:
+            tag_counts[name] = tag_counts.get(name, 0) + 1
+        diagnostics = self.text_column('diagnostics')[i]
+        return ParsedNote(text=text, redacted=''.join(redacted), destroyed=''.join(destroyed),
+                          spans=list(zip(starts, ends, names)), tag_counts=tag_counts,
+                          diagnostics=diagnostics.split('\n') if diagnostics else [], outermost=[bool(o) for o in outermost])
+
+    def find(self, text: str) -> Optional[int]:
+        """find gives the index of the first note with the given text (with the tags removed), or None."""
+        for i in np.flatnonzero(self.array('text.hash') == np.uint64(text_hash(text))).tolist():
+            if self.text_column('text')[i] == text:
+                return i
+        return None
+
+
+class _Writer:
+    """_Writer writes the columns of a corpus to temporary files one at a time,
+    and the corpus file with all of them when it is closed."""
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self._directory = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path)))
+        self._columns: Dict[str, dict] = {}
+
+    def _column_file(self, name: str):
+        return open(os.path.join(self._directory.name, f'{name}.column'), 'wb')
+
+    def add_array(self, name: str, values: np.ndarray):
+        with self._column_file(name) as column_file:
+            column_file.write(values.tobytes())
+            self._columns[name] = {'dtype': values.dtype.str, 'length': len(values), 'file': column_file.name}
+
+    def add_text(self, name: str, values: Iterable[Optional[str]]) -> int:
+        """add_text writes a text column, giving the number of elements it has."""
+        offsets = array.array('Q', [0])
+        nulls = bytearray()
+        with self._column_file(f'{name}.data') as data_file:
+            for value in values:
+                encoded = b'' if value is None else value.encode('utf8')
+                data_file.write(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+                nulls.append(value is None)
+        self._columns[f'{name}.data'] = {'dtype': '|u1', 'length': offsets[-1], 'file': data_file.name}
+        self.add_array(f'{name}.offsets', np.frombuffer(offsets, dtype='<u8'))
+        self.add_array(f'{name}.null', np.frombuffer(bytes(nulls), dtype='|u1'))
+        return len(nulls)
+
+    def close(self, contents: dict):
+        offset = 0
+        for column in self._columns.values():
+            column['offset'] = offset
+            offset = _aligned(offset + column['length'] * np.dtype(column['dtype']).itemsize)
+        encoded = json.dumps({**contents, 'columns': {name: {k: v for k, v in column.items() if k != 'file'}
+                                                      for name, column in self._columns.items()}}).encode('utf8')
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'wb') as corpus_file:
+            corpus_file.write(_HEADER.pack(_MAGIC, len(encoded)))
+            corpus_file.write(encoded)
+            data_start = _aligned(_HEADER.size + len(encoded))
+            for column in self._columns.values():
+                corpus_file.write(b'\0' * (data_start + column['offset'] - corpus_file.tell()))
+                with open(column['file'], 'rb') as column_file:
+                    while chunk := column_file.read(1 << 20):
+                        corpus_file.write(chunk)
+        os.replace(temporary_path, self.path)
+        self._directory.cleanup()
+
+
+def _aligned(offset: int) -> int:
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def import_results(results_path: pathlib.Path, corpus_path: pathlib.Path) -> int:
+    """import_results builds a corpus from the results (or a record file) of generate.py, reading one
+    section at a time, and gives the number of notes in it."""
+    writer = _Writer(corpus_path)
+    sections = []
+    count = None
+    for section in TEXT_SECTIONS:
+        elements = utilities.stream.iterate_section(results_path, section)
+        try:
+            first = next(elements, _END)
+        except KeyError:
+            continue
+        values = _prepend(first, elements) if first is not _END else iter([])
+        if section == 'scenarios':
+            values = (None if scenario is None else json.dumps(scenario, ensure_ascii=False) for scenario in values)
+        length = writer.add_text(section, values)
+        if count is not None and length != count:
+            raise ValueError(f"The {section} of {results_path} have {length} elements, but the other sections {count}")
+        count = length
+        sections.append(section)
+    if count is None:
+        raise ValueError(f"{results_path} has none of the sections {', '.join(TEXT_SECTIONS)}")
+
+    truncated = np.full(count, -1, dtype=np.int8)
+    try:
+        for i, value in enumerate(utilities.stream.iterate_section(results_path, 'truncated')):
+            truncated[i] = -1 if value is None else int(value)
+        sections.append('truncated')
+    except KeyError:
+        pass
+    writer.add_array('truncated', truncated)
+
+    labels: Dict[str, int] = {}
+    span_offsets = array.array('Q', [0])
+    starts, ends, label_ids, outermost = array.array('I'), array.array('I'), array.array('H'), array.array('B')
+    hashes = array.array('Q')
+    diagnostics = []
+
+    def texts() -> Iterator[Optional[str]]:
+        notes = utilities.stream.iterate_section(results_path, 'cleaned_results') if 'cleaned_results' in sections else [None] * count
+        for note in notes:
+            parsed = None if note is None else parse_note(note)
+            if parsed is not None:
+                starts.extend(start for start, _, _ in parsed.spans)
+                ends.extend(end for _, end, _ in parsed.spans)
+                label_ids.extend(labels.setdefault(label, len(labels)) for _, _, label in parsed.spans)
+                outermost.extend(parsed.outermost)
+                diagnostics.append('\n'.join(parsed.diagnostics) if parsed.diagnostics else None)
+                hashes.append(text_hash(parsed.text))
+                yield parsed.text
+            else:
+                diagnostics.append(None)
+                hashes.append(0)
+                yield None
+            span_offsets.append(len(starts))
+
+    writer.add_text('text', texts())
+    writer.add_text('diagnostics', diagnostics)
+    for name, values, dtype in [('spans.offsets', span_offsets, '<u8'), ('spans.start', starts, '<u4'),
+                                ('spans.end', ends, '<u4'), ('spans.label', label_ids, '<u2'),
+                                ('spans.outermost', outermost, '|u1'), ('text.hash', hashes, '<u8')]:
+        writer.add_array(name, np.frombuffer(values, dtype=dtype) if len(values) else np.zeros(0, dtype=dtype))
+    try:
+        parameters = utilities.stream.read_parameters(results_path)
+    except KeyError:
+        parameters = {}
+    writer.close({'version': 1, 'count': count, 'sections': sections, 'labels': list(labels), 'parameters': parameters})
+    return count
+
+
+# _END marks the end of a section that has no elements
+_END = object()
+
+
+def _prepend(first, elements: Iterator) -> Iterator:
+    yield first
+    yield from elements
+
+
+def export_results(corpus_path: pathlib.Path, results_path: pathlib.Path):
+    """export_results writes a corpus back to the JSON layout of generate.py, with the sections it was built from."""
+    corpus = CorpusFile(corpus_path)
+    with open(results_path, 'w', encoding='utf8') as output:
+        output.write('{"parameters": ')
+        json.dump(corpus.parameters, output)
+        for section in utilities.records.SECTIONS:
+            if section not in corpus.sections:
+                continue
+            output.write(f', "{section}": [')
+            for i, element in enumerate(corpus.section(section)):
+                if i > 0:
+                    output.write(', ')
+                json.dump(element, output)
+            output.write(']')
+        output.write('}')
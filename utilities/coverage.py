@@ -0,0 +1,206 @@
+"""
+coverage.py checks that generated notes mention the patient details of their scenarios,
+and that they are tagged with the right label.
+
+The values of many notes are found together with an Aho-Corasick automaton, which finds
+every occurrence of any of its patterns in a single pass over a text. Values are matched
+case-insensitively, on word boundaries, and in the common ways of writing them (e.g. a date
+as '30. desember 1990' or '30.12.1990').
+"""
+import collections
+import dataclasses
+import datetime
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+
+from utilities.scenarios import DATE_FORMAT
+from utilities.tags import parse_note
+
+# FIELDS maps the scenario fields that must be mentioned in a note to the label they must be tagged with
+FIELDS = {
+    'givenName': 'First_Name',
+    'familyName': 'Last_Name',
+    'phoneNumber': 'Phone_Number',
+    'socialSecurityNumber': 'Social_Security_Number',
+    'birthDate': 'Date',
+    'healthCareUnit': 'Health_Care_Unit',
+    'city': 'Location',
+}
+
+# The status of a field, from best to worst
+TAGGED = 'tagged'
+MISLABELED = 'mislabeled'
+UNTAGGED = 'untagged'
+MISSING = 'missing'
+STATUSES = [TAGGED, MISLABELED, UNTAGGED, MISSING]
+
+_NORWEGIAN_MONTHS = ['januar', 'februar', 'mars', 'april', 'mai', 'juni', 'juli', 'august',
+                     'september', 'oktober', 'november', 'desember']
+
+
+class Automaton:
+    """Automaton finds all occurrences of a set of patterns in a text in one pass (Aho-Corasick)."""
+    def __init__(self, patterns: Sequence[str]):
+        self.patterns = list(patterns)
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail = [0]
+        # The patterns ending at each state, including those of the states its failure links lead to
+        self._output: List[List[int]] = [[]]
+        for pattern_id, pattern in enumerate(self.patterns):
+            state = 0
+            for character in pattern:
+                following = self._goto[state].get(character)
+                if following is None:
+                    following = len(self._goto)
+                    self._goto[state][character] = following
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = following
+            self._output[state].append(pattern_id)
+
+        # The states right below the root fail back to it, and every deeper state to the longest
+        # proper suffix of its path that is also a path from the root
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, following in self._goto[state].items():
+                queue.append(following)
+                fallback = self._fail[state]
+                while fallback and character not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[following] = self._goto[fallback].get(character, 0)
+                self._output[following] = self._output[following] + self._output[self._fail[following]]
+
+    def search(self, text: str) -> Iterator[Tuple[int, int, int]]:
+        """search yields the (start, end, pattern id) of every occurrence of a pattern in text."""
+        goto, fail, output, patterns = self._goto, self._fail, self._output, self.patterns
+        state = 0
+        for position, character in enumerate(text):
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            for pattern_id in output[state]:
+                yield position + 1 - len(patterns[pattern_id]), position + 1, pattern_id
+
+
+def fold_case(text: str) -> str:
+    """fold_case lower-cases a text, keeping the characters whose lower case is longer as they are,
+    so that offsets into the folded text are offsets into the text."""
+    folded = text.lower()
+    if len(folded) == len(text):
+        return folded
+    return ''.join(c.lower() if len(c.lower()) == 1 else c for c in text)
+
+
+def value_variants(field: str, value: str, locale: str) -> List[str]:
+    """value_variants lists the ways a scenario value may be written in a note, with their case folded."""
+    variants = {value}
+    if field == 'birthDate':
+        try:
+            date = datetime.datetime.strptime(value, DATE_FORMAT).date()
+        except ValueError:
+            date = None
+        if date is not None:
+            variants |= _date_variants(date, locale)
+    elif field in ('phoneNumber', 'socialSecurityNumber'):
+        digits = ''.join(c for c in value if c.isdigit())
+        variants.add(digits)
+        if len(digits) == 8:
+            variants |= {f'{digits[:2]} {digits[2:4]} {digits[4:6]} {digits[6:]}', f'{digits[:3]} {digits[3:5]} {digits[5:]}'}
+        elif len(digits) == 11:
+            variants.add(f'{digits[:6]} {digits[6:]}')
+    return sorted({fold_case(v) for v in variants if v})
+
+
+def _date_variants(date: datetime.date, locale: str) -> set:
+    """_date_variants writes a date with the month as a number, and named in English (which prompts use)
+    and, for Norwegian notes, in Norwegian, with the punctuation models tend to use."""
+    day, month, year = date.day, date.month, date.year
+    variants = {f'{day:02d}.{month:02d}.{year}', f'{day}.{month}.{year}', f'{year}-{month:02d}-{day:02d}'}
+    if locale == 'nb':
+        variants |= {f'{day:02d}/{month:02d}/{year}', f'{day}/{month}/{year}'}
+    else:
+        variants |= {f'{month:02d}/{day:02d}/{year}', f'{month}/{day}/{year}'}
+    names = [date.strftime('%B')] + ([_NORWEGIAN_MONTHS[month - 1]] if locale == 'nb' else [])
+    for name in names:
+        for day_name in {str(day), f'{day:02d}'}:
+            variants |= {f'{day_name}. {name} {year}', f'{day_name}. {name}, {year}', f'{day_name}. {name}. {year}',
+                         f'{day_name} {name} {year}', f'{name} {day_name}, {year}', f'{name} {day_name}. {year}',
+                         f'{name} {day_name} {year}'}
+    return variants
+
+
+@dataclasses.dataclass
+class NoteCoverage:
+    """NoteCoverage describes how well a note covers the values of its scenario."""
+    fields: Dict[str, str]
+    """The status of each field: tagged with the right label, mislabeled, untagged or missing."""
+    found_labels: Dict[str, List[str]]
+    """The labels of the tags around the mislabeled values."""
+
+    @property
+    def coverage(self) -> float:
+        """coverage is the fraction of the fields that are mentioned and tagged with the right label."""
+        return sum(status == TAGGED for status in self.fields.values()) / len(self.fields) if self.fields else 1.0
+
+
+def _is_word_boundary(text: str, start: int, end: int) -> bool:
+    return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+
+def _tag_status(text: str, start: int, end: int, spans: List[Tuple[int, int, str]], label: str) -> Tuple[str, List[str]]:
+    """_tag_status tells how an occurrence of a value is tagged by the spans overlapping it: it is tagged if it is
+    inside a span with the label, or if its parts are (e.g. a health care unit tagged part by part), and
+    mislabeled if any other label overlaps it. Also gives the other labels."""
+    if any(span_start <= start and end <= span_end and span_label == label for span_start, span_end, span_label in spans):
+        return TAGGED, []
+    other_labels = [span_label for _, _, span_label in spans if span_label != label]
+    if other_labels:
+        return MISLABELED, other_labels
+    covered = set()
+    for span_start, span_end, _ in spans:
+        covered.update(range(max(start, span_start), min(end, span_end)))
+    if spans and all(i in covered for i in range(start, end) if text[i].isalnum()):
+        return TAGGED, []
+    return UNTAGGED, []
+
+
+def check_notes(scenarios: Iterable[dict], notes: Iterable[str], chunk_size: int = 2000) -> Iterator[NoteCoverage]:
+    """check_notes yields the coverage of each note of the values of its scenario (as a dict).
+    The notes are checked chunk_size at a time, with one automaton for the values of each chunk."""
+    pairs = zip(scenarios, notes)
+    while True:
+        chunk = [pair for _, pair in zip(range(chunk_size), pairs)]
+        if not chunk:
+            return
+        pattern_ids = {}
+        # The fields that each pattern id is a variant of, for each note
+        owners = []
+        for scenario, _ in chunk:
+            fields = collections.defaultdict(set)
+            for field in FIELDS:
+                value = str(scenario.get(field) or '').strip()
+                if not value:
+                    continue
+                for variant in value_variants(field, value, scenario.get('locale', 'nb')):
+                    fields[pattern_ids.setdefault(variant, len(pattern_ids))].add(field)
+            owners.append(fields)
+        automaton = Automaton(list(pattern_ids))
+
+        for (scenario, note), fields in zip(chunk, owners):
+            expected = {field for variants in fields.values() for field in variants}
+            parsed = parse_note(note or '')
+            statuses = {field: MISSING for field in FIELDS if field in expected}
+            found_labels = collections.defaultdict(list)
+            for start, end, pattern_id in automaton.search(fold_case(parsed.text)):
+                if pattern_id not in fields or not _is_word_boundary(parsed.text, start, end):
+                    continue
+                overlapping = [span for span in parsed.spans if span[0] < end and start < span[1]]
+                for field in fields[pattern_id]:
+                    status, other_labels = _tag_status(parsed.text, start, end, overlapping, FIELDS[field])
+                    if status == MISLABELED:
+                        found_labels[field] += [label for label in other_labels if label not in found_labels[field]]
+                    if STATUSES.index(status) < STATUSES.index(statuses[field]):
+                        statuses[field] = status
+            yield NoteCoverage(fields=statuses,
+                               found_labels={f: labels for f, labels in found_labels.items() if statuses[f] == MISLABELED})
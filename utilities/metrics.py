@@ -0,0 +1,193 @@
+"""
+metrics.py records where the time of a run goes and what it cost: wall time per stage,
+a histogram of request latencies, token usage and other counters. They are written as JSON
+and in the Prometheus text format (for node_exporter's textfile collector).
+
+It can also run a profiler (cProfile or tracemalloc) around a run, to find hot spots.
+"""
+import bisect
+import contextlib
+import dataclasses
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+# LATENCY_BUCKETS are the upper bounds in seconds of the request latency histogram
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120]
+
+
+class Histogram:
+    """Histogram counts observations in buckets with the given upper bounds (plus one for
+    everything larger), like a Prometheus histogram."""
+    def __init__(self, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """quantile estimates a quantile by interpolating within the bucket it falls in."""
+        if self.count == 0:
+            return math.nan
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count > 0:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+                'buckets': {str(b): c for b, c in zip(self.buckets + ['+Inf'], self.counts)}}
+
+
+@dataclasses.dataclass
+class StageTiming:
+    """StageTiming adds up the wall time spent in one stage of a run."""
+    seconds: float = 0.0
+    calls: int = 0
+
+
+class Metrics:
+    """Metrics collects the stage timings, request latencies and counters of a run.
+    It may be updated from several threads."""
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.started = time.time()
+        self.stages: Dict[str, StageTiming] = {}
+        self.latency = Histogram()
+        self.counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, stage: str, calls: int = 1):
+        """timer adds the time spent in its block to a stage, as the given number of calls."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - started, calls)
+
+    def add_time(self, stage: str, seconds: float, calls: int = 1):
+        with self._lock:
+            timing = self.stages.setdefault(stage, StageTiming())
+            timing.seconds += seconds
+            timing.calls += calls
+
+    def observe_latency(self, seconds: float):
+        with self._lock:
+            self.latency.observe(seconds)
+
+    def count(self, name: str, amount: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {'started': self.started, 'elapsed': time.time() - self.started,
+                    'stages': {name: dataclasses.asdict(timing) for name, timing in self.stages.items()},
+                    'request_latency_seconds': self.latency.to_dict(),
+                    'counters': dict(self.counters)}
+
+    def write_json(self, path: str):
+        with open(path, 'w', encoding='utf8') as metrics_file:
+            json.dump(self.to_dict(), metrics_file, indent=2)
+
+    def prometheus_lines(self, labels: Dict[str, str] = None) -> List[str]:
+        """prometheus_lines writes the metrics in the Prometheus text exposition format."""
+        def label_text(extra: Dict[str, str] = None) -> str:
+            merged = {**(labels or {}), **(extra or {})}
+            if not merged:
+                return ''
+            escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in merged.values())
+            return '{' + ','.join(f'{k}="{v}"' for k, v in zip(merged, escaped)) + '}'
+
+        p = self.prefix
+        metrics = self.to_dict()
+        lines = [f'# HELP {p}_stage_seconds_total Wall time spent in each stage of the run.',
+                 f'# TYPE {p}_stage_seconds_total counter']
+        lines += [f'{p}_stage_seconds_total{label_text({"stage": name})} {timing["seconds"]}'
+                  for name, timing in metrics['stages'].items()]
+        lines += [f'# HELP {p}_stage_calls_total The number of times each stage ran.',
+                  f'# TYPE {p}_stage_calls_total counter']
+        lines += [f'{p}_stage_calls_total{label_text({"stage": name})} {timing["calls"]}'
+                  for name, timing in metrics['stages'].items()]
+
+        lines += [f'# HELP {p}_request_latency_seconds The latency of completion requests.',
+                  f'# TYPE {p}_request_latency_seconds histogram']
+        cumulative = 0
+        for bound, count in zip(self.latency.buckets + ['+Inf'], self.latency.counts):
+            cumulative += count
+            lines.append(f'{p}_request_latency_seconds_bucket{label_text({"le": str(bound)})} {cumulative}')
+        lines += [f'{p}_request_latency_seconds_sum{label_text()} {self.latency.sum}',
+                  f'{p}_request_latency_seconds_count{label_text()} {self.latency.count}']
+
+        for name, value in sorted(metrics['counters'].items()):
+            lines += [f'# TYPE {p}_{name}_total counter', f'{p}_{name}_total{label_text()} {value}']
+        lines += [f'# TYPE {p}_last_run_timestamp_seconds gauge',
+                  f'{p}_last_run_timestamp_seconds{label_text()} {self.started}']
+        return lines
+
+    def write_prometheus(self, path: str, labels: Dict[str, str] = None):
+        """write_prometheus writes the metrics to a textfile, replacing it atomically
+        so the collector never reads a partial file."""
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w', encoding='utf8') as prometheus_file:
+            prometheus_file.write('\n'.join(self.prometheus_lines(labels)) + '\n')
+        os.replace(temporary_path, path)
+
+
+@contextlib.contextmanager
+def profiled(kind: Optional[str], path_stem: str, top: int = 25):
+    """profiled runs its block under a profiler: 'cprofile' writes the statistics of the
+    calls made on this thread to <path_stem>.prof, and 'tracemalloc' writes the lines that
+    allocated the most memory still held at the end to <path_stem>.tracemalloc.txt.
+    The top entries are also logged."""
+    if kind is None:
+        yield
+        return
+    if kind == 'cprofile':
+        import cProfile
+        import io
+        import pstats
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(f'{path_stem}.prof')
+            report = io.StringIO()
+            pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(top)
+            logging.info(f"Wrote profile to {path_stem}.prof, top {top} functions by cumulative time:\n{report.getvalue()}")
+    elif kind == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            statistics = snapshot.statistics('lineno')[:top]
+            report = '\n'.join([f'Peak traced memory: {peak / 1e6:.1f} MB'] + [str(s) for s in statistics])
+            with open(f'{path_stem}.tracemalloc.txt', 'w', encoding='utf8') as report_file:
+                report_file.write(report + '\n')
+            logging.info(f"Wrote allocations to {path_stem}.tracemalloc.txt:\n{report}")
+    else:
+        raise ValueError(f"Unknown profiler '{kind}'")
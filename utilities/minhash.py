@@ -0,0 +1,165 @@
+"""
+minhash.py finds near-duplicate texts without comparing every pair of them.
+
+Each text is split into shingles (runs of shingle_size words, hashed), and summarized by a MinHash
+signature: the smallest value of each of num_perm hash functions over its shingles. Two
+signatures agree on a hash function with probability equal to the Jaccard similarity of the
+shingle sets, so the fraction of agreeing values estimates it.
+
+Locality-sensitive hashing (LSH) splits the signatures into bands of rows values. Texts
+whose signatures are identical on any band become candidates, which are then kept if their
+estimated similarity reaches the threshold. Every band is bucketed with one sort, so finding
+the candidates takes O(n log n) time instead of the O(n^2) of comparing all pairs.
+"""
+import re
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+# _WORD matches the words that shingles are made of
+_WORD = re.compile(r'\w+')
+# EMPTY is the value of a signature of a text without words (which is never a duplicate)
+EMPTY = np.uint32(0xFFFFFFFF)
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+def _mix(values: np.ndarray) -> np.ndarray:
+    """_mix scrambles 64-bit values (the finalizer of splitmix64), so that similar inputs get unrelated hashes."""
+    values = values ^ (values >> np.uint64(30))
+    values = values * _MIX_1
+    values = values ^ (values >> np.uint64(27))
+    values = values * _MIX_2
+    return values ^ (values >> np.uint64(31))
+
+
+class MinHasher:
+    """MinHasher computes the MinHash signatures of texts, shingled into runs of shingle_size words."""
+    def __init__(self, num_perm: int = 128, shingle_size: int = 3, seed: int = 1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing: (a * x + b) >> 32 with odd a, computed modulo 2^64
+        self._a = (rng.integers(0, 1 << 63, num_perm, dtype=np.uint64) << np.uint64(1)) | np.uint64(1)
+        self._b = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)
+        self._words = {}
+
+    def word_ids(self, text: str) -> np.ndarray:
+        """word_ids numbers the words of a (case-folded) text, padded with zeros to at least shingle_size
+        words (so that a shorter text is one shingle), or empty if it has none."""
+        words = self._words
+        ids = [words.setdefault(word, len(words) + 1) for word in _WORD.findall(text.lower())]
+        if ids and len(ids) < self.shingle_size:
+            ids += [0] * (self.shingle_size - len(ids))
+        return np.array(ids, dtype=np.uint64)
+
+    def signatures(self, texts: Iterable[str], batch_words: int = 1 << 16) -> Iterator[np.ndarray]:
+        """signatures yields the signatures of texts as (texts, num_perm) arrays of uint32, for a batch
+        of texts at a time. Batches hold about batch_words words, so the hashes of a batch
+        (num_perm 64-bit values per shingle) take a bounded amount of memory."""
+        batch: List[np.ndarray] = []
+        size = 0
+        for text in texts:
+            ids = self.word_ids(text or '')
+            batch.append(ids)
+            size += len(ids)
+            if size >= batch_words:
+                yield self._sign(batch)
+                batch, size = [], 0
+        if batch:
+            yield self._sign(batch)
+
+    def _sign(self, batch: List[np.ndarray]) -> np.ndarray:
+        signatures = np.full((len(batch), self.num_perm), EMPTY, dtype=np.uint32)
+        lengths = np.array([len(ids) for ids in batch])
+        nonempty = np.flatnonzero(lengths)
+        if len(nonempty) == 0:
+            return signatures
+        ids = np.concatenate([batch[i] for i in nonempty])
+        ends = np.cumsum(lengths[nonempty])
+        starts = ends - lengths[nonempty]
+        # The shingles of all texts are hashed together, including those that run across the end
+        # of a text, whose hashes are then replaced by the largest value so they are never a minimum
+        count = len(ids) - self.shingle_size + 1
+        shingles = np.zeros(count, dtype=np.uint64)
+        for offset in range(self.shingle_size):
+            shingles = _mix(shingles ^ ids[offset:offset + count])
+        hashes = self._a[:, None] * shingles[None, :]
+        hashes += self._b[:, None]
+        across = (ends[:, None] - np.arange(1, self.shingle_size)[None, :]).ravel()
+        hashes[:, across[across < count]] = np.iinfo(np.uint64).max
+        # The top 32 bits of the smallest hash are the smallest of the top 32 bits of the hashes
+        signatures[nonempty] = (np.minimum.reduceat(hashes, starts, axis=1) >> np.uint64(32)).T
+        return signatures
+
+
+def collision_probability(similarity: np.ndarray, bands: int, rows: int) -> np.ndarray:
+    """collision_probability gives the probability that texts with the given similarity share a bucket in some band."""
+    return 1 - (1 - similarity ** rows) ** bands
+
+
+def optimal_bands(threshold: float, num_perm: int, false_positive_weight: float = 0.2) -> Tuple[int, int]:
+    """optimal_bands chooses the (bands, rows) that minimize the weighted probability of candidates below
+    the threshold and of missed pairs above it. Candidates are checked against their signatures, so
+    false positives only cost time, and are weighted less by default."""
+    best, best_error = None, None
+    below = np.linspace(0, threshold, 200)
+    above = np.linspace(threshold, 1, 200)
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            false_positives = collision_probability(below, bands, rows).mean() * threshold
+            false_negatives = (1 - collision_probability(above, bands, rows)).mean() * (1 - threshold)
+            error = false_positive_weight * false_positives + (1 - false_positive_weight) * false_negatives
+            if best_error is None or error < best_error:
+                best, best_error = (bands, rows), error
+    return best
+
+
+def candidate_pairs(signatures: np.ndarray, bands: int, rows: int) -> Tuple[np.ndarray, np.ndarray]:
+    """candidate_pairs gives the (text, representative) pairs of texts that share a bucket in some band,
+    where the representative is the first text of the bucket. Pairing every text of a bucket with one
+    text (instead of with each other) keeps buckets of many copies linear; the clusters are the same."""
+    members, representatives = [], []
+    nonempty = np.flatnonzero(signatures[:, 0] != EMPTY)
+    if len(nonempty) < 2:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    for band in range(bands):
+        keys = np.zeros(len(nonempty), dtype=np.uint64)
+        for column in range(band * rows, (band + 1) * rows):
+            keys = _mix(keys ^ signatures[nonempty, column].astype(np.uint64))
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]])
+        first = order[np.maximum.accumulate(np.where(starts, np.arange(len(order)), 0))]
+        shared = ~starts
+        members.append(nonempty[order[shared]])
+        representatives.append(nonempty[first[shared]])
+    if not members:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    pairs = np.unique(np.stack([np.concatenate(members), np.concatenate(representatives)], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def similarities(signatures: np.ndarray, first: np.ndarray, second: np.ndarray, chunk_size: int = 1 << 16) -> np.ndarray:
+    """similarities estimates the Jaccard similarity of each pair of texts from their signatures."""
+    estimates = np.empty(len(first), dtype=np.float32)
+    for start in range(0, len(first), chunk_size):
+        end = start + chunk_size
+        estimates[start:end] = (signatures[first[start:end]] == signatures[second[start:end]]).mean(axis=1)
+    return estimates
+
+
+def connected_components(count: int, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """connected_components labels each of count nodes with the smallest node it is connected to by the edges."""
+    labels = np.arange(count)
+    while True:
+        # Every edge pulls both of its ends down to the smaller of their labels, and then
+        # every node jumps to the label of its label, until nothing changes
+        smallest = np.minimum(labels[first], labels[second])
+        updated = labels.copy()
+        np.minimum.at(updated, first, smallest)
+        np.minimum.at(updated, second, smallest)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
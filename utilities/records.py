@@ -0,0 +1,136 @@
+"""
+records.py stores generated notes incrementally as JSON Lines, one record per note,
+so long generation runs can be resumed and never hold the whole corpus in memory.
+
+The first line of a record file holds the run parameters ({"parameters": {...}}),
+and every following line holds one note:
+
+    {"index": 0, "scenario": {...}, "prompt": "...", "result": "...", "cleaned_result": "...", "truncated": false}
+
+Records are appended in the order they complete, and compact() rewrites them in
+index order to the JSON layout used under dataset/.
+"""
+import json
+import logging
+import os
+import pathlib
+from typing import Dict, Iterator, Tuple
+
+# SECTIONS maps the lists in the compacted JSON layout to the record fields they are built from.
+SECTIONS = {
+    'scenarios': 'scenario',
+    'prompts': 'prompt',
+    'results': 'result',
+    'cleaned_results': 'cleaned_result',
+    'truncated': 'truncated',
+}
+
+
+def _scan(path: pathlib.Path) -> Tuple[dict, Dict[int, int], int]:
+    """_scan reads the header of a record file and the byte offset of each record,
+    returning the parameters, the offsets by record index and the length of the file
+    up to the last complete line."""
+    parameters = None
+    offsets = {}
+    valid_length = 0
+    with open(path, 'rb') as record_file:
+        offset = 0
+        for line in record_file:
+            if not line.endswith(b'\n'):
+                # An interrupted write leaves a partial last line behind.
+                logging.warning(f"Ignoring incomplete record at the end of {path}")
+                break
+            entry = json.loads(line)
+            if parameters is None:
+                parameters = entry['parameters']
+            else:
+                offsets[entry['index']] = offset
+            offset += len(line)
+            valid_length = offset
+    return parameters, offsets, valid_length
+
+
+def read_parameters(path: pathlib.Path) -> dict:
+    """read_parameters returns the run parameters stored in the header of a record file."""
+    with open(path, 'r', encoding='utf8') as record_file:
+        return json.loads(record_file.readline())['parameters']
+
+
+def completed_indices(path: pathlib.Path) -> set:
+    """completed_indices lists the indices of the records already present in a record file."""
+    if not os.path.exists(path):
+        return set()
+    _, offsets, _ = _scan(path)
+    return set(offsets)
+
+
+def iterate_records(path: pathlib.Path) -> Iterator[dict]:
+    """iterate_records yields the records of a record file in index order,
+    reading them one at a time."""
+    _, offsets, _ = _scan(path)
+    with open(path, 'rb') as record_file:
+        for index in sorted(offsets):
+            record_file.seek(offsets[index])
+            yield json.loads(record_file.readline())
+
+
+class RecordWriter:
+    """RecordWriter appends records to a record file, flushing after each one so that
+    no more than the record being written is lost if the run is interrupted.
+
+    With resume set, an existing file is appended to (after dropping any partial last line),
+    otherwise the file must not exist already."""
+    def __init__(self, path: pathlib.Path, parameters: dict, resume: bool = False):
+        self.path = path
+        if resume and os.path.exists(path):
+            _, _, valid_length = _scan(path)
+            self._file = open(path, 'r+b')
+            self._file.truncate(valid_length)
+            self._file.seek(valid_length)
+        elif os.path.exists(path):
+            raise FileExistsError(f"The record file {path} already exists, use --resume to continue it.")
+        else:
+            self._file = open(path, 'wb')
+            self._write_line({'parameters': parameters})
+
+    def write(self, record: dict):
+        self._write_line(record)
+
+    def _write_line(self, entry: dict):
+        self._file.write(json.dumps(entry).encode('utf8') + b'\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def compact(path: pathlib.Path, output_path: pathlib.Path, parameters: dict = None):
+    """compact writes the records of a record file in index order to a single JSON file
+    with the parameters, scenarios, prompts, results, cleaned_results and truncated lists.
+    Only one record is held in memory at a time."""
+    stored_parameters, offsets, _ = _scan(path)
+    indices = sorted(offsets)
+    if indices != list(range(len(indices))):
+        missing = sorted(set(range(max(indices, default=-1) + 1)) - set(indices))
+        logging.warning(f"{path} is missing {len(missing)} records (e.g. {missing[:5]}), compacting the rest")
+
+    with open(path, 'rb') as record_file, open(output_path, 'w', encoding='utf8') as output:
+        output.write('{"parameters": ')
+        json.dump(parameters if parameters is not None else stored_parameters, output)
+        for section, field in SECTIONS.items():
+            output.write(f', "{section}": [')
+            for position, index in enumerate(indices):
+                record_file.seek(offsets[index])
+                record = json.loads(record_file.readline())
+                if position > 0:
+                    output.write(', ')
+                # Records written before a field was added don't have it
+                json.dump(record.get(field), output)
+            output.write(']')
+        output.write('}')
@@ -0,0 +1,43 @@
+"""
+scenarios.py describes the scenarios used to prompt the language model for generated notes.
+"""
+import dataclasses
+import datetime
+
+# The ranges of dates drawn for patients, as (first, last) days
+BIRTH_DATES = (datetime.date(1943, 1, 1), datetime.date(2010, 1, 1))
+ADMISSION_DATES = (datetime.date(2012, 1, 1), datetime.date(2023, 1, 1))
+# DATE_FORMAT is how dates are written in prompts (e.g. 'June 07. 2016')
+DATE_FORMAT = "%B %d. %Y"
+
+@dataclasses.dataclass
+class Scenario:
+    """Scenario contains the parameters used to prompt the language model for a generated note."""
+    locale: str
+    """The intended language of the generated note, as a two-letter code ('nb' for Norwegian, 'en' for American English)"""
+    noteType: str
+    """The note type (e.g. 'discharge summary')"""
+    translatedNoteType: str
+    """The note type translated to the intended language (e.g. 'epikrise')"""
+    givenName: str
+    """The given/first name of the patient."""
+    familyName: str
+    """The family/surname of the patient."""
+    age: int
+    """The age of the patient."""
+    phoneNumber: str
+    """The patient's phone number."""
+    city: str
+    """The patient's city of residence."""
+    healthCareUnit: str
+    """The institution where the patient has been admitted."""
+    diagnosis: str
+    """The diagnosis or primary symptoms the patient has been admitted with (as a partial sentence, e.g. [admitted with] 'generalized abdominal pain')"""
+    birthDate: str
+    """The date the patient was born."""
+    admissionDate: str
+    """The date the patient was admitted."""
+    socialSecurityNumber: str
+    """A unique identifier for the patient (the US Social Security Number for English, the fødsels/personnummer for Norwegian)"""
+    findings: list[str]
+    """Clinical observations to include"""
@@ -0,0 +1,238 @@
+"""
+scoring.py compares predicted entity spans to reference spans, computing precision, recall
+and F1 per label from character offsets alone, without loading a spaCy pipeline.
+
+Every document in a corpus is placed one after the other in a single coordinate space,
+so that aligning, matching and overlapping spans are a handful of NumPy operations over the
+whole corpus instead of a loop over documents. Three kinds of scores are computed:
+
+- exact: a predicted span is correct if a reference span has the same label and tokens
+  (like the ents_p/ents_r/ents_f of spacy.scorer.get_ner_prf),
+- overlap: a predicted span is correct if it overlaps a reference span with the same label,
+  and a reference span is found if a predicted span with the same label overlaps it,
+- token: each token is counted as correct if it has the same label in both.
+"""
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Span is the (start, end, label) of an entity, as character offsets into the text
+Span = Tuple[int, int, str]
+
+# _TOKEN splits a text into words and single punctuation characters
+_TOKEN = re.compile(r'\w+|[^\w\s]')
+
+# AGE_SUFFIXES are stripped from the end of spans with clean_ages, with the number of tokens they span
+AGE_SUFFIXES = [('years old', 2), ('years', 1)]
+
+
+def tokenize(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """tokenize gives the start and end character offsets of the tokens in a text."""
+    offsets = np.array([m.span() for m in _TOKEN.finditer(text)], dtype=np.int64).reshape(-1, 2)
+    return offsets[:, 0], offsets[:, 1]
+
+
+def _prf(found_predicted: np.ndarray, predicted: np.ndarray, found_reference: np.ndarray, reference: np.ndarray) -> dict:
+    # The same formulas (and tiny constants) as spacy.scorer.PRFScore, so the scores compare exactly
+    p = found_predicted / (predicted + 1e-100)
+    r = found_reference / (reference + 1e-100)
+    return {'p': float(p), 'r': float(r), 'f': float(2 * ((p * r) / (p + r + 1e-100)))}
+
+
+def _summarize(labels: List[str], found_predicted, predicted, found_reference, reference) -> dict:
+    """_summarize gives the micro-averaged scores and the scores of each label that occurs."""
+    per_type = {label: _prf(found_predicted[i], predicted[i], found_reference[i], reference[i])
+                for i, label in enumerate(labels) if predicted[i] + reference[i] > 0}
+    scores = _prf(found_predicted.sum(), predicted.sum(), found_reference.sum(), reference.sum())
+    return {**scores, 'per_type': per_type}
+
+
+class _AlignedSpans:
+    """_AlignedSpans holds the spans of a corpus as [start, end) ranges of global token indices,
+    expanded to cover every token the character span touches (like spaCy's alignment_mode='expand')."""
+    def __init__(self, starts: np.ndarray, ends: np.ndarray, labels: np.ndarray):
+        self.starts = starts
+        self.ends = ends
+        self.labels = labels
+
+    @classmethod
+    def align(cls, spans: Sequence[List[Span]], char_offsets: np.ndarray, token_starts: np.ndarray,
+              token_ends: np.ndarray, label_ids: Dict[str, int]) -> '_AlignedSpans':
+        counts = [len(s) for s in spans]
+        flat = [span for document in spans for span in document]
+        shift = np.repeat(char_offsets, counts)
+        starts = np.fromiter((s[0] for s in flat), dtype=np.int64, count=len(flat)) + shift
+        ends = np.fromiter((s[1] for s in flat), dtype=np.int64, count=len(flat)) + shift
+        labels = np.fromiter((label_ids[s[2]] for s in flat), dtype=np.int64, count=len(flat))
+        # The first token ending after the start, and the tokens starting before the end
+        token_start = np.searchsorted(token_ends, starts, side='right')
+        token_end = np.searchsorted(token_starts, ends, side='left')
+        keep = token_start < token_end
+        return cls(token_start[keep], token_end[keep], labels[keep])
+
+    def strip_suffixes(self, text: str, token_starts: np.ndarray, token_ends: np.ndarray, suffixes):
+        """strip_suffixes drops the last tokens of spans whose text ends with one of the suffixes."""
+        for i in range(len(self.starts)):
+            span_text = text[token_starts[self.starts[i]]:token_ends[self.ends[i] - 1]]
+            for suffix, tokens in suffixes:
+                if span_text.endswith(suffix):
+                    self.ends[i] -= tokens
+                    break
+        keep = self.starts < self.ends
+        self.starts, self.ends, self.labels = self.starts[keep], self.ends[keep], self.labels[keep]
+
+    def without_overlaps(self) -> '_AlignedSpans':
+        """without_overlaps keeps the longest of overlapping spans (the first if equally long),
+        like spacy.util.filter_spans."""
+        order = np.argsort(self.starts, kind='stable')
+        starts, ends = self.starts[order], self.ends[order]
+        if len(starts) < 2 or (starts[1:] >= np.maximum.accumulate(ends)[:-1]).all():
+            return self
+        taken = set()
+        kept = []
+        for i in np.lexsort((self.starts, self.starts - self.ends)):
+            # Like filter_spans, only the first and last tokens are checked
+            if self.starts[i] not in taken and self.ends[i] - 1 not in taken:
+                taken.update(range(self.starts[i], self.ends[i]))
+                kept.append(i)
+        kept = np.sort(np.array(kept, dtype=np.int64))
+        return _AlignedSpans(self.starts[kept], self.ends[kept], self.labels[kept])
+
+    def token_labels(self, token_count: int) -> np.ndarray:
+        """token_labels gives the label of each token (-1 for tokens outside of every span)."""
+        labels = np.full(token_count, -1, dtype=np.int64)
+        lengths = self.ends - self.starts
+        first = np.repeat(self.starts - np.cumsum(lengths) + lengths, lengths)
+        labels[first + np.arange(lengths.sum())] = np.repeat(self.labels, lengths)
+        return labels
+
+
+def _overlapping(spans: _AlignedSpans, others: _AlignedSpans, stride: int) -> np.ndarray:
+    """_overlapping tells for each of spans whether any of others with the same label overlaps it.
+    Spans of different labels are placed stride apart, so they never overlap each other."""
+    if len(others.starts) == 0:
+        return np.zeros(len(spans.starts), dtype=bool)
+    order = np.argsort(others.starts + others.labels * stride)
+    other_starts = (others.starts + others.labels * stride)[order]
+    # The furthest any of the spans starting before a position reaches
+    reach = np.maximum.accumulate((others.ends + others.labels * stride)[order])
+    before = np.searchsorted(other_starts, spans.ends + spans.labels * stride, side='left')
+    return (before > 0) & (reach[np.maximum(before - 1, 0)] > spans.starts + spans.labels * stride)
+
+
+class Corpus:
+    """Corpus places texts one after the other, with a character between them so no token
+    spans two, and their tokens (by default those of tokenize) in the same offsets."""
+    def __init__(self, texts: Sequence[str], tokens: Optional[Sequence[Tuple[np.ndarray, np.ndarray]]] = None):
+        if tokens is None:
+            tokens = [tokenize(text) for text in texts]
+        self.texts = texts
+        self.char_offsets = np.cumsum([0] + [len(text) + 1 for text in texts], dtype=np.int64)[:len(texts)]
+        self.token_starts = np.concatenate([np.asarray(starts, dtype=np.int64) + offset for (starts, _), offset in zip(tokens, self.char_offsets)] or [np.zeros(0, np.int64)])
+        self.token_ends = np.concatenate([np.asarray(ends, dtype=np.int64) + offset for (_, ends), offset in zip(tokens, self.char_offsets)] or [np.zeros(0, np.int64)])
+        self.token_count = len(self.token_starts)
+
+    def align(self, spans: Sequence[List[Span]], label_ids: Dict[str, int], clean_ages: bool = False) -> _AlignedSpans:
+        """align gives the spans of each text as ranges of tokens, without overlaps."""
+        aligned = _AlignedSpans.align(spans, self.char_offsets, self.token_starts, self.token_ends, label_ids)
+        if clean_ages:
+            aligned.strip_suffixes('\0'.join(self.texts), self.token_starts, self.token_ends, AGE_SUFFIXES)
+        return aligned.without_overlaps()
+
+    def token_labels(self, spans: Sequence[List[Span]], label_ids: Dict[str, int], clean_ages: bool = False) -> np.ndarray:
+        """token_labels gives the id of the label of each token of the corpus (-1 outside of every span)."""
+        return self.align(spans, label_ids, clean_ages).token_labels(self.token_count)
+
+
+def label_ids(*annotations: Sequence[List[Span]]) -> Dict[str, int]:
+    """label_ids numbers the labels used in any of the annotations, in alphabetical order."""
+    labels = sorted({s[2] for spans in annotations for document in spans for s in document})
+    return {label: i for i, label in enumerate(labels)}
+
+
+def score_spans(texts: Sequence[str], references: Sequence[List[Span]], predictions: Sequence[List[Span]],
+                tokens: Optional[Sequence[Tuple[np.ndarray, np.ndarray]]] = None,
+                clean_ages: bool = False) -> Dict[str, dict]:
+    """score_spans scores the predicted spans of each text against its reference spans,
+    giving the exact, overlap and token scores (p, r, f and per_type) per label.
+
+    Spans are aligned to the tokens given for each text (by default those of tokenize),
+    and with clean_ages, trailing 'years' and 'years old' are left out of spans."""
+    corpus = Corpus(texts, tokens)
+    ids = label_ids(references, predictions)
+    labels = list(ids)
+    reference, predicted = corpus.align(references, ids, clean_ages), corpus.align(predictions, ids, clean_ages)
+    token_count = corpus.token_count
+
+    label_count = len(labels)
+    reference_counts = np.bincount(reference.labels, minlength=label_count)
+    predicted_counts = np.bincount(predicted.labels, minlength=label_count)
+    scores = {}
+
+    # Spans are the same if their label, start and end are, so we compare them as single integers
+    stride = token_count + 1
+    reference_keys = np.unique((reference.labels * stride + reference.starts) * stride + reference.ends)
+    predicted_keys = np.unique((predicted.labels * stride + predicted.starts) * stride + predicted.ends)
+    matched = np.bincount(np.intersect1d(reference_keys, predicted_keys, assume_unique=True) // (stride * stride), minlength=label_count)
+    scores['exact'] = _summarize(labels, matched, predicted_counts, matched, reference_counts)
+
+    found_predicted = np.bincount(predicted.labels[_overlapping(predicted, reference, stride)], minlength=label_count)
+    found_reference = np.bincount(reference.labels[_overlapping(reference, predicted, stride)], minlength=label_count)
+    scores['overlap'] = _summarize(labels, found_predicted, predicted_counts, found_reference, reference_counts)
+
+    reference_tokens = reference.token_labels(token_count)
+    predicted_tokens = predicted.token_labels(token_count)
+    same = predicted_tokens[(predicted_tokens == reference_tokens) & (predicted_tokens >= 0)]
+    matched_tokens = np.bincount(same, minlength=label_count)
+    scores['token'] = _summarize(labels, matched_tokens, np.bincount(predicted_tokens[predicted_tokens >= 0], minlength=label_count),
+                                 matched_tokens, np.bincount(reference_tokens[reference_tokens >= 0], minlength=label_count))
+    return scores
+
+
+def category_counts(token_labels: np.ndarray, label_count: int) -> np.ndarray:
+    """category_counts turns a (raters, tokens) array of label ids (-1 outside of spans,
+    -2 for tokens a rater did not annotate) into a (tokens, label_count + 1) array counting
+    the raters that gave each token each label, with the last column counting 'outside'."""
+    categories = np.where(token_labels == -1, label_count, token_labels)
+    counts = np.zeros((token_labels.shape[1], label_count + 1), dtype=np.int64)
+    for rater in categories:
+        rated = rater >= 0
+        np.add.at(counts, (np.flatnonzero(rated), rater[rated]), 1)
+    return counts
+
+
+def fleiss_kappa(counts: np.ndarray) -> Tuple[float, np.ndarray]:
+    """fleiss_kappa computes Fleiss' kappa from a (units, categories) array counting the raters
+    that chose each category, where every unit has the same number of raters. Also gives the
+    kappa of each category on its own (against all the others)."""
+    units, raters = counts.shape[0], counts[0].sum() if len(counts) else 0
+    if units == 0 or raters < 2:
+        return float('nan'), np.full(counts.shape[1], np.nan)
+    proportions = counts.sum(axis=0) / (units * raters)
+    agreement = ((counts * (counts - 1)).sum(axis=1) / (raters * (raters - 1))).mean()
+    expected = (proportions ** 2).sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kappa = (agreement - expected) / (1 - expected)
+        per_category = 1 - (counts * (raters - counts)).sum(axis=0) / (units * raters * (raters - 1) * proportions * (1 - proportions))
+    return float(kappa), per_category
+
+
+def krippendorff_alpha(counts: np.ndarray) -> float:
+    """krippendorff_alpha computes Krippendorff's alpha for nominal data from a (units, categories)
+    array counting the raters that chose each category. Units may have different numbers of
+    raters, and units with fewer than two are left out."""
+    raters = counts.sum(axis=1)
+    counts = counts[raters >= 2]
+    raters = raters[raters >= 2]
+    pairable = counts.sum()
+    if pairable < 2:
+        return float('nan')
+    # The diagonal of the coincidence matrix, and the number of values in each category
+    coincidences = ((counts * (counts - 1)).T / (raters - 1)).sum(axis=1)
+    totals = counts.sum(axis=0)
+    observed = (pairable - coincidences.sum()) / pairable
+    expected = (pairable ** 2 - (totals ** 2).sum()) / (pairable * (pairable - 1))
+    if expected == 0:
+        return float('nan')
+    return float(1 - observed / expected)
@@ -0,0 +1,123 @@
+"""
+seeding.py derives random draws from (seed, record index) alone, so that record i gets the
+same scenario no matter how many records are generated or how they are split between
+processes or machines.
+
+Sampling without replacement maps record i through a keyed permutation of the vocabulary,
+which keeps the entries unique across every shard without coordinating between them.
+"""
+import hashlib
+import random
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+
+
+def stable_hash(*parts) -> int:
+    """stable_hash hashes its arguments to a 64-bit integer that is the same in every process
+    (unlike hash(), which is salted per process for strings)."""
+    digest = hashlib.blake2b(repr(parts).encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def mix64(x):
+    """mix64 scrambles 64-bit integers with the SplitMix64 finalizer. It works on Python ints
+    and element-wise on NumPy uint64 arrays."""
+    x = (x + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+def record_random(seed: int, index: int) -> random.Random:
+    """record_random gives the generator for the record with the given index."""
+    return random.Random(stable_hash(seed, 'record', index))
+
+
+class KeyedPermutation:
+    """KeyedPermutation is a pseudorandom bijection on range(size) chosen by key,
+    computed one element at a time with a Feistel network (cycle-walking the values that
+    fall outside of range(size))."""
+    ROUNDS = 6
+
+    def __init__(self, size: int, key: int):
+        if size < 1:
+            raise ValueError("Can't permute an empty range")
+        self.size = size
+        self.half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.half_mask = (1 << self.half_bits) - 1
+        self.round_keys = [mix64((key + r) & _MASK64) for r in range(self.ROUNDS)]
+
+    def _encrypt(self, x):
+        left, right = x >> self.half_bits, x & self.half_mask
+        for round_key in self.round_keys:
+            left, right = right, left ^ (mix64(right ^ round_key) & self.half_mask)
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, i: int) -> int:
+        if not 0 <= i < self.size:
+            raise IndexError(f"Index {i} is outside of the permuted range {self.size}")
+        value = self._encrypt(i)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+    def take(self, indices):
+        """take permutes a NumPy array of indices element-wise."""
+        import numpy as np
+        values = self._encrypt(np.asarray(indices, dtype=np.uint64))
+        outside = values >= self.size
+        while outside.any():
+            values[outside] = self._encrypt(values[outside])
+            outside = values >= self.size
+        return values.astype(np.int64)
+
+
+class CounterGenerator:
+    """CounterGenerator stands in for the parts of numpy.random.Generator used by
+    utilities.vectorized.create_batch, drawing a batch of records with the given indices.
+
+    Each call is a new stream, and each value is a hash of (seed, stream, record index, column),
+    so a record's values don't depend on which other records are in the batch."""
+    def __init__(self, seed: int, indices):
+        import numpy as np
+        self.seed = seed
+        self.indices = np.asarray(indices, dtype=np.uint64)
+        self.stream = 0
+
+    def _next_key(self) -> int:
+        self.stream += 1
+        return stable_hash(self.seed, 'stream', self.stream)
+
+    def _bits(self, size):
+        import numpy as np
+        shape = (size,) if isinstance(size, int) else tuple(size)
+        if shape[0] != len(self.indices):
+            raise ValueError(f"Expected draws for {len(self.indices)} records, got size {size}")
+        columns = int(np.prod(shape[1:], dtype=np.int64))
+        counters = self.indices[:, None] * np.uint64(columns) + np.arange(columns, dtype=np.uint64)
+        return mix64(mix64(counters) ^ np.uint64(self._next_key())).reshape(shape)
+
+    def random(self, size):
+        return (self._bits(size) >> 11) * (1.0 / (1 << 53))
+
+    def integers(self, low, high=None, size=None, dtype=None, endpoint=False):
+        import numpy as np
+        if high is None:
+            low, high = 0, low
+        span = high - low + (1 if endpoint else 0)
+        values = low + np.floor(self.random(size) * span).astype(np.int64)
+        return values.astype(dtype if dtype is not None else np.int64)
+
+    def choice(self, a: int, size, replace: bool = True):
+        if replace:
+            return self.integers(0, a, size=size)
+        if size != len(self.indices):
+            raise ValueError(f"Expected draws for {len(self.indices)} records, got size {size}")
+        if self.indices.max(initial=0) >= a:
+            raise ValueError(f"Can only draw {a} unique choices, but record {self.indices.max()} needs one.")
+        return KeyedPermutation(a, self._next_key()).take(self.indices)
+
+    def permuted(self, x, axis: int = 1):
+        import numpy as np
+        order = np.argsort(self.random(x.shape), axis=axis)
+        return np.take_along_axis(x, order, axis=axis)
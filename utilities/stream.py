@@ -0,0 +1,149 @@
+"""
+stream.py reads one section (e.g. 'cleaned_results') of a results file without loading
+the rest of it, so converting a corpus takes the same memory whatever its size.
+
+Results JSON is parsed incrementally: the other top-level values are decoded one list
+element at a time and thrown away, and the elements of the requested section are yielded
+as they are read. JSONL checkpoints written by generate.py --checkpoint are read in
+record order.
+"""
+import json
+import pathlib
+import re
+from typing import Any, Iterator
+
+import utilities.records
+
+_WHITESPACE = re.compile(r'\s*')
+_decoder = json.JSONDecoder()
+
+
+class _IncrementalReader:
+    """_IncrementalReader decodes JSON values from a text file, holding only the
+    unread part of the current chunk in memory."""
+    def __init__(self, file, chunk_size: int):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.position = 0
+        self.at_end = False
+
+    def _fill(self) -> bool:
+        if self.at_end:
+            return False
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            self.at_end = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self) -> str:
+        """peek skips whitespace and returns the next character ('' at the end of the file)."""
+        while True:
+            self.position = _WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._fill():
+                return ''
+
+    def expect(self, characters: str) -> str:
+        character = self.peek()
+        if character == '' or character not in characters:
+            raise ValueError(f"Expected one of '{characters}' but found '{character}' in {self.file.name}")
+        self.position += 1
+        return character
+
+    def decode(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # A number or literal at the very end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.position = end
+            return value
+
+    def iterate_array(self) -> Iterator[Any]:
+        """iterate_array decodes the elements of the array at the current position one at a time."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.position += 1
+            return
+        while True:
+            yield self.decode()
+            if self.expect(',]') == ']':
+                return
+
+
+def iterate_section(path: pathlib.Path, section: str, chunk_size: int = 1 << 20) -> Iterator[Any]:
+    """iterate_section yields the elements of one of the lists in a results file
+    (e.g. 'scenarios', 'prompts', 'results' or 'cleaned_results'), reading them incrementally.
+    Files ending in .jsonl are read as record files from generate.py --checkpoint, and files
+    ending in .corpus as corpus files (see utilities/corpus.py)."""
+    if str(path).endswith('.corpus'):
+        # corpus.py reads results through this module, so it is imported when it is needed
+        from utilities.corpus import CorpusFile
+        yield from CorpusFile(path).section(section)
+        return
+    if str(path).endswith('.jsonl'):
+        field = utilities.records.SECTIONS[section]
+        for record in utilities.records.iterate_records(path):
+            yield record.get(field)
+        return
+
+    with open(path, 'r', encoding='utf8') as source:
+        reader = _IncrementalReader(source, chunk_size)
+        _find_key(reader, section)
+        yield from reader.iterate_array()
+
+
+def iterate_optional_section(path: pathlib.Path, section: str) -> Iterator[Any]:
+    """iterate_optional_section yields the elements of a section of the results, or None forever for a section they don't have."""
+    try:
+        elements = iterate_section(path, section)
+        first = next(elements, None)
+    except KeyError:
+        while True:
+            yield None
+    yield first
+    yield from elements
+
+
+def read_parameters(path: pathlib.Path, chunk_size: int = 1 << 20) -> dict:
+    """read_parameters gives the parameters stored in a results file (or a record file)."""
+    if str(path).endswith('.corpus'):
+        from utilities.corpus import CorpusFile
+        return CorpusFile(path).parameters
+    if str(path).endswith('.jsonl'):
+        return utilities.records.read_parameters(path)
+    with open(path, 'r', encoding='utf8') as source:
+        reader = _IncrementalReader(source, chunk_size)
+        _find_key(reader, 'parameters')
+        return reader.decode()
+
+
+def _find_key(reader: _IncrementalReader, key: str):
+    """_find_key skips the top-level values of a JSON object up to the value of key, raising a KeyError if it has none."""
+    reader.expect('{')
+    if reader.peek() == '}':
+        raise KeyError(key)
+    while True:
+        found = reader.decode()
+        reader.expect(':')
+        if found == key:
+            return
+        if reader.peek() == '[':
+            # Skip lists element by element, so we never hold all of them
+            for _ in reader.iterate_array():
+                pass
+        else:
+            reader.decode()
+        if reader.expect(',}') == '}':
+            raise KeyError(key)
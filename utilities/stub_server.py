@@ -0,0 +1,236 @@
+"""
+stub_server.py serves a small OpenAI-compatible chat completion endpoint that fabricates
+annotated notes from the prompts it receives. It can inject latency and rate limit errors,
+so the concurrency and backoff of generate.py can be exercised without calling OpenAI:
+
+    python -m utilities.stub_server --port 8000 --latency 0.5 --rateLimitRate 0.1
+    python generate.py --apiBase http://localhost:8000/v1 --openAIKey stub --n 100
+
+It can also stand in for the batch API, answering a batch request file written by
+generate.py --batch write with a result file in the same format as OpenAI's:
+
+    python -m utilities.stub_server --batchRequests batch-requests.jsonl --batchResults batch-results.jsonl
+"""
+import http.server
+import json
+import pathlib
+import random
+import re
+import threading
+import time
+import uuid
+from typing import Optional, Tuple
+
+from tap import Tap
+
+# CONTINUATION_OVERLAP is how much of the end of a partial answer a continuation repeats, as models tend to
+CONTINUATION_OVERLAP = 20
+_NOTE_MARKER = re.compile(r'^===NOTE (\d+)===$', re.MULTILINE)
+_PATIENT_NAME = re.compile(r'patient named (\S+) (.+?), who')
+_FACTS = {
+    'age': re.compile(r'The patient is (\d+) years old'),
+    'unit': re.compile(r'admitted to (.+) on (.+)\.\n'),
+    'birth': re.compile(r'born in (.+) on (.+)\.\n'),
+    'phone': re.compile(r'phone number is (.+)\.\n'),
+    'ssn': re.compile(r'social security number is (.+)\.\n'),
+}
+
+
+class StubArguments(Tap):
+    host: str = 'localhost'
+    """The interface to listen on"""
+    port: int = 8000
+    """The port to listen on"""
+    latency: float = 0.0
+    """The mean time in seconds to wait before answering each request"""
+    jitter: float = 0.0
+    """The maximum random deviation in seconds from the mean latency"""
+    rateLimitRate: float = 0.0
+    """The fraction of requests to reject with HTTP 429"""
+    retryAfter: Optional[float] = 1.0
+    """The Retry-After value in seconds to send with rejected requests"""
+    seed: int = None
+    """The seed for injected latency and errors"""
+    batchRequests: str = None
+    """Instead of serving, answer the requests in this batch request JSONL (like the batch API)"""
+    batchResults: str = 'batch-results.jsonl'
+    """The batch result JSONL to write the answers to --batchRequests to"""
+    batchFailureRate: float = 0.0
+    """The fraction of batch requests to fail with HTTP 500"""
+    dropNoteRate: float = 0.0
+    """The fraction of notes to leave out of answers to prompts asking for several notes (see generate.py --notesPerRequest)"""
+
+
+def fabricate_note(prompt: str) -> str:
+    """fabricate_note writes a short annotated note containing the patient details
+    given in a prompt made by generate.format_scenario."""
+    name = _PATIENT_NAME.search(prompt)
+    facts = {key: pattern.search(prompt) for key, pattern in _FACTS.items()}
+    lines = ['Discharge note', '']
+    if name:
+        lines.append(f"Patient: <First_Name>{name.group(1)}</First_Name> <Last_Name>{name.group(2)}</Last_Name>")
+    if facts['age']:
+        lines.append(f"The patient is <Age>{facts['age'].group(1)} years old</Age>.")
+    if facts['unit']:
+        lines.append(f"Admitted to <Health_Care_Unit>{facts['unit'].group(1)}</Health_Care_Unit> "
+                     f"on <Date>{facts['unit'].group(2)}</Date>.")
+    if facts['birth']:
+        lines.append(f"Born in <Location>{facts['birth'].group(1)}</Location> on <Date>{facts['birth'].group(2)}</Date>.")
+    if facts['phone']:
+        lines.append(f"Phone: <Phone_Number>{facts['phone'].group(1)}</Phone_Number>")
+    if facts['ssn']:
+        lines.append(f"SSN: <Social_Security_Number>{facts['ssn'].group(1)}</Social_Security_Number>")
+    lines += ['', 'The patient was examined on admission and is recovering as expected.']
+    return '\n'.join(lines)
+
+
+def completion_response(content: str, model: str, prompt_tokens: int, finish_reason: str = 'stop') -> dict:
+    """completion_response wraps a message in the body of an OpenAI chat completion response."""
+    completion_tokens = len(content) // 4
+    return {
+        'id': f'chatcmpl-{uuid.uuid4().hex}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': finish_reason}],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                  'total_tokens': prompt_tokens + completion_tokens},
+    }
+
+
+def fabricate_notes(prompt: str, drop_rate: float = 0.0, rng: random.Random = random) -> str:
+    """fabricate_notes writes a note for each patient in a prompt made by generate.format_packed,
+    each after its marker, leaving out drop_rate of them. Other prompts get a single note."""
+    markers = list(_NOTE_MARKER.finditer(prompt))
+    if not markers:
+        return fabricate_note(prompt)
+    sections = []
+    for marker, following in zip(markers, markers[1:] + [None]):
+        if rng.random() >= drop_rate:
+            details = prompt[marker.end():following.start() if following else len(prompt)]
+            sections.append(f"{marker.group(0)}\n{fabricate_note(details)}")
+    return '\n\n'.join(sections)
+
+
+def answer(request: dict, drop_rate: float = 0.0, rng: random.Random = random) -> dict:
+    """answer gives the response to the body of a chat completion request, cut off at its max_tokens
+    (at four characters per token). Given a partial answer, it continues it."""
+    messages = request.get('messages', [])
+    prompts = [m['content'] for m in messages if m.get('role') == 'user']
+    partials = [m['content'] for m in messages if m.get('role') == 'assistant']
+    content = fabricate_notes(prompts[0] if prompts else '', drop_rate, rng)
+    if partials and content.startswith(partials[-1]):
+        content = content[max(0, len(partials[-1]) - CONTINUATION_OVERLAP):]
+    finish_reason = 'stop'
+    max_tokens = request.get('max_tokens')
+    if max_tokens and len(content) > 4 * max_tokens:
+        content, finish_reason = content[:4 * max_tokens], 'length'
+    prompt_tokens = sum(len(m.get('content', '')) for m in messages) // 4
+    return completion_response(content, request.get('model', 'stub'), prompt_tokens, finish_reason)
+
+
+def answer_batch(requests_path: pathlib.Path, results_path: pathlib.Path, failure_rate: float = 0.0,
+                 rng: random.Random = random) -> Tuple[int, int]:
+    """answer_batch writes a result line for each line of a batch request file, in a random order like
+    the batch API, failing failure_rate of them. Returns the number of answered and failed requests."""
+    with open(requests_path, 'r', encoding='utf8') as request_file:
+        requests = [json.loads(line) for line in request_file if line.strip()]
+    rng.shuffle(requests)
+    failed = 0
+    with open(results_path, 'w', encoding='utf8') as result_file:
+        for request in requests:
+            if rng.random() < failure_rate:
+                failed += 1
+                response = {'status_code': 500, 'request_id': uuid.uuid4().hex,
+                            'body': {'error': {'message': 'Server error (injected by stub)', 'type': 'server_error'}}}
+            else:
+                response = {'status_code': 200, 'request_id': uuid.uuid4().hex, 'body': answer(request['body'])}
+            result = {'id': f'batch_req_{uuid.uuid4().hex}', 'custom_id': request['custom_id'], 'response': response, 'error': None}
+            result_file.write(json.dumps(result) + '\n')
+    return len(requests) - failed, failed
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            return self._respond(404, {'error': {'message': f'Unknown path {self.path}', 'type': 'invalid_request_error'}})
+
+        options = self.server.options
+        with self.server.lock:
+            rate_limited = self.server.random.random() < options.rateLimitRate
+            delay = max(0.0, options.latency + self.server.random.uniform(-options.jitter, options.jitter))
+            self.server.requests += 1
+        time.sleep(delay)
+
+        if rate_limited:
+            with self.server.lock:
+                self.server.rate_limited += 1
+            headers = {} if options.retryAfter is None else {'Retry-After': str(options.retryAfter)}
+            return self._respond(429, {'error': {'message': 'Rate limit reached (injected by stub)',
+                                                 'type': 'requests', 'code': 'rate_limit_exceeded'}}, headers)
+
+        with self.server.lock:
+            response = answer(request, options.dropNoteRate, self.server.random)
+        self._respond(200, response)
+
+    def _respond(self, status: int, body: dict, headers: dict = None):
+        payload = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """StubServer answers chat completion requests with fabricated notes.
+    Use it as a context manager to run it on a background thread."""
+    daemon_threads = True
+
+    def __init__(self, options: StubArguments):
+        super().__init__((options.host, options.port), StubHandler)
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+if __name__ == '__main__':
+    options = StubArguments().parse_args()
+    if options.batchRequests is not None:
+        answered, failed = answer_batch(options.batchRequests, options.batchResults, options.batchFailureRate,
+                                        random.Random(options.seed))
+        print(f'Answered {answered} batch requests ({failed} failed) in {options.batchResults}')
+        raise SystemExit(0)
+    server = StubServer(options)
+    print(f'Serving stub chat completions on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,44 +1,150 @@
+import collections
+import dataclasses
+import itertools
+import multiprocessing
 import re
-from typing import List, Tuple
+from typing import Dict, Iterable, List, Tuple
 
-# _ENCLOSED_IN_TAGS matches on expressions with XML-style tags (e.g. '<Age>23</Age>')
-# putting the tag name in the first capturing group, and the contents in the second
-# capturing group.
-# NOTE: This will fail if you have nested annotations.
-_ENCLOSED_IN_TAGS = re.compile(r'<([\w_]*)>([^<]*)<\/\1>')
+# _TAG matches a single XML-style opening or closing tag (e.g. '<Age>' or '</Age>'),
+# putting the slash (if any) in the first capturing group, and the tag name in the second.
+_TAG = re.compile(r'<(/?)(\w*)>')
+
+@dataclasses.dataclass
+class ParsedNote:
+    """ParsedNote holds everything we read from an annotated note in a single pass."""
+    text: str
+    """The note with the tags removed, but their contents kept."""
+    redacted: str
+    """The note with each outermost tag and its contents replaced by the tag name in brackets."""
+    destroyed: str
+    """The note with each outermost tag and its contents removed."""
+    spans: List[Tuple[int, int, str]]
+    """The (start, end, tag name) of each tag, as character offsets into text, in order of their start."""
+    tag_counts: Dict[str, int]
+    """The number of times each tag name occurs."""
+    diagnostics: List[str]
+    """Descriptions of the tags that could not be matched, which are kept in the text as-is."""
+    outermost: List[bool] = None
+    """Whether each span is outside of every other tag (the spans that are replaced in redacted, and left out of destroyed)."""
+
+def _match_tags(closing: List[str], names: List[str]) -> Tuple[List[int], List[Tuple[int, str]]]:
+    """_match_tags pairs each closing tag with the nearest open tag of the same name.
+    Returns the index of the matching tag for each tag (None if it has no match),
+    and the index of and a message for each unmatched tag."""
+    partners = [None] * len(names)
+    problems = []
+    open_tags = []
+    for i, name in enumerate(names):
+        if not closing[i]:
+            open_tags.append(i)
+            continue
+        if open_tags and names[open_tags[-1]] == name:
+            partners[open_tags[-1]] = i
+            partners[i] = open_tags.pop()
+            continue
+        depth = len(open_tags) - 1
+        while depth >= 0 and names[open_tags[depth]] != name:
+            depth -= 1
+        if depth < 0:
+            problems.append((i, f"Closing tag </{name}> has no opening tag"))
+            continue
+        for unclosed in open_tags[depth + 1:]:
+            problems.append((unclosed, f"Opening tag <{names[unclosed]}> is not closed before </{name}>"))
+        partners[open_tags[depth]] = i
+        partners[i] = open_tags[depth]
+        del open_tags[depth:]
+    for unclosed in open_tags:
+        problems.append((unclosed, f"Opening tag <{names[unclosed]}> is never closed"))
+    return partners, problems
+
+def _parse_flat(texts: List[str], names: List[str]) -> ParsedNote:
+    """_parse_flat handles the common case where every tag is closed right after it is opened,
+    so the texts alternate between the text outside of tags and the contents of a tag."""
+    offsets = list(itertools.accumulate(map(len, texts)))
+    redacted = [None] * len(texts)
+    redacted[0::2] = texts[0::2]
+    redacted[1::2] = [f'[{name}]' for name in names]
+    return ParsedNote(text=''.join(texts), redacted=''.join(redacted), destroyed=''.join(texts[0::2]),
+                      spans=list(zip(offsets[0::2], offsets[1::2], names)),
+                      tag_counts=dict(collections.Counter(names)), diagnostics=[], outermost=[True] * len(names))
+
+def parse_note(annotated: str) -> ParsedNote:
+    """parse_note reads the XML-style tags in an annotated note (e.g. '<Age>23</Age>'),
+    which may be nested. Tags without a match are treated as plain text."""
+    # Splitting on the tags gives [text, slash, name, text, slash, name, ..., text]
+    parts = _TAG.split(annotated)
+    texts, closing, names = parts[0::3], parts[1::3], parts[2::3]
+    if names[0::2] == names[1::2] and not any(closing[0::2]) and all(closing[1::2]):
+        return _parse_flat(texts, names[0::2])
+    partners, problems = _match_tags(closing, names)
+
+    diagnostics = []
+    if problems:
+        # Unmatched tags are plain text, so we merge them into the text around them
+        offsets = [0]
+        for i, name in enumerate(names):
+            offsets.append(offsets[-1] + len(texts[i]) + len(closing[i]) + len(name) + 2)
+        diagnostics = [f"{message} (at {offsets[i + 1] - len(closing[i]) - len(names[i]) - 2})" for i, message in sorted(problems)]
+        for i, _ in problems:
+            texts[i + 1] = f'<{closing[i]}{names[i]}>' + texts[i + 1]
+
+    text_length = len(texts[0])
+    redacted = [texts[0]]
+    destroyed = [texts[0]]
+    spans = []
+    outermost = []
+    tag_counts = collections.Counter()
+    # depth counts the matched tags we are inside of; while inside of any,
+    # the text is left out of the redacted and destroyed notes.
+    depth = 0
+    open_spans = []
+    for i, name in enumerate(names):
+        if partners[i] is not None:
+            if not closing[i]:
+                if depth == 0:
+                    redacted.append(f'[{name}]')
+                depth += 1
+                open_spans.append((len(spans), text_length))
+                spans.append(None)
+                outermost.append(depth == 1)
+                tag_counts[name] += 1
+            else:
+                depth -= 1
+                span_index, start = open_spans.pop()
+                spans[span_index] = (start, text_length, name)
+        chunk = texts[i + 1]
+        if depth == 0:
+            redacted.append(chunk)
+            destroyed.append(chunk)
+        text_length += len(chunk)
+    return ParsedNote(text=''.join(texts), redacted=''.join(redacted), destroyed=''.join(destroyed),
+                      spans=spans, tag_counts=dict(tag_counts), diagnostics=diagnostics, outermost=outermost)
+
+def parse_notes(notes: Iterable[str], processes: int = 1, chunksize: int = 64) -> List[ParsedNote]:
+    """parse_notes parses many notes, spreading them over a pool of processes if processes > 1."""
+    if processes <= 1:
+        return [parse_note(note) for note in notes]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(parse_note, notes, chunksize=chunksize)
 
 def remove_tags(task: str) -> str:
     """remove_tags removes simple XML tags from a text,
     replacing them with their contents."""
-    return _ENCLOSED_IN_TAGS.sub(r'\2', task)
+    return parse_note(task).text
 
 def destroy_tags(task: str) -> str:
     """destroy_tags removes all inline tags from a text, including their contents."""
-    return _ENCLOSED_IN_TAGS.sub('', task)
+    return parse_note(task).destroyed
 
 def redact_tags(task: str) -> str:
     """redact_tags replaces simple XML tags from text,
     replacing them with the tag name."""
-    return _ENCLOSED_IN_TAGS.sub(r'[\1]', task)
+    return parse_note(task).redacted
 
 def list_annotations(annotated: str, expected_tags: List[str] = None) -> List[Tuple[int, int, str]]:
-    annotations = []
-    matches = _ENCLOSED_IN_TAGS.finditer(annotated)
-
-    # We want to find the character spans as they will be
-    # in the unannotated text. To achieve this, we keep a running
-    # count of how many markup characters have found so far
-    # in markup_offset:
-    markup_offset = 0
-    for match in matches:
-        tag_name, contents = match.groups()
-        # The annotations consist of an opening tag and a closing tag
-        # (e.g. <Age></Age>) - the tags themselves add 5 characters:
-        total_markup_chars = (2*len(tag_name) + 5)
-        tag_start = match.span()[0] - markup_offset
-        tag_end = match.span()[1] - markup_offset - total_markup_chars
-        markup_offset += total_markup_chars
-        if expected_tags is not None and tag_name not in expected_tags:
-            continue
-        annotations.append((tag_start, tag_end, tag_name))
-    return annotations
\ No newline at end of file
+    """list_annotations lists the (start, end, tag name) of the tags in a text,
+    as character offsets into the text with the tags removed."""
+    spans = parse_note(annotated).spans
+    if expected_tags is None:
+        return spans
+    return [span for span in spans if span[2] in expected_tags]
@@ -0,0 +1,144 @@
+"""
+tokcache.py keeps the tokenization of note texts in a SQLite file, keyed by the spaCy pipeline
+(name and version) and a hash of the text, so texts that were tokenized in an earlier run
+are turned back into documents without running the tokenizer again.
+
+Only the token offsets are stored (as zlib-compressed start and end offsets), since the
+words and the whitespace after them can be read back from the text.
+"""
+import hashlib
+import os
+import pathlib
+import sqlite3
+import threading
+import zlib
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+# TOKEN_CACHE_PATH is where convert.py and check-annotation-quality.py keep tokenizations
+TOKEN_CACHE_PATH = pathlib.Path('.cache/tokens.sqlite')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    pipeline TEXT NOT NULL,
+    version TEXT NOT NULL,
+    text_hash BLOB NOT NULL,
+    offsets BLOB NOT NULL,
+    PRIMARY KEY (pipeline, version, text_hash)
+) WITHOUT ROWID;
+"""
+
+# _LOOKUP_BATCH is the number of texts looked up in a single query
+_LOOKUP_BATCH = 512
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode('utf8'), digest_size=16).digest()
+
+
+def pack_offsets(starts: np.ndarray, ends: np.ndarray) -> bytes:
+    """pack_offsets stores the gap before each token and its length, which are small numbers that compress well."""
+    gaps = np.diff(np.concatenate([[0], starts]))
+    gaps[1:] -= (ends - starts)[:-1]
+    return zlib.compress(np.stack([gaps, ends - starts]).astype(np.uint32).tobytes())
+
+
+def unpack_offsets(packed: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    gaps, lengths = np.frombuffer(zlib.decompress(packed), dtype=np.uint32).astype(np.int64).reshape(2, -1)
+    ends = np.cumsum(gaps + lengths)
+    return ends - lengths, ends
+
+
+def pipeline_identity(nlp) -> Tuple[str, str]:
+    """pipeline_identity gives the name and version a pipeline's tokenizations are cached under.
+    The version includes spaCy's, since the tokenizer rules may change between spaCy versions."""
+    import spacy
+    return f"{nlp.meta.get('lang')}_{nlp.meta.get('name')}", f"{nlp.meta.get('version')}/spacy-{spacy.__version__}"
+
+
+def doc_from_offsets(nlp, text: str, starts: np.ndarray, ends: np.ndarray):
+    """doc_from_offsets creates the spaCy document with the given tokens, which must cover the text
+    like the tokens of a spaCy tokenizer: with only single spaces left between them."""
+    import spacy.tokens
+    words = [text[start:end] for start, end in zip(starts.tolist(), ends.tolist())]
+    spaces = (np.concatenate([starts[1:], [len(text)]]) > ends).tolist()
+    doc = spacy.tokens.Doc(nlp.vocab, words=words, spaces=spaces)
+    # The tokenizer leaves the sentence start of a single leading space unset, which we match
+    # so the documents are the same as those from the tokenizer
+    if words and words[0] == ' ':
+        doc[0].is_sent_start = None
+    return doc
+
+
+class TokenizationCache:
+    """TokenizationCache stores the tokenizations of texts in a SQLite database at `path`,
+    counting hits and misses. Every thread gets its own connection."""
+    def __init__(self, path: pathlib.Path = TOKEN_CACHE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _lookup(self, pipeline: Tuple[str, str], hashes: List[bytes]) -> dict:
+        found = {}
+        connection = self._connection()
+        for first in range(0, len(hashes), _LOOKUP_BATCH):
+            batch = hashes[first:first + _LOOKUP_BATCH]
+            rows = connection.execute(
+                f'SELECT text_hash, offsets FROM tokens WHERE pipeline = ? AND version = ? '
+                f'AND text_hash IN ({",".join("?" * len(batch))})', (*pipeline, *batch)).fetchall()
+            found.update(rows)
+        return found
+
+    def make_docs(self, nlp, texts: Iterable[str], batch_size: int = 256) -> Iterator:
+        """make_docs yields a spaCy document for each text, like nlp.tokenizer.pipe, but only tokenizes
+        the texts that aren't cached yet (and caches them)."""
+        pipeline = pipeline_identity(nlp)
+        iterator = iter(texts)
+        while True:
+            batch = [text for _, text in zip(range(batch_size), iterator)]
+            if not batch:
+                return
+            hashes = [text_hash(text) for text in batch]
+            found = self._lookup(pipeline, hashes)
+            missing = [i for i, h in enumerate(hashes) if h not in found]
+            tokenized = dict(zip(missing, nlp.tokenizer.pipe((batch[i] for i in missing), batch_size=batch_size)))
+            if missing:
+                connection = self._connection()
+                connection.execute('BEGIN')
+                connection.executemany('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)', [
+                    (*pipeline, hashes[i], pack_offsets(*doc_offsets(tokenized[i]))) for i in missing])
+                connection.execute('COMMIT')
+            self.hits += len(batch) - len(missing)
+            self.misses += len(missing)
+            for i, text in enumerate(batch):
+                if i in tokenized:
+                    yield tokenized[i]
+                else:
+                    yield doc_from_offsets(nlp, text, *unpack_offsets(found[hashes[i]]))
+
+    def summary(self) -> str:
+        """summary describes the hits and misses counted so far."""
+        total = self.hits + self.misses
+        rate = 100 * self.hits / total if total > 0 else 0.0
+        return f"Tokenization cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate)"
+
+
+def doc_offsets(doc) -> Tuple[np.ndarray, np.ndarray]:
+    """doc_offsets gives the start and end character offsets of the tokens of a spaCy document."""
+    starts = np.fromiter((token.idx for token in doc), dtype=np.int64, count=len(doc))
+    lengths = np.fromiter((len(token) for token in doc), dtype=np.int64, count=len(doc))
+    return starts, starts + lengths
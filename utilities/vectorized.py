@@ -0,0 +1,182 @@
+"""
+vectorized.py draws scenarios in batches with NumPy: every field of N scenarios is
+drawn and formatted as one array operation, and the scenarios are kept as columns in a
+ScenarioBatch that only creates Scenario objects when they are accessed.
+
+This draws different scenarios than create_scenarios in generate.py for the same seed,
+but from the same distributions.
+"""
+import dataclasses
+import datetime
+from typing import Iterator, Union
+
+import numpy as np
+
+from utilities.scenarios import Scenario, BIRTH_DATES, ADMISSION_DATES
+from utilities.vocabulary import Vocabulary, VocabularyStore
+
+# MONTHS are the month names written by DATE_FORMAT ('%B' in the C locale)
+MONTHS = np.array(['January', 'February', 'March', 'April', 'May', 'June', 'July',
+                   'August', 'September', 'October', 'November', 'December'])
+
+
+def _digits(values: np.ndarray, width: int) -> np.ndarray:
+    """_digits writes integers as strings zero-padded to width."""
+    return np.char.zfill(values.astype(str), width)
+
+
+def _join(*parts) -> np.ndarray:
+    """_join concatenates string arrays and constant strings element-wise."""
+    joined = parts[0]
+    for part in parts[1:]:
+        joined = np.char.add(joined, part)
+    return joined
+
+
+def _pick(choice: np.ndarray, *options: np.ndarray) -> np.ndarray:
+    """_pick takes element i from options[choice[i]]."""
+    return np.choose(choice, [np.asarray(o, dtype=str) for o in np.broadcast_arrays(*options)])
+
+
+def random_dates(rng: np.random.Generator, date_range, n: int) -> np.ndarray:
+    """random_dates draws n days uniformly from an inclusive (start, end) range."""
+    start, end = date_range
+    days = rng.integers(0, (end - start).days, size=n, endpoint=True)
+    return np.datetime64(start, 'D') + days
+
+
+def format_dates(dates: np.ndarray) -> np.ndarray:
+    """format_dates writes dates like DATE_FORMAT (e.g. 'June 07. 2016')."""
+    months = dates.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]').astype(int) + 1970
+    days = (dates - months).astype(int) + 1
+    return _join(MONTHS[months.astype(int) % 12], ' ', _digits(days, 2), '. ', years.astype(str))
+
+
+def random_phone_numbers(rng: np.random.Generator, locale: str, n: int) -> np.ndarray:
+    """random_phone_numbers draws n phone numbers in the formats of generate_random_phone."""
+    choice = rng.integers(0, 3, size=n)
+    if locale == 'nb':
+        phone = _digits(rng.integers(0, 10**8, size=n), 8)
+        return _pick(choice, phone, _join('0047', phone), _join('+47', phone))
+    elif locale == 'en':
+        number = rng.integers(0, 10**10, size=n)
+        area, exchange, line = _digits(number // 10**7, 3), _digits(number // 10**3 % 10**4, 4), _digits(number % 10**3, 3)
+        formatted = _join('(', area, ') ', exchange, '-', line)
+        return _pick(choice, _digits(number, 10), formatted, _join('+1 ', formatted))
+    else:
+        raise ValueError(f"Can't generate phone number for locale {locale}")
+
+
+def random_ssns(rng: np.random.Generator, locale: str, n: int) -> np.ndarray:
+    """random_ssns draws n social security numbers in the formats of generate_random_ssn."""
+    if locale == 'nb':
+        choice = rng.integers(0, 2, size=n)
+        number = rng.integers(0, 10**11, size=n)
+        return _pick(choice, _digits(number, 11), _join(_digits(number // 10**5, 6), ' ', _digits(number % 10**5, 5)))
+    elif locale == 'en':
+        choice = rng.integers(0, 3, size=n)
+        number = rng.integers(0, 10**9, size=n)
+        area, group, serial = _digits(number // 10**6, 3), _digits(number // 10**4 % 100, 2), _digits(number % 10**4, 4)
+        return _pick(choice, _digits(number, 9), _join(area, '-', group, '-', serial), _join(area, ' ', group, ' ', serial))
+    else:
+        raise ValueError(f"Can't generate SSN for locale {locale}")
+
+
+def finding_names(findings_source: dict) -> np.ndarray:
+    """finding_names lists the findings of every category, in the order random_findings numbers them."""
+    return np.array([finding for values in findings_source.values() for finding in values])
+
+
+def random_findings(rng: np.random.Generator, findings_source: dict, n: int) -> np.ndarray:
+    """random_findings draws one finding from each category for n patients, in a random order
+    for each patient, as an (n, categories) array of indices into finding_names."""
+    columns = []
+    first = 0
+    for values in findings_source.values():
+        columns.append(first + rng.integers(0, len(values), size=n, dtype=np.int16))
+        first += len(values)
+    return rng.permuted(np.stack(columns, axis=1), axis=1)
+
+
+def _draw(rng: np.random.Generator, vocabulary: Vocabulary, n: int, with_replacement: bool) -> np.ndarray:
+    if not with_replacement and n > len(vocabulary):
+        raise ValueError(f"The vocabulary only has {len(vocabulary)} lines but we requested {n} unique choices.")
+    return rng.choice(len(vocabulary), size=n, replace=with_replacement)
+
+
+@dataclasses.dataclass
+class ScenarioBatch:
+    """ScenarioBatch holds the fields of many scenarios as columns. Vocabulary entries
+    are kept as indices into the store until a Scenario is materialized."""
+    locale: str
+    store: VocabularyStore
+    document_types: np.ndarray
+    given_names: np.ndarray
+    family_names: np.ndarray
+    cities: np.ndarray
+    healthcare_units: np.ndarray
+    diagnoses: np.ndarray
+    ages: np.ndarray
+    birth_dates: np.ndarray
+    admission_dates: np.ndarray
+    phone_numbers: np.ndarray
+    social_security_numbers: np.ndarray
+    findings: np.ndarray
+    finding_names: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.ages)
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[Scenario, 'ScenarioBatch']:
+        if isinstance(key, slice):
+            columns = {f.name: getattr(self, f.name)[key] for f in dataclasses.fields(self)
+                       if isinstance(getattr(self, f.name), np.ndarray) and f.name != 'finding_names'}
+            return ScenarioBatch(locale=self.locale, store=self.store, finding_names=self.finding_names, **columns)
+
+        document_type = self.store.document_types[self.document_types[key]]
+        return Scenario(locale=self.locale,
+                        noteType=document_type['en'],
+                        translatedNoteType=document_type[self.locale],
+                        givenName=self.store.given_names[self.given_names[key]],
+                        familyName=self.store.family_names[self.family_names[key]],
+                        age=int(self.ages[key]),
+                        phoneNumber=str(self.phone_numbers[key]),
+                        city=self.store.cities[self.cities[key]],
+                        healthCareUnit=self.store.healthcare_units[self.healthcare_units[key]],
+                        diagnosis=self.store.diagnoses[self.diagnoses[key]],
+                        birthDate=str(self.birth_dates[key]),
+                        admissionDate=str(self.admission_dates[key]),
+                        socialSecurityNumber=str(self.social_security_numbers[key]),
+                        findings=self.finding_names[self.findings[key]].tolist())
+
+    def __iter__(self) -> Iterator[Scenario]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+def create_batch(n: int, locale: str, store: VocabularyStore, rng: np.random.Generator,
+                 with_replacement: bool = False, today: datetime.date = None) -> ScenarioBatch:
+    """create_batch draws n scenarios like create_scenarios in generate.py, one array per field."""
+    if today is None:
+        today = datetime.date.today()
+    birth_dates = random_dates(rng, BIRTH_DATES, n)
+    # Like create_scenarios, this ignores leap years
+    ages = (np.datetime64(today, 'D') - birth_dates).astype(int) // 365
+
+    return ScenarioBatch(
+        locale=locale,
+        store=store,
+        document_types=rng.integers(0, len(store.document_types), size=n),
+        given_names=_draw(rng, store.given_names, n, with_replacement),
+        family_names=_draw(rng, store.family_names, n, with_replacement),
+        cities=_draw(rng, store.cities, n, with_replacement),
+        healthcare_units=_draw(rng, store.healthcare_units, n, True),
+        diagnoses=_draw(rng, store.diagnoses, n, True),
+        ages=ages,
+        birth_dates=format_dates(birth_dates),
+        admission_dates=format_dates(random_dates(rng, ADMISSION_DATES, n)),
+        phone_numbers=random_phone_numbers(rng, locale, n),
+        social_security_numbers=random_ssns(rng, locale, n),
+        findings=random_findings(rng, store.findings, n),
+        finding_names=finding_names(store.findings))
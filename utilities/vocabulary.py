@@ -0,0 +1,146 @@
+"""
+vocabulary.py loads the vocabularies a split draws samples from once, keeping each
+vocabulary file as a single UTF-8 buffer with an array of line offsets.
+
+Optionally, the buffer and offsets are persisted in a binary index next to each file
+(e.g. vocabularies/training/nb_cities.csv.idx), which later runs memory-map instead of
+parsing the file again. An index is rebuilt when the size or modification time of its
+file has changed.
+"""
+import array
+import csv
+import functools
+import json
+import logging
+import mmap
+import os
+import pathlib
+import random
+import struct
+from typing import List, Tuple
+
+VOCABULARY_DIRECTORY = 'vocabularies'
+
+_INDEX_MAGIC = b'VOCIDX01'
+# magic, source size, source modification time (ns), number of lines
+_INDEX_HEADER = struct.Struct('<8sQQQ')
+
+
+class Vocabulary:
+    """Vocabulary gives random access to the stripped lines of a vocabulary file,
+    stored as one UTF-8 buffer and the offsets of each line in it."""
+    def __init__(self, buffer, offsets):
+        self._buffer = buffer
+        self._offsets = offsets
+
+    @classmethod
+    def from_lines(cls, lines: List[str]) -> 'Vocabulary':
+        encoded = [line.encode('utf8') for line in lines]
+        offsets = array.array('Q', [0])
+        total = 0
+        for line in encoded:
+            total += len(line)
+            offsets.append(total)
+        return cls(b''.join(encoded), offsets)
+
+    @classmethod
+    def from_file(cls, filename: pathlib.Path, persist_index: bool = False) -> 'Vocabulary':
+        """from_file reads a vocabulary with one entry per line. With persist_index set,
+        the index next to the file is used if it is up to date, and written otherwise."""
+        index_path = f'{filename}.idx'
+        if persist_index and _index_is_current(index_path, filename):
+            return cls._from_index(index_path)
+
+        with open(filename, 'r', encoding='utf8') as file:
+            lines = file.read().split('\n')
+        # Like readlines(), a trailing newline does not start another line
+        if lines[-1] == '':
+            lines.pop()
+        vocabulary = cls.from_lines([line.strip() for line in lines])
+
+        if persist_index:
+            try:
+                vocabulary._write_index(index_path, filename)
+            except OSError as error:
+                logging.warning(f"Could not write vocabulary index {index_path}: {error}")
+        return vocabulary
+
+    @classmethod
+    def _from_index(cls, index_path: str) -> 'Vocabulary':
+        with open(index_path, 'rb') as index_file:
+            mapped = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        _, _, _, count = _INDEX_HEADER.unpack_from(mapped)
+        view = memoryview(mapped)
+        offsets_end = _INDEX_HEADER.size + 8 * (count + 1)
+        offsets = view[_INDEX_HEADER.size:offsets_end].cast('Q')
+        return cls(view[offsets_end:], offsets)
+
+    def _write_index(self, index_path: str, source: pathlib.Path):
+        status = os.stat(source)
+        temporary_path = f'{index_path}.tmp'
+        with open(temporary_path, 'wb') as index_file:
+            index_file.write(_INDEX_HEADER.pack(_INDEX_MAGIC, status.st_size, status.st_mtime_ns, len(self)))
+            index_file.write(array.array('Q', self._offsets).tobytes())
+            index_file.write(self._buffer)
+        os.replace(temporary_path, index_path)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Vocabulary index {i} out of range")
+        return str(self._buffer[self._offsets[i]:self._offsets[i + 1]], 'utf8')
+
+    def sample(self, n: int, rng: random.Random = random) -> List[str]:
+        """sample draws n unique entries (consuming the random generator like random.sample on a list)."""
+        if n > len(self):
+            raise ValueError(f"The vocabulary only has {len(self)} lines but we requested {n} unique choices.")
+        return [self[i] for i in rng.sample(range(len(self)), n)]
+
+    def choices(self, n: int, rng: random.Random = random) -> List[str]:
+        """choices draws n entries with replacement (consuming the random generator like random.choices on a list)."""
+        return [self[i] for i in rng.choices(range(len(self)), k=n)]
+
+
+def _index_is_current(index_path: str, source: pathlib.Path) -> bool:
+    try:
+        status = os.stat(source)
+        with open(index_path, 'rb') as index_file:
+            header = index_file.read(_INDEX_HEADER.size)
+    except OSError:
+        return False
+    if len(header) < _INDEX_HEADER.size:
+        return False
+    magic, size, mtime_ns, _ = _INDEX_HEADER.unpack(header)
+    return magic == _INDEX_MAGIC and size == status.st_size and mtime_ns == status.st_mtime_ns
+
+
+class VocabularyStore:
+    """VocabularyStore holds every vocabulary used to create scenarios for one split."""
+    def __init__(self, split: str = 'all', directory: pathlib.Path = VOCABULARY_DIRECTORY, persist_index: bool = False):
+        def load(name: str) -> Vocabulary:
+            return Vocabulary.from_file(os.path.join(directory, split, name), persist_index)
+
+        self.split = split
+        self.given_names = load('nb_given_names.csv')
+        self.family_names = load('nb_family_names.csv')
+        self.cities = load('nb_cities.csv')
+        self.diagnoses = load('en_diagnoses.csv')
+        self.healthcare_units = load('nb_healthcare_units.csv')
+        with open(os.path.join(directory, 'document_types.csv'), 'r', encoding='utf8') as file:
+            self.document_types = list(csv.DictReader(file))
+        with open(os.path.join(directory, 'en_findings.json'), 'r') as findings_file:
+            self.findings = json.load(findings_file)
+
+    def sample_document_types(self, task_locale: str, title_locale: str, n: int = 1, rng: random.Random = random) -> List[Tuple[str, str]]:
+        random_types = rng.choices(self.document_types, k=n)
+        return [(r[task_locale], r[title_locale]) for r in random_types]
+
+
+@functools.lru_cache(maxsize=None)
+def load_store(split: str = 'all', directory: pathlib.Path = VOCABULARY_DIRECTORY, persist_index: bool = False) -> VocabularyStore:
+    """load_store returns the VocabularyStore for a split, loading it on first use."""
+    return VocabularyStore(split, directory, persist_index)
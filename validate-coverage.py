@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+validate-coverage.py checks that each note in the results of generate.py mentions the patient
+details of its scenario (names, phone number, social security number, birth date, health care
+unit and city), and that they are tagged with the right label.
+
+With --regenerate, only the notes that fail are requested again (with the parameters stored in
+the results, up to --attempts times), and the results are written to --output with the best
+note found for each record. Each attempt is cached under keys of its own, so the notes cached
+for the original run are kept, and validating the same results again reuses the attempts.
+"""
+import json
+import logging
+import pathlib
+import time
+from typing import Dict, Tuple
+
+from tap import Tap
+
+import generate
+import utilities.cache
+import utilities.coverage
+import utilities.metrics
+import utilities.records
+import utilities.stream
+
+class Arguments(Tap):
+    results: pathlib.Path = 'results.json'
+    """The results (or --checkpoint record file) of generate.py to validate"""
+    minCoverage: float = 1.0
+    """The fraction of the patient details a note must mention, tagged with the right label, to pass"""
+    report: pathlib.Path = None
+    """A JSON file to write the coverage of each field, and of each failing note, to"""
+    regenerate: bool = False
+    """Request the failing notes again, and write the results with the new notes to --output"""
+    attempts: int = 2
+    """How many times to request a failing note again"""
+    output: pathlib.Path = None
+    """The JSON file to write the results with the regenerated notes to"""
+    openAIKey: str = generate.OPENAI_PLACEHOLDER
+    """The API key to OpenAI"""
+    apiBase: str = None
+    """The base URL of an OpenAI-compatible API to use instead of OpenAI (e.g. utilities/stub_server.py)"""
+    concurrency: int = 8
+    """The maximum number of completion requests in flight at the same time"""
+    chunkSize: int = 2000
+    """The number of notes to match with each automaton"""
+    verbose: bool = False
+    """Whether to output debugging information"""
+
+def generation_arguments(args: Arguments, parameters: dict) -> generate.Arguments:
+    """generation_arguments gives the arguments of the run that created the results, with the API settings of args."""
+    generate_args = generate.Arguments().parse_args([])
+    for name, value in parameters.items():
+        if hasattr(generate_args, name):
+            setattr(generate_args, name, value)
+    generate_args.openAIKey = args.openAIKey
+    generate_args.apiBase = args.apiBase
+    generate_args.concurrency = args.concurrency
+    generate_args.dryRun = False
+    return generate_args
+
+def regenerate(args: Arguments, failing: Dict[int, utilities.coverage.NoteCoverage], scenarios: Dict[int, dict],
+               prompts: Dict[int, str], generate_args: generate.Arguments) -> Dict[int, Tuple[int, str]]:
+    """regenerate requests the failing notes again until they pass or args.attempts runs out,
+    giving the best note found for each (by coverage) with the attempt that found it."""
+    if generate_args.temperature == 0:
+        logging.warning("The results were generated with temperature 0, so new requests will likely give the same notes")
+    cache = utilities.cache.CompletionCache(generate.CACHE_PATH)
+    metrics = utilities.metrics.Metrics('validate')
+    best = {}
+    remaining = sorted(failing)
+    for attempt in range(1, args.attempts + 1):
+        if not remaining:
+            break
+        logging.info(f"Attempt {attempt}: requesting {len(remaining)} notes again")
+        engine = generate.create_engine(cache, generate_args, metrics, attempt=attempt)
+        notes = engine.complete_all([prompts[i] for i in remaining])
+        logging.info(engine.stats.summary())
+        checked = utilities.coverage.check_notes([scenarios[i] for i in remaining], notes, args.chunkSize)
+        still_failing = []
+        for index, note, coverage in zip(remaining, notes, checked):
+            if coverage.coverage > failing[index].coverage:
+                best[index] = (attempt, note)
+                failing[index] = coverage
+            if coverage.coverage < args.minCoverage:
+                still_failing.append(index)
+        remaining = still_failing
+    cache.save_counters()
+    return best
+
+def write_results(args: Arguments, parameters: dict, replaced: Dict[int, Tuple[int, str]], prompts: Dict[int, str],
+                  generate_args: generate.Arguments):
+    """write_results copies the results to args.output, one section at a time, with the replaced notes
+    (found in the given attempts)."""
+    cache = utilities.cache.CompletionCache(generate.CACHE_PATH)
+    replacements = {'results': {i: note for i, (_, note) in replaced.items()},
+                    'cleaned_results': {i: generate.clean_answer(note) for i, (_, note) in replaced.items()},
+                    'truncated': {i: generate.is_truncated(prompts[i], cache, generate_args, attempt=attempt)
+                                  for i, (attempt, _) in replaced.items()}}
+    count = sum(1 for _ in utilities.stream.iterate_section(args.results, 'scenarios'))
+    with open(args.output, 'w', encoding='utf8') as output:
+        output.write('{"parameters": ')
+        json.dump(parameters, output)
+        for section in utilities.records.SECTIONS:
+            output.write(f', "{section}": [')
+            for index, element in zip(range(count), utilities.stream.iterate_optional_section(args.results, section)):
+                if index > 0:
+                    output.write(', ')
+                json.dump(replacements.get(section, {}).get(index, element), output)
+            output.write(']')
+        output.write('}')
+
+def main(args: Arguments):
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    if args.regenerate and args.output is None:
+        raise ValueError("--regenerate needs an --output to write the results to")
+
+    started = time.perf_counter()
+    statuses = {field: {status: 0 for status in utilities.coverage.STATUSES} for field in utilities.coverage.FIELDS}
+    failing = {}
+    scenarios = {}
+    total = 0
+    checked = utilities.coverage.check_notes(utilities.stream.iterate_section(args.results, 'scenarios'),
+                                             utilities.stream.iterate_section(args.results, 'results'), args.chunkSize)
+    for index, (scenario, coverage) in enumerate(zip(utilities.stream.iterate_section(args.results, 'scenarios'), checked)):
+        total += 1
+        for field, status in coverage.fields.items():
+            statuses[field][status] += 1
+        if coverage.coverage < args.minCoverage:
+            failing[index] = coverage
+            scenarios[index] = scenario
+    logging.info(f"Checked {total} notes in {time.perf_counter() - started:.2f}s, {len(failing)} have less than "
+                 f"{100 * args.minCoverage:.0f}% coverage")
+    for field, counts in statuses.items():
+        print(f"{field:22s} " + ' '.join(f"{status} {count:6d}" for status, count in counts.items()))
+    initially_failing = len(failing)
+
+    regenerated = {}
+    if args.regenerate:
+        parameters = utilities.stream.read_parameters(args.results)
+        generate_args = generation_arguments(args, parameters)
+        prompts = {i: p for i, p in enumerate(utilities.stream.iterate_section(args.results, 'prompts')) if i in failing}
+        regenerated = regenerate(args, failing, scenarios, prompts, generate_args)
+        still_failing = sum(coverage.coverage < args.minCoverage for coverage in failing.values())
+        logging.info(f"Replaced {len(regenerated)} notes, {still_failing} of the {initially_failing} failing notes still fail")
+        write_results(args, parameters, regenerated, prompts, generate_args)
+        logging.info(f"Wrote results to {args.output}")
+
+    if args.report is not None:
+        report = {'notes': total, 'min_coverage': args.minCoverage, 'failing': initially_failing,
+                  'regenerated': len(regenerated),
+                  'still_failing': sum(coverage.coverage < args.minCoverage for coverage in failing.values()),
+                  'fields': statuses,
+                  'failing_notes': [{'index': i, 'coverage': c.coverage, 'fields': c.fields, 'found_labels': c.found_labels,
+                                     'regenerated': i in regenerated} for i, c in sorted(failing.items())]}
+        with open(args.report, 'w', encoding='utf8') as report_file:
+            json.dump(report, report_file, indent=2)
+
+if __name__ == '__main__':
+    args = Arguments()
+    args.parse_args()
+    main(args)